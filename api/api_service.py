@@ -6,6 +6,7 @@ from flask import Blueprint, request, jsonify, Response, make_response
 import os
 import logging
 import json
+import time
 import jwt
 from datetime import datetime, timedelta
 from functools import wraps
@@ -33,6 +34,15 @@ api_bp = Blueprint('api', __name__)
 # Secret key cho JWT
 SECRET_KEY = os.getenv('API_SECRET_KEY', 'default_secret_key')
 
+# Số tin nhắn gần nhất của hội thoại gửi kèm cho mô hình
+CHAT_HISTORY_LIMIT = int(os.getenv('CHAT_HISTORY_LIMIT', '20'))
+
+# Quyền đặc biệt của API key: không dùng bộ đệm phản hồi cho các request chat công khai
+NO_RESPONSE_CACHE_PERMISSION = "no_response_cache"
+
+# Các tài khoản (phân tách bằng dấu phẩy) được xem /api/metrics; để trống thì không ai được xem
+METRICS_USERS = {u.strip() for u in os.getenv('METRICS_USERS', '').split(',') if u.strip()}
+
 # Khởi tạo các dịch vụ
 chatbot_service = CodeSupporterService()
 storage_service = StorageService()
@@ -113,8 +123,9 @@ def api_key_required(f):
         if required_permission not in permissions:
             return jsonify({'message': 'API key không có quyền truy cập!'}), 403
         
-        # Lưu API key để sử dụng trong hàm
+        # Lưu API key và quyền để sử dụng trong hàm
         kwargs['api_key'] = api_key
+        kwargs['api_key_permissions'] = permissions
         
         return f(*args, **kwargs)
     
@@ -130,15 +141,27 @@ def get_conversations(current_user):
         # Lấy các tham số query
         limit = request.args.get('limit', 20, type=int)
         offset = request.args.get('offset', 0, type=int)
+        cursor = request.args.get('cursor')  # Phân trang keyset (ưu tiên hơn offset)
+        
+        if cursor and not storage_service.parse_conversation_cursor(cursor):
+            return jsonify({"error": "Cursor không hợp lệ"}), 400
         
         # Lấy danh sách hội thoại từ storage service
-        conversations = storage_service.get_conversations(current_user, limit=limit, offset=offset)
+        conversations = storage_service.get_conversations(
+            current_user, limit=limit, offset=offset, cursor=cursor
+        )
+        
+        # Cursor cho trang tiếp theo (None nếu đã hết)
+        next_cursor = None
+        if conversations and len(conversations) >= limit:
+            next_cursor = storage_service.make_conversation_cursor(conversations[-1])
         
         # Trả về danh sách
         return jsonify({
             "conversations": conversations,
             "count": len(conversations),
-            "total": storage_service.get_conversations_count(current_user)
+            "total": storage_service.get_conversations_count(current_user),
+            "next_cursor": next_cursor
         })
         
     except Exception as e:
@@ -169,8 +192,17 @@ def get_conversation(current_user, conversation_id):
             logger.warning(f"Không tìm thấy hội thoại với ID: {conversation_id}")
             return jsonify({"error": "Không tìm thấy hội thoại"}), 404
         
-        # Lấy tin nhắn của hội thoại
-        messages = storage_service.get_conversation_messages(conversation_id)
+        # Lấy tin nhắn của hội thoại (?limit=&before= để lấy từng trang từ cuối lên)
+        limit = request.args.get('limit', type=int)
+        before = request.args.get('before')
+        
+        if limit or before:
+            limit = limit or 50
+            messages = storage_service.get_recent_messages(conversation_id, limit=limit, before=before)
+            has_more = len(messages) >= limit
+        else:
+            messages = storage_service.get_conversation_messages(conversation_id)
+            has_more = False
         
         # Chuẩn bị dữ liệu phản hồi
         conversation_data = {
@@ -178,12 +210,13 @@ def get_conversation(current_user, conversation_id):
             "title": conversation.get("title") or "Hội thoại không có tiêu đề",
             "created_at": conversation.get("created_at"),
             "updated_at": conversation.get("updated_at"),
-            "message_count": len(messages)
+            "message_count": conversation.get("message_count", len(messages))
         }
         
         return jsonify({
             "conversation": conversation_data,
-            "messages": messages
+            "messages": messages,
+            "has_more": has_more
         })
         
     except Exception as e:
@@ -316,10 +349,14 @@ def chat_authenticated(current_user):
         
         # Lấy lịch sử hội thoại
         conversation_history = []
+        summary = None
+        pending_messages = 0
+        context = {}
         if conversation_id:
-            # Nếu có conversation_id, lấy tin nhắn từ hội thoại đó
-            messages = storage_service.get_conversation_messages(conversation_id)
-            conversation_history = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+            # Nếu có conversation_id, lấy bản tóm tắt và các tin nhắn gần nhất chưa được tóm tắt
+            summary, conversation_history, pending_messages = chatbot_service.load_conversation_context(
+                storage_service, conversation_id, limit=CHAT_HISTORY_LIMIT, context=context
+            )
         else:
             # Tạo hội thoại mới nếu không có conversation_id
             conversation_title = "Hội thoại " + datetime.now().strftime("%d/%m/%Y %H:%M")
@@ -330,21 +367,29 @@ def chat_authenticated(current_user):
                 logger.error(f"Không thể tạo hội thoại mới cho người dùng {current_user}")
                 return jsonify({"error": "Không thể tạo hội thoại mới"}), 500
         
-        # Lưu tin nhắn người dùng vào hội thoại
-        if not storage_service.add_message_to_conversation(conversation_id, "user", user_message):
-            logger.error(f"Không thể thêm tin nhắn người dùng vào hội thoại {conversation_id}")
-            return jsonify({"error": "Không thể lưu tin nhắn"}), 500
+        # Thời điểm gửi tin nhắn người dùng (giữ thứ tự khi lưu cả lượt chat sau khi có phản hồi)
+        user_timestamp = datetime.now()
         
-        # Gọi service để tạo phản hồi
-        bot_reply = chatbot_service.generate_response(user_message, conversation_history)
+        # Gọi service để tạo phản hồi (lịch sử được cắt theo ngân sách token, báo cáo trong context)
+        bot_reply = chatbot_service.generate_response(
+            user_message, conversation_history, context=context, summary=summary
+        )
+        
+        # Lưu cả lượt chat (tin nhắn người dùng + phản hồi) vào hội thoại trong một lần ghi
+        if not storage_service.add_messages_to_conversation(conversation_id, [
+            {"role": "user", "content": user_message, "timestamp": user_timestamp},
+            {"role": "assistant", "content": bot_reply}
+        ]):
+            logger.error(f"Không thể lưu lượt chat vào hội thoại {conversation_id}")
+            return jsonify({"error": "Không thể lưu tin nhắn"}), 500
         
-        # Lưu phản hồi vào hội thoại
-        if not storage_service.add_message_to_conversation(conversation_id, "assistant", bot_reply):
-            logger.error(f"Không thể lưu phản hồi vào hội thoại {conversation_id}")
+        # Làm mới bản tóm tắt hội thoại trong nền sau mỗi SUMMARY_REFRESH_TURNS lượt chat
+        chatbot_service.schedule_summary_refresh(storage_service, conversation_id, pending_messages + 2)
         
         return jsonify({
             "reply": bot_reply,
             "conversation_id": conversation_id,
+            "context": context,
             "status": "success"
         })
         
@@ -378,10 +423,14 @@ def chat_stream(current_user):
         
         # Lấy lịch sử hội thoại
         conversation_history = []
+        summary = None
+        pending_messages = 0
+        context = {}
         if conversation_id:
-            # Nếu có conversation_id, lấy tin nhắn từ hội thoại đó
-            messages = storage_service.get_conversation_messages(conversation_id)
-            conversation_history = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+            # Nếu có conversation_id, lấy bản tóm tắt và các tin nhắn gần nhất chưa được tóm tắt
+            summary, conversation_history, pending_messages = chatbot_service.load_conversation_context(
+                storage_service, conversation_id, limit=CHAT_HISTORY_LIMIT, context=context
+            )
         else:
             # Tạo hội thoại mới nếu không có conversation_id
             conversation_title = "Hội thoại " + datetime.now().strftime("%d/%m/%Y %H:%M")
@@ -392,24 +441,34 @@ def chat_stream(current_user):
                 logger.error(f"Không thể tạo hội thoại mới cho người dùng {current_user} trong stream API")
                 return jsonify({"error": "Không thể tạo hội thoại mới"}), 500
         
-        # Lưu tin nhắn người dùng vào hội thoại
-        if not storage_service.add_message_to_conversation(conversation_id, "user", user_message):
-            logger.error(f"Không thể thêm tin nhắn người dùng vào hội thoại {conversation_id} trong stream API")
-            return jsonify({"error": "Không thể lưu tin nhắn"}), 500
+        # Thời điểm gửi tin nhắn người dùng (lượt chat được lưu một lần khi stream kết thúc)
+        user_timestamp = datetime.now()
         
         def generate():
             full_response = ""
             
-            # Stream phản hồi từ mô hình
-            for text_chunk in chatbot_service.generate_response_stream(user_message, conversation_history):
-                full_response += text_chunk
-                yield f"data: {json.dumps({'chunk': text_chunk, 'done': False})}\n\n"
-            
-            # Lưu phản hồi đầy đủ vào lịch sử
-            storage_service.add_message_to_conversation(conversation_id, "assistant", full_response)
+            try:
+                # Stream phản hồi từ mô hình
+                for text_chunk in chatbot_service.generate_response_stream(
+                    user_message, conversation_history, context=context, summary=summary
+                ):
+                    full_response += text_chunk
+                    yield f"data: {json.dumps({'chunk': text_chunk, 'done': False})}\n\n"
+            finally:
+                # Lưu cả lượt chat trong một lần ghi, kể cả khi client ngắt kết nối giữa chừng
+                turn = [{"role": "user", "content": user_message, "timestamp": user_timestamp}]
+                if full_response:
+                    turn.append({"role": "assistant", "content": full_response})
+                
+                if storage_service.add_messages_to_conversation(conversation_id, turn):
+                    chatbot_service.schedule_summary_refresh(
+                        storage_service, conversation_id, pending_messages + len(turn)
+                    )
+                else:
+                    logger.error(f"Không thể lưu lượt chat vào hội thoại {conversation_id} trong stream API")
             
             # Gửi thông báo conversation_id và hoàn thành
-            yield f"data: {json.dumps({'chunk': '', 'done': True, 'conversation_id': conversation_id})}\n\n"
+            yield f"data: {json.dumps({'chunk': '', 'done': True, 'conversation_id': conversation_id, 'context': context})}\n\n"
         
         return Response(generate(), mimetype='text/event-stream')
         
@@ -445,10 +504,27 @@ def chat_public(**kwargs):
         conversation_history = data.get("conversation_history", [])
         
         # Gọi service để tạo phản hồi
-        bot_reply = chatbot_service.generate_response(user_message, conversation_history)
+        start_time = time.monotonic()
+        usage = {}
+        context = {}
+        bot_reply = chatbot_service.generate_response(
+            user_message, conversation_history, usage=usage,
+            use_cache=NO_RESPONSE_CACHE_PERMISSION not in kwargs.get('api_key_permissions', []),
+            context=context
+        )
+        
+        # Ghi nhận sự kiện sử dụng API (độ trễ, số token)
+        storage_service.record_api_usage_event(
+            api_key, user_id,
+            latency_ms=(time.monotonic() - start_time) * 1000,
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            cached=usage.get("cached", False)
+        )
         
         return jsonify({
             "reply": bot_reply,
+            "context": context,
             "status": "success"
         })
         
@@ -482,14 +558,32 @@ def chat_public_stream(**kwargs):
         
         # Lấy lịch sử hội thoại (nếu có)
         conversation_history = data.get("conversation_history", [])
+        use_cache = NO_RESPONSE_CACHE_PERMISSION not in kwargs.get('api_key_permissions', [])
         
         def generate():
-            # Stream phản hồi từ mô hình
-            for text_chunk in chatbot_service.generate_response_stream(user_message, conversation_history):
-                yield f"data: {json.dumps({'chunk': text_chunk, 'done': False})}\n\n"
+            start_time = time.monotonic()
+            usage = {}
+            context = {}
+            
+            try:
+                # Stream phản hồi từ mô hình
+                for text_chunk in chatbot_service.generate_response_stream(
+                    user_message, conversation_history, usage=usage, use_cache=use_cache, context=context
+                ):
+                    yield f"data: {json.dumps({'chunk': text_chunk, 'done': False})}\n\n"
+            finally:
+                # Ghi nhận sự kiện sử dụng API, kể cả khi client ngắt kết nối giữa chừng
+                storage_service.record_api_usage_event(
+                    api_key, user_id,
+                    latency_ms=(time.monotonic() - start_time) * 1000,
+                    prompt_tokens=usage.get("prompt_tokens"),
+                    completion_tokens=usage.get("completion_tokens"),
+                    stream=True,
+                    cached=usage.get("cached", False)
+                )
             
             # Gửi thông báo hoàn thành
-            yield f"data: {json.dumps({'chunk': '', 'done': True})}\n\n"
+            yield f"data: {json.dumps({'chunk': '', 'done': True, 'context': context})}\n\n"
         
         # Thêm CORS header cho Stream API
         response = Response(generate(), mimetype='text/event-stream')
@@ -513,7 +607,27 @@ def health_check():
         "service": "Code Supporter API",
         "version": "1.0.0",
         "timestamp": datetime.now().isoformat(),
-        "storage_type": storage_service.storage_type
+        "storage_type": storage_service.storage_type,
+        "write_concern": storage_service.get_write_concern_policy()
+    })
+
+@api_bp.route('/metrics', methods=['GET'])
+@token_required
+def storage_metrics(current_user):
+    """
+    API xuất metrics của lớp lưu trữ (connection pool, độ trễ lệnh MongoDB, bộ đệm thực thể),
+    bộ đệm phản hồi và việc cắt lịch sử theo ngân sách token (chỉ tài khoản trong METRICS_USERS)
+    """
+    if current_user not in METRICS_USERS:
+        return jsonify({'message': 'Không có quyền xem metrics!'}), 403
+    
+    return jsonify({
+        "timestamp": datetime.now().isoformat(),
+        "storage_type": storage_service.storage_type,
+        "mongodb": storage_service.get_mongo_metrics(),
+        "cache": storage_service.get_cache_status(),
+        "response_cache": chatbot_service.get_response_cache_stats(),
+        "context": chatbot_service.get_context_stats()
     })
 
 @api_bp.route('/register', methods=['POST'])
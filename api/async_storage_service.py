@@ -0,0 +1,335 @@
+"""
+Module lưu trữ bất đồng bộ cho Code Supporter
+Dùng cho front end async (asyncio): nhiều hội thoại đồng thời trong một tiến trình mà không
+chiếm một thread cho mỗi thao tác lưu trữ
+"""
+import os
+import asyncio
+import functools
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Tuple, Optional, Any
+
+from bson.objectid import ObjectId
+from pymongo.write_concern import WriteConcern
+
+from .storage_service import StorageService, mongo_client_options
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient  # Driver MongoDB bất đồng bộ (tùy chọn)
+except ImportError:
+    AsyncIOMotorClient = None
+
+logger = logging.getLogger(__name__)
+
+# Số thread thực hiện các thao tác lưu trữ đồng bộ (SQLite, file và các thao tác MongoDB chưa có trên Motor)
+ASYNC_STORAGE_THREADS = int(os.getenv("ASYNC_STORAGE_THREADS", "32"))
+
+
+class AsyncStorageService:
+    """
+    Dịch vụ lưu trữ bất đồng bộ với cùng API công khai như StorageService (mỗi phương thức trả về coroutine)
+
+    Với MongoDB (khi cài motor), các thao tác trên đường chat chạy trực tiếp trên Motor: xác thực
+    API key, kiểm tra quyền truy cập hội thoại, đọc tin nhắn gần nhất và ghi một lượt chat.
+    Các thao tác còn lại, lưu trữ SQLite và lưu trữ file chạy trên StorageService trong thread pool
+    riêng (ASYNC_STORAGE_THREADS), nên dùng chung khóa file, bộ đệm và write-behind với phần đồng bộ.
+    """
+
+    def __init__(self, storage: StorageService = None, db_uri=None):
+        """
+        Khởi tạo dịch vụ lưu trữ bất đồng bộ
+
+        Args:
+            storage (StorageService, optional): Dịch vụ lưu trữ đồng bộ dùng chung (tạo mới nếu không có)
+            db_uri (str, optional): URI MongoDB khi tạo StorageService mới
+        """
+        self._storage = storage or StorageService(db_uri)
+        self._executor = ThreadPoolExecutor(max_workers=ASYNC_STORAGE_THREADS, thread_name_prefix="async-storage")
+        # Client Motor và các database theo write concern, theo event loop (tạo khi dùng lần đầu trong loop)
+        self._motor_clients: Dict[asyncio.AbstractEventLoop, Tuple[Any, Dict[str, Any]]] = {}
+        self._motor_pid = None
+        self._motor_lock = threading.Lock()
+
+        if self._storage.storage_type == "mongodb" and AsyncIOMotorClient is None:
+            logger.warning("Chưa cài motor, các thao tác MongoDB bất đồng bộ chạy trong thread pool")
+
+    def __getattr__(self, name: str):
+        """Các phương thức công khai khác của StorageService: chạy trong thread pool"""
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        attr = getattr(self._storage, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await self._run(attr, *args, **kwargs)
+
+        return call
+
+    async def _run(self, func, *args, **kwargs) -> Any:
+        """Chạy một hàm đồng bộ trong thread pool của dịch vụ"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def _use_motor(self) -> bool:
+        """Dùng Motor cho các thao tác trên đường chat (MongoDB và đã cài motor)"""
+        return self._storage.storage_type == "mongodb" and AsyncIOMotorClient is not None
+
+    def _motor_db(self, tier: str = "critical"):
+        """
+        Lấy database Motor của event loop hiện tại với write concern của loại thao tác (critical/messages/telemetry)
+
+        Client Motor được tạo một lần cho mỗi event loop (client gắn với loop tạo ra nó) với cùng cấu hình
+        pool và metrics như MongoClient; client của các loop đã đóng được đóng khi một loop mới dùng dịch vụ.
+        """
+        loop = asyncio.get_running_loop()
+
+        with self._motor_lock:
+            if self._motor_pid != os.getpid():
+                # Client của tiến trình cha không dùng được sau fork
+                self._motor_clients = {}
+                self._motor_pid = os.getpid()
+
+            entry = self._motor_clients.get(loop)
+            if entry is None:
+                write_concerns = self._storage.write_concerns
+                client = AsyncIOMotorClient(
+                    self._storage.db_uri, **mongo_client_options(write_concerns["critical"])
+                )
+                dbs = {
+                    name: client.get_database(self._storage.db.name, write_concern=WriteConcern(w=w))
+                    for name, w in write_concerns.items()
+                }
+                entry = (client, dbs)
+                self._motor_clients[loop] = entry
+
+                stale_clients = self._pop_motor_clients(lambda l: l.is_closed())
+            else:
+                stale_clients = []
+
+        self._close_motor_clients(stale_clients)
+        dbs = entry[1]
+        return dbs.get(tier, dbs["critical"])
+
+    async def aclose(self) -> None:
+        """Đóng client Motor của event loop hiện tại và của các event loop đã đóng (khi tắt ứng dụng async)"""
+        loop = asyncio.get_running_loop()
+        with self._motor_lock:
+            clients = self._pop_motor_clients(lambda l: l is loop or l.is_closed())
+
+        self._close_motor_clients(clients)
+
+    def _pop_motor_clients(self, predicate) -> List[Any]:
+        """Bỏ (gọi khi giữ _motor_lock) và trả về client Motor của các event loop thỏa predicate"""
+        loops = [loop for loop in self._motor_clients if predicate(loop)]
+        return [self._motor_clients.pop(loop)[0] for loop in loops]
+
+    def _close_motor_clients(self, clients: List[Any]) -> None:
+        """Đóng các client Motor (và pool kết nối của chúng)"""
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                logger.warning(f"Lỗi khi đóng client Motor: {str(e)}")
+
+    async def _get_cached_entity(self, collection: str, key: Any, load) -> Any:
+        """Như StorageService._get_cached_entity, với load là coroutine function"""
+        hit, value, generation = self._storage._lookup_cached_entity(collection, key)
+        if hit:
+            return value
+
+        value, doc_id = await load()
+        self._storage._store_cached_entity(collection, key, value, doc_id, generation)
+        return value
+
+    # --- Thao tác trong bộ nhớ (bộ đệm write-behind), không cần thread pool ---
+
+    async def track_api_user(self, api_key: str, user_id: str, user_info: Dict = None) -> bool:
+        """Theo dõi người dùng qua API (ghi vào bộ đệm write-behind)"""
+        return self._storage.track_api_user(api_key, user_id, user_info)
+
+    async def record_api_usage_event(self, api_key: str, user_id: str = None, latency_ms: float = None,
+                                     prompt_tokens: int = None, completion_tokens: int = None,
+                                     stream: bool = False, cached: bool = False) -> bool:
+        """Ghi nhận một sự kiện sử dụng API (ghi vào bộ đệm write-behind)"""
+        return self._storage.record_api_usage_event(
+            api_key, user_id, latency_ms, prompt_tokens, completion_tokens, stream, cached
+        )
+
+    # --- Đường chat trên Motor ---
+
+    async def verify_api_key(self, api_key: str) -> Tuple[bool, List[str]]:
+        """Xác thực API key"""
+        if not self._use_motor():
+            return await self._run(self._storage.verify_api_key, api_key)
+
+        try:
+            db = self._motor_db()
+
+            async def load_permissions():
+                key_data = await db.api_keys.find_one(
+                    {"key": api_key, "status": "active"},
+                    {"permissions": 1}
+                )
+                return (key_data["permissions"], key_data["_id"]) if key_data else (None, None)
+
+            permissions = await self._get_cached_entity("api_keys", api_key, load_permissions)
+
+            if permissions is None:
+                return False, []
+
+            # Cập nhật thời gian sử dụng (ghi sau)
+            self._storage._buffer_write("api_key_last_used", api_key, datetime.now())
+
+            return True, permissions
+
+        except Exception as e:
+            logger.error(f"Lỗi khi xác thực API key: {str(e)}")
+            return False, []
+
+    async def check_conversation_access(self, username: str, conversation_id: str) -> bool:
+        """Kiểm tra quyền truy cập hội thoại"""
+        if not self._use_motor():
+            return await self._run(self._storage.check_conversation_access, username, conversation_id)
+
+        try:
+            if not self._storage._is_valid_object_id(conversation_id):
+                logger.warning(f"Conversation ID không phải ObjectId hợp lệ: {conversation_id}")
+                return False
+
+            obj_id = ObjectId(conversation_id)
+            db = self._motor_db()
+
+            async def load_owner():
+                conversation = await db.conversations.find_one({"_id": obj_id}, {"username": 1})
+                return (conversation.get("username"), obj_id) if conversation else (None, None)
+
+            owner = await self._get_cached_entity("conversations", conversation_id, load_owner)
+
+            if not owner:
+                logger.warning(f"Không tìm thấy hội thoại với ID: {conversation_id}")
+                return False
+
+            return owner == username
+        except Exception as e:
+            logger.error(f"Lỗi khi kiểm tra quyền truy cập hội thoại: {str(e)}")
+            return False
+
+    async def get_recent_messages(self, conversation_id: str, limit: int = 20,
+                                  before: Optional[str] = None, after: Optional[str] = None) -> List[Dict]:
+        """
+        Lấy một phần tin nhắn của hội thoại (xem StorageService.get_recent_messages)
+
+        Returns:
+            List[Dict]: Danh sách tin nhắn theo thứ tự thời gian tăng dần
+        """
+        if not self._use_motor():
+            return await self._run(self._storage.get_recent_messages, conversation_id, limit, before, after)
+
+        try:
+            if not self._storage._is_valid_object_id(conversation_id):
+                logger.warning(f"Conversation ID không phải ObjectId hợp lệ khi lấy tin nhắn: {conversation_id}")
+                return []
+
+            obj_id = ObjectId(conversation_id)
+            query = {"conversation_id": obj_id}
+            db = self._motor_db()
+
+            # Hội thoại đã lưu trữ (hiếm, có cờ archived): đưa tin nhắn trở lại kho chính bằng phần đồng bộ
+            if await db.conversations.find_one({"_id": obj_id, "archived": True}, {"_id": 1}):
+                await self._run(self._storage._rehydrate_conversation, conversation_id)
+
+            anchor_id = after or before
+            if anchor_id:
+                # Tìm tin nhắn mốc (theo id hoặc _id)
+                anchor_query = {"conversation_id": obj_id, "id": anchor_id}
+                if self._storage._is_valid_object_id(anchor_id):
+                    anchor_query = {"conversation_id": obj_id, "$or": [{"id": anchor_id}, {"_id": ObjectId(anchor_id)}]}
+                anchor = await db.conversation_messages.find_one(anchor_query, {"timestamp": 1})
+
+                if not anchor:
+                    logger.warning(f"Không tìm thấy tin nhắn mốc {anchor_id} trong hội thoại {conversation_id}")
+                    return []
+
+                op = "$gt" if after else "$lt"
+                query["$or"] = [
+                    {"timestamp": {op: anchor["timestamp"]}},
+                    {"timestamp": anchor["timestamp"], "_id": {op: anchor["_id"]}}
+                ]
+
+            # Dùng index (conversation_id, timestamp, _id), không sắp xếp trong bộ nhớ
+            direction = 1 if after else -1
+            messages = await db.conversation_messages.find(query).sort(
+                [("timestamp", direction), ("_id", direction)]
+            ).limit(limit).to_list(length=limit)
+
+            if not after:
+                messages.reverse()
+
+            return [self._storage._sanitize_mongodb_doc(msg) for msg in messages]
+        except Exception as e:
+            logger.error(f"Lỗi khi lấy tin nhắn hội thoại: {str(e)}")
+            return []
+
+    async def add_message_to_conversation(self, conversation_id: str, role: str, content: str) -> bool:
+        """Thêm tin nhắn vào hội thoại"""
+        return await self.add_messages_to_conversation(
+            conversation_id, [{"role": role, "content": content}]
+        )
+
+    async def add_messages_to_conversation(self, conversation_id: str, messages: List[Dict[str, Any]]) -> bool:
+        """
+        Thêm nhiều tin nhắn vào hội thoại trong một lần ghi (xem StorageService.add_messages_to_conversation)
+
+        Returns:
+            bool: True nếu thành công, False nếu thất bại
+        """
+        if not self._use_motor():
+            return await self._run(self._storage.add_messages_to_conversation, conversation_id, messages)
+
+        try:
+            if not messages:
+                return True
+
+            # Chuyển conversation_id thành ObjectId nếu hợp lệ
+            conversation_key = conversation_id
+            if self._storage._is_valid_object_id(conversation_id):
+                conversation_key = ObjectId(conversation_id)
+
+            messages_data = [
+                {
+                    "conversation_id": conversation_key,
+                    "id": str(uuid.uuid4()),
+                    "role": message["role"],
+                    "content": message["content"],
+                    "timestamp": message.get("timestamp") or datetime.now()
+                }
+                for message in messages
+            ]
+
+            db = self._motor_db("messages")
+
+            # Thêm các tin nhắn mới
+            await db.conversation_messages.insert_many(messages_data, ordered=True)
+
+            # Cập nhật thời gian cập nhật và thông tin tóm tắt của hội thoại
+            summary = self._storage._conversation_stats_summary(messages_data)
+            result = await db.conversations.update_one(
+                {"_id": conversation_key, "message_count": {"$exists": True}},
+                {"$set": summary, "$inc": {"message_count": len(messages_data)}}
+            )
+
+            if result.matched_count == 0:
+                # Hội thoại cũ chưa có message_count: để backfill_conversation_stats đếm lại từ tin nhắn
+                await db.conversations.update_one({"_id": conversation_key}, {"$set": summary})
+
+            return True
+        except Exception as e:
+            logger.error(f"Lỗi khi thêm tin nhắn vào hội thoại: {str(e)}")
+            return False
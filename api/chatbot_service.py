@@ -2,13 +2,21 @@
 Module chuyên biệt cho dịch vụ chatbot Code Supporter
 Cập nhật: Sử dụng Together API phiên bản mới
 """
-from together import Together
+from together import Together, AsyncTogether, DefaultAsyncHttpxClient
 import os
 from dotenv import load_dotenv
 import logging
 import time
+import asyncio
+import threading
+import httpx
 import backoff
-from typing import List, Dict, Any, Generator, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Any, Generator, AsyncGenerator, Optional
+
+from .response_cache import ResponseCache, RESPONSE_CACHE
+from .near_duplicate_cache import NearDuplicateIndex, NEAR_DUPLICATE_CACHE, minhash_signature
+from .context_builder import ContextBuilder, count_tokens
 
 # Cấu hình logging
 logging.basicConfig(
@@ -20,12 +28,30 @@ logger = logging.getLogger(__name__)
 # Load biến môi trường
 load_dotenv()
 
+# Đường sinh phản hồi bất đồng bộ: số lời gọi mô hình đồng thời tối đa của mỗi tiến trình
+# và số kết nối HTTP trong pool dùng chung của client async
+TOGETHER_MAX_CONCURRENCY = int(os.getenv("TOGETHER_MAX_CONCURRENCY", "32"))
+TOGETHER_MAX_CONNECTIONS = int(os.getenv("TOGETHER_MAX_CONNECTIONS", "64"))
+
+# Tóm tắt lũy tiến của hội thoại: bật/tắt, làm mới sau mỗi số lượt chat này, số tin nhắn gần nhất
+# luôn gửi nguyên văn (không tóm tắt) và độ dài tối đa của bản tóm tắt (token)
+CONVERSATION_SUMMARY = os.getenv("CONVERSATION_SUMMARY", "false").lower() == "true"
+SUMMARY_REFRESH_TURNS = int(os.getenv("SUMMARY_REFRESH_TURNS", "5"))
+SUMMARY_KEEP_RECENT_MESSAGES = int(os.getenv("SUMMARY_KEEP_RECENT_MESSAGES", "10"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "512"))
+# Giới hạn của một lần tóm tắt: số tin nhắn, số token đầu vào và số ký tự mỗi tin nhắn
+SUMMARY_BATCH_MESSAGES = 40
+SUMMARY_INPUT_TOKENS = 6000
+SUMMARY_MESSAGE_MAX_CHARS = 4000
+# Số thread làm mới tóm tắt trong nền của mỗi tiến trình
+SUMMARY_THREADS = 2
+
 # Decorator cho backoff retry
-def on_api_error(e):
+def on_api_error(details):
     """
-    Hàm xử lý lỗi khi cần retry
+    Hàm xử lý lỗi khi cần retry (details do backoff truyền vào)
     """
-    logger.warning(f"Lỗi gọi API, thử lại: {str(e)}")
+    logger.warning(f"Lỗi gọi API (lần {details.get('tries')}), thử lại: {str(details.get('exception'))}")
 
 class CodeSupporterService:
     def __init__(self, api_key=None, model_name=None):
@@ -63,6 +89,23 @@ class CodeSupporterService:
             logger.error(f"Lỗi khởi tạo kết nối Together API: {str(e)}")
             raise
         
+        # Bộ đệm phản hồi theo khóa băm của đầu vào (None nếu tắt RESPONSE_CACHE) và chỉ mục
+        # câu hỏi gần trùng trên bộ đệm đó (None nếu tắt NEAR_DUPLICATE_CACHE)
+        self.response_cache = ResponseCache() if RESPONSE_CACHE else None
+        self.near_duplicate_index = NearDuplicateIndex() if RESPONSE_CACHE and NEAR_DUPLICATE_CACHE else None
+        
+        # Ngân sách token của ngữ cảnh (cắt lịch sử cũ khi prompt quá dài)
+        self.context_builder = ContextBuilder()
+        
+        # Làm mới tóm tắt hội thoại trong nền (thread pool tạo khi dùng lần đầu)
+        self._summary_executor = None
+        self._summary_refreshing = set()
+        self._summary_lock = threading.Lock()
+        
+        # Client async và semaphore giới hạn đồng thời theo event loop, tạo khi gọi lần đầu trong loop
+        self._async_clients: Dict[asyncio.AbstractEventLoop, Tuple[Any, asyncio.Semaphore]] = {}
+        self._async_clients_lock = threading.Lock()
+        
         # Prompt hệ thống mặc định
         self.system_prompt = (
             "Bạn là một trợ lý viết code hỗ trợ học sinh với các bài tập lập trình. Bạn được finetune và chỉnh sửa bỏi Châu Phúc Khang. "
@@ -70,13 +113,25 @@ class CodeSupporterService:
             "Lưu ý, chỉ đưa code trực tiếp khi và chỉ khi học sinh yêu cầu rõ ràng trong tin nhắn, nếu không thì tập trung vào giải thích logic và ý tưởng giải giúp học sinh tự viết code và hỏi rằng học sinh có cần đưa code thẳng không. "
             "Ngoài việc sinh code, bạn cũng có thể giải thích các thắc mắc liên quan đến lập trình và nếu người dùng có hỏi điều gì ngoài lập trình thì bạn vẫn đối thoại được như bình thường"
         )
+        
+        # Prompt tạo tóm tắt hội thoại
+        self.summary_prompt = (
+            "Bạn tóm tắt hội thoại giữa học sinh và trợ lý lập trình để trợ lý tiếp tục hỗ trợ mà không cần đọc lại toàn bộ. "
+            "Hãy cập nhật bản tóm tắt hiện có với các tin nhắn tiếp theo, giữ lại: bài tập hoặc vấn đề học sinh đang làm, "
+            "ngôn ngữ lập trình, các đoạn code và lỗi quan trọng, những gì đã giải thích hoặc đã thống nhất, và câu hỏi còn bỏ ngỏ. "
+            "Viết ngắn gọn bằng ngôn ngữ của hội thoại, chỉ trả về bản tóm tắt."
+        )
     
     @backoff.on_exception(backoff.expo, 
                          (Exception),
                          max_tries=3,
                          on_backoff=on_api_error)
     def generate_response(self, user_message: str, conversation_history: Optional[List[Dict[str, str]]] = None, 
-                         custom_params: Optional[Dict[str, Any]] = None) -> str:
+                         custom_params: Optional[Dict[str, Any]] = None,
+                         usage: Optional[Dict[str, int]] = None,
+                         use_cache: bool = False,
+                         context: Optional[Dict[str, int]] = None,
+                         summary: Optional[str] = None) -> str:
         """
         Tạo phản hồi từ mô hình cho tin nhắn của người dùng
         
@@ -84,6 +139,12 @@ class CodeSupporterService:
             user_message (str): Tin nhắn từ người dùng
             conversation_history (list, optional): Lịch sử hội thoại
             custom_params (dict, optional): Các tham số tùy chỉnh cho API call
+            usage (dict, optional): Nếu có, được điền prompt_tokens/completion_tokens của API call
+                (khi phản hồi lấy từ bộ đệm chỉ được điền cached=True)
+            use_cache (bool): Dùng bộ đệm phản hồi (chỉ lưu phản hồi thành công)
+            context (dict, optional): Nếu có, được điền báo cáo ngữ cảnh (prompt_tokens ước lượng,
+                history_messages, dropped_messages, dropped_tokens khi lịch sử bị cắt theo ngân sách token)
+            summary (str, optional): Tóm tắt phần trước của hội thoại (gửi kèm thay cho các tin nhắn cũ)
             
         Returns:
             str: Phản hồi từ mô hình
@@ -91,28 +152,18 @@ class CodeSupporterService:
         try:
             start_time = time.time()
             
-            # Tạo ngữ cảnh từ lịch sử hội thoại nếu có
-            messages = [
-                {"role": "system", "content": self.system_prompt}
-            ]
-            
-            # Thêm lịch sử hội thoại nếu có
-            if conversation_history and len(conversation_history) > 0:
-                for entry in conversation_history:
-                    messages.append({
-                        "role": entry["role"],
-                        "content": entry["content"]
-                    })
-            
-            # Thêm tin nhắn hiện tại của người dùng
-            messages.append({"role": "user", "content": user_message})
-            
             logger.info(f"Gửi yêu cầu đến mô hình {self.model_name} với tin nhắn: {user_message[:50]}...")
             
-            # Kết hợp tham số mặc định và tùy chỉnh
-            params = self.default_params.copy()
-            if custom_params:
-                params.update(custom_params)
+            params = self._build_params(custom_params)
+            messages, conversation_history = self._build_messages(
+                user_message, conversation_history, params, context, summary
+            )
+            
+            cache_ref = self._response_cache_ref(user_message, conversation_history, params) if use_cache else None
+            cached = self._get_cached_response(cache_ref, usage)
+            if cached is not None:
+                logger.info(f"Trả phản hồi từ bộ đệm cho tin nhắn: {user_message[:50]}...")
+                return cached
             
             # Gọi API với Together phiên bản mới
             response = self.client.chat.completions.create(
@@ -125,22 +176,18 @@ class CodeSupporterService:
             # Trích xuất phản hồi theo cách mới
             bot_response = response.choices[0].message.content
             
+            if usage is not None:
+                self._record_usage(response, usage)
+            
+            self._store_cached_response(cache_ref, bot_response)
+            
             logger.info(f"Nhận phản hồi từ mô hình sau {elapsed_time:.2f}s: {bot_response[:50]}...")
             
             return bot_response
             
         except Exception as e:
             logger.error(f"Lỗi khi tạo phản hồi: {str(e)}")
-            # Tạo phản hồi lỗi thân thiện hơn
-            error_message = "Xin lỗi, tôi đang gặp khó khăn trong việc xử lý yêu cầu của bạn. "
-            if "rate limit" in str(e).lower():
-                error_message += "Hệ thống đang nhận quá nhiều yêu cầu. Vui lòng thử lại sau vài giây."
-            elif "timeout" in str(e).lower():
-                error_message += "Kết nối đến máy chủ bị chậm. Vui lòng thử lại."
-            else:
-                error_message += f"Lỗi cụ thể: {str(e)}. Vui lòng thử lại hoặc đặt câu hỏi theo cách khác."
-            
-            return error_message
+            return self._error_message(e)
             
     @backoff.on_exception(backoff.expo, 
                          (Exception),
@@ -148,7 +195,11 @@ class CodeSupporterService:
                          on_backoff=on_api_error)
     def generate_response_stream(self, user_message: str, 
                                conversation_history: Optional[List[Dict[str, str]]] = None,
-                               custom_params: Optional[Dict[str, Any]] = None) -> Generator[str, None, None]:
+                               custom_params: Optional[Dict[str, Any]] = None,
+                               usage: Optional[Dict[str, int]] = None,
+                               use_cache: bool = False,
+                               context: Optional[Dict[str, int]] = None,
+                               summary: Optional[str] = None) -> Generator[str, None, None]:
         """
         Tạo phản hồi từ mô hình theo kiểu stream
         
@@ -156,6 +207,13 @@ class CodeSupporterService:
             user_message (str): Tin nhắn từ người dùng
             conversation_history (list, optional): Lịch sử hội thoại
             custom_params (dict, optional): Các tham số tùy chỉnh cho API call
+            usage (dict, optional): Nếu có, được điền prompt_tokens/completion_tokens (từ chunk cuối),
+                hoặc cached=True khi phản hồi lấy từ bộ đệm
+            use_cache (bool): Dùng bộ đệm phản hồi (phản hồi có sẵn được trả trong một chunk,
+                phản hồi mới chỉ được lưu khi stream kết thúc trọn vẹn)
+            context (dict, optional): Nếu có, được điền báo cáo ngữ cảnh (prompt_tokens ước lượng,
+                history_messages, dropped_messages, dropped_tokens khi lịch sử bị cắt theo ngân sách token)
+            summary (str, optional): Tóm tắt phần trước của hội thoại (gửi kèm thay cho các tin nhắn cũ)
             
         Returns:
             generator: Generator trả về từng phần của phản hồi
@@ -163,30 +221,21 @@ class CodeSupporterService:
         try:
             start_time = time.time()
             
-            # Tạo messages từ lịch sử hội thoại và tin nhắn hiện tại
-            messages = [
-                {"role": "system", "content": self.system_prompt}
-            ]
-            
-            # Thêm lịch sử hội thoại nếu có
-            if conversation_history and len(conversation_history) > 0:
-                for entry in conversation_history:
-                    messages.append({
-                        "role": entry["role"],
-                        "content": entry["content"]
-                    })
-            
-            # Thêm tin nhắn hiện tại của người dùng
-            messages.append({"role": "user", "content": user_message})
-            
             logger.info(f"Gửi yêu cầu stream đến mô hình {self.model_name} với tin nhắn: {user_message[:50]}...")
             
-            # Kết hợp tham số mặc định và tùy chỉnh
-            params = self.default_params.copy()
-            if custom_params:
-                params.update(custom_params)
+            params = self._build_params(custom_params)
             # Đảm bảo stream=True cho phản hồi theo stream
             params["stream"] = True
+            messages, conversation_history = self._build_messages(
+                user_message, conversation_history, params, context, summary
+            )
+            
+            cache_ref = self._response_cache_ref(user_message, conversation_history, params) if use_cache else None
+            cached = self._get_cached_response(cache_ref, usage)
+            if cached is not None:
+                logger.info(f"Trả phản hồi stream từ bộ đệm cho tin nhắn: {user_message[:50]}...")
+                yield cached
+                return
             
             # Gọi API với stream sử dụng Together phiên bản mới
             response_stream = self.client.chat.completions.create(
@@ -196,13 +245,195 @@ class CodeSupporterService:
             )
             
             chunk_count = 0
+            parts = []
             for chunk in response_stream:
                 chunk_count += 1
-                if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'content'):
-                    content = chunk.choices[0].delta.content
+                if usage is not None:
+                    self._record_usage(chunk, usage)
+                content = self._chunk_content(chunk)
+                if content:
+                    parts.append(content)
+                    yield content
+            
+            self._store_cached_response(cache_ref, "".join(parts))
+            
+            elapsed_time = time.time() - start_time
+            logger.info(f"Stream hoàn thành sau {elapsed_time:.2f}s với {chunk_count} chunks")
+            
+        except Exception as e:
+            logger.error(f"Lỗi khi tạo phản hồi stream: {str(e)}")
+            yield f"Xin lỗi, đã xảy ra lỗi khi xử lý yêu cầu của bạn: {str(e)}. Vui lòng thử lại."
+    
+    async def _get_async_client(self):
+        """
+        Lấy client async (pool kết nối HTTP dùng chung cho mọi lời gọi) và semaphore giới hạn
+        số lời gọi đồng thời của event loop hiện tại, tạo khi gọi lần đầu trong loop
+        """
+        loop = asyncio.get_running_loop()
+        
+        with self._async_clients_lock:
+            entry = self._async_clients.get(loop)
+            if entry is None:
+                entry = (
+                    AsyncTogether(
+                        api_key=self.api_key,
+                        http_client=DefaultAsyncHttpxClient(
+                            limits=httpx.Limits(
+                                max_connections=TOGETHER_MAX_CONNECTIONS,
+                                max_keepalive_connections=TOGETHER_MAX_CONNECTIONS
+                            )
+                        )
+                    ),
+                    asyncio.Semaphore(TOGETHER_MAX_CONCURRENCY)
+                )
+                self._async_clients[loop] = entry
+                
+                stale_clients = self._pop_async_clients(lambda l: l.is_closed())
+            else:
+                stale_clients = []
+        
+        await self._close_async_clients(stale_clients)
+        return entry
+    
+    async def aclose(self) -> None:
+        """Đóng client async của event loop hiện tại và của các event loop đã đóng (khi tắt ứng dụng async)"""
+        loop = asyncio.get_running_loop()
+        with self._async_clients_lock:
+            clients = self._pop_async_clients(lambda l: l is loop or l.is_closed())
+        
+        await self._close_async_clients(clients)
+    
+    def _pop_async_clients(self, predicate) -> List[Any]:
+        """Bỏ (gọi khi giữ _async_clients_lock) và trả về client của các event loop thỏa predicate"""
+        loops = [loop for loop in self._async_clients if predicate(loop)]
+        return [self._async_clients.pop(loop)[0] for loop in loops]
+    
+    async def _close_async_clients(self, clients: List[Any]) -> None:
+        """Đóng các client async (và pool kết nối HTTP của chúng)"""
+        for client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                # Kết nối gắn với event loop đã đóng không còn dùng được nữa
+                logger.warning(f"Lỗi khi đóng client async: {str(e)}")
+    
+    @backoff.on_exception(backoff.expo,
+                         (Exception),
+                         max_tries=3,
+                         on_backoff=on_api_error)
+    async def _acreate_completion(self, client, messages: List[Dict[str, str]], params: Dict[str, Any]):
+        """
+        Gọi API tạo phản hồi (bất đồng bộ), thử lại khi lỗi
+        
+        Với stream, chỉ việc mở stream được thử lại; lỗi giữa chừng không được thử lại vì các
+        chunk trước đó đã được gửi cho client.
+        """
+        return await client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            **params
+        )
+    
+    async def agenerate_response(self, user_message: str, conversation_history: Optional[List[Dict[str, str]]] = None, 
+                                 custom_params: Optional[Dict[str, Any]] = None,
+                                 usage: Optional[Dict[str, int]] = None,
+                                 use_cache: bool = False,
+                                 context: Optional[Dict[str, int]] = None,
+                                 summary: Optional[str] = None) -> str:
+        """
+        Tạo phản hồi từ mô hình (bất đồng bộ, xem generate_response)
+        
+        Số lời gọi đồng thời bị giới hạn bởi TOGETHER_MAX_CONCURRENCY; các lời gọi vượt quá chờ trong event loop.
+        
+        Returns:
+            str: Phản hồi từ mô hình
+        """
+        try:
+            params = self._build_params(custom_params)
+            messages, conversation_history = self._build_messages(
+                user_message, conversation_history, params, context, summary
+            )
+            
+            cache_ref = self._response_cache_ref(user_message, conversation_history, params) if use_cache else None
+            cached = self._get_cached_response(cache_ref, usage)
+            if cached is not None:
+                logger.info(f"Trả phản hồi từ bộ đệm cho tin nhắn: {user_message[:50]}...")
+                return cached
+            
+            client, semaphore = await self._get_async_client()
+            
+            async with semaphore:
+                start_time = time.time()
+                logger.info(f"Gửi yêu cầu async đến mô hình {self.model_name} với tin nhắn: {user_message[:50]}...")
+                
+                response = await self._acreate_completion(client, messages, params)
+            
+            elapsed_time = time.time() - start_time
+            bot_response = response.choices[0].message.content
+            
+            if usage is not None:
+                self._record_usage(response, usage)
+            
+            self._store_cached_response(cache_ref, bot_response)
+            
+            logger.info(f"Nhận phản hồi từ mô hình sau {elapsed_time:.2f}s: {bot_response[:50]}...")
+            
+            return bot_response
+            
+        except Exception as e:
+            logger.error(f"Lỗi khi tạo phản hồi: {str(e)}")
+            return self._error_message(e)
+    
+    async def agenerate_response_stream(self, user_message: str, 
+                                        conversation_history: Optional[List[Dict[str, str]]] = None,
+                                        custom_params: Optional[Dict[str, Any]] = None,
+                                        usage: Optional[Dict[str, int]] = None,
+                                        use_cache: bool = False,
+                                        context: Optional[Dict[str, int]] = None,
+                                        summary: Optional[str] = None) -> AsyncGenerator[str, None]:
+        """
+        Tạo phản hồi từ mô hình theo kiểu stream (bất đồng bộ, xem generate_response_stream)
+        
+        Một suất của semaphore TOGETHER_MAX_CONCURRENCY được giữ trong suốt thời gian stream.
+        
+        Returns:
+            async generator: Trả về từng phần của phản hồi
+        """
+        try:
+            params = self._build_params(custom_params)
+            params["stream"] = True
+            messages, conversation_history = self._build_messages(
+                user_message, conversation_history, params, context, summary
+            )
+            
+            cache_ref = self._response_cache_ref(user_message, conversation_history, params) if use_cache else None
+            cached = self._get_cached_response(cache_ref, usage)
+            if cached is not None:
+                logger.info(f"Trả phản hồi stream từ bộ đệm cho tin nhắn: {user_message[:50]}...")
+                yield cached
+                return
+            
+            client, semaphore = await self._get_async_client()
+            
+            async with semaphore:
+                start_time = time.time()
+                logger.info(f"Gửi yêu cầu stream async đến mô hình {self.model_name} với tin nhắn: {user_message[:50]}...")
+                
+                response_stream = await self._acreate_completion(client, messages, params)
+                
+                chunk_count = 0
+                parts = []
+                async for chunk in response_stream:
+                    chunk_count += 1
+                    if usage is not None:
+                        self._record_usage(chunk, usage)
+                    content = self._chunk_content(chunk)
                     if content:
+                        parts.append(content)
                         yield content
             
+            self._store_cached_response(cache_ref, "".join(parts))
+            
             elapsed_time = time.time() - start_time
             logger.info(f"Stream hoàn thành sau {elapsed_time:.2f}s với {chunk_count} chunks")
             
@@ -210,6 +441,341 @@ class CodeSupporterService:
             logger.error(f"Lỗi khi tạo phản hồi stream: {str(e)}")
             yield f"Xin lỗi, đã xảy ra lỗi khi xử lý yêu cầu của bạn: {str(e)}. Vui lòng thử lại."
     
+    def load_conversation_context(self, storage: Any, conversation_id: str, limit: int = 20,
+                                  context: Optional[Dict[str, Any]] = None
+                                  ) -> Tuple[Optional[str], List[Dict[str, str]], int]:
+        """
+        Lấy ngữ cảnh của hội thoại đã lưu: bản tóm tắt (nếu bật CONVERSATION_SUMMARY) và các tin nhắn
+        gần nhất chưa được tóm tắt
+        
+        Khi bật CONVERSATION_SUMMARY, mọi tin nhắn chưa được tóm tắt đều được lấy (không chỉ `limit` tin
+        nhắn cuối), tối đa số tin nhắn có thể vừa ngân sách token; ContextBuilder cắt tiếp theo token.
+        
+        Args:
+            storage (StorageService): Dịch vụ lưu trữ
+            conversation_id (str): ID hội thoại
+            limit (int): Số tin nhắn gần nhất tối đa (số tối thiểu được lấy khi bật tóm tắt)
+            context (Optional[Dict]): Nếu có, ghi số tin nhắn chưa được tóm tắt nhưng không được lấy vào
+                context["unsummarized_omitted"]
+        
+        Returns:
+            Tuple: (nội dung tóm tắt hoặc None, lịch sử hội thoại (role/content), số tin nhắn chưa được tóm tắt)
+        """
+        summary = storage.get_conversation_summary(conversation_id) if CONVERSATION_SUMMARY else None
+        
+        fetch_limit = limit
+        if summary:
+            fetch_limit = max(limit, summary["pending_messages"])
+            max_messages = self.context_builder.max_history_messages()
+            if max_messages is not None:
+                fetch_limit = max(limit, min(fetch_limit, max_messages))
+        
+        messages = storage.get_recent_messages(conversation_id, limit=fetch_limit)
+        
+        if not summary:
+            return None, [{"role": msg["role"], "content": msg["content"]} for msg in messages], len(messages)
+        
+        if summary["text"]:
+            # Bỏ các tin nhắn đã nằm trong bản tóm tắt (đến tin nhắn cuối đã được tóm tắt)
+            for index, msg in enumerate(messages):
+                if msg.get("id") == summary["last_message_id"]:
+                    messages = messages[index + 1:]
+                    break
+        
+        omitted = max(0, summary["pending_messages"] - len(messages))
+        if omitted:
+            logger.warning(
+                f"Hội thoại {conversation_id}: {omitted} tin nhắn chưa được tóm tắt không được đưa vào ngữ cảnh "
+                f"(vượt số tin nhắn tối đa có thể vừa ngân sách token)"
+            )
+        if context is not None:
+            context["unsummarized_omitted"] = omitted
+        
+        history = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+        return summary["text"], history, summary["pending_messages"]
+    
+    def schedule_summary_refresh(self, storage: Any, conversation_id: str, pending_messages: int) -> bool:
+        """
+        Làm mới bản tóm tắt của hội thoại trong nền khi đã có đủ SUMMARY_REFRESH_TURNS lượt chat mới
+        ngoài SUMMARY_KEEP_RECENT_MESSAGES tin nhắn gần nhất (luôn gửi nguyên văn)
+        
+        Args:
+            storage (StorageService): Dịch vụ lưu trữ (đồng bộ)
+            conversation_id (str): ID hội thoại
+            pending_messages (int): Số tin nhắn chưa được tóm tắt, kể cả lượt chat vừa lưu
+            
+        Returns:
+            bool: True nếu đã lên lịch làm mới
+        """
+        if not CONVERSATION_SUMMARY or pending_messages < SUMMARY_KEEP_RECENT_MESSAGES + 2 * SUMMARY_REFRESH_TURNS:
+            return False
+        
+        with self._summary_lock:
+            # Mỗi hội thoại chỉ có một lần làm mới đang chạy trong tiến trình
+            if conversation_id in self._summary_refreshing:
+                return False
+            self._summary_refreshing.add(conversation_id)
+            
+            if self._summary_executor is None:
+                self._summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_THREADS, thread_name_prefix="summary")
+        
+        def run():
+            try:
+                self.refresh_conversation_summary(storage, conversation_id)
+            except Exception as e:
+                logger.error(f"Lỗi khi làm mới tóm tắt hội thoại {conversation_id}: {str(e)}")
+            finally:
+                with self._summary_lock:
+                    self._summary_refreshing.discard(conversation_id)
+        
+        self._summary_executor.submit(run)
+        return True
+    
+    def refresh_conversation_summary(self, storage: Any, conversation_id: str) -> bool:
+        """
+        Gộp các tin nhắn cũ chưa được tóm tắt (trừ SUMMARY_KEEP_RECENT_MESSAGES tin nhắn gần nhất)
+        vào bản tóm tắt của hội thoại và lưu lại
+        
+        Mỗi lần xử lý tối đa SUMMARY_BATCH_MESSAGES tin nhắn. Hội thoại chưa có tóm tắt bắt đầu từ
+        các tin nhắn ngay trước phần gần nhất (tin nhắn cũ hơn nữa, ví dụ của hội thoại có từ trước khi
+        bật CONVERSATION_SUMMARY, không được tóm tắt).
+        
+        Returns:
+            bool: True nếu bản tóm tắt đã được cập nhật
+        """
+        summary = storage.get_conversation_summary(conversation_id)
+        keep = SUMMARY_KEEP_RECENT_MESSAGES
+        
+        # Kiểm tra lại: worker khác có thể vừa làm mới xong
+        if not summary or summary["pending_messages"] < keep + 2 * SUMMARY_REFRESH_TURNS:
+            return False
+        
+        messages = []
+        if summary["last_message_id"]:
+            messages = storage.get_recent_messages(
+                conversation_id, limit=SUMMARY_BATCH_MESSAGES + keep, after=summary["last_message_id"]
+            )
+            covered = summary["message_count"]
+        
+        if not messages:
+            # Chưa có tóm tắt (hoặc không còn tin nhắn mốc): bắt đầu ngay trước phần gần nhất
+            messages = storage.get_recent_messages(conversation_id, limit=SUMMARY_BATCH_MESSAGES + keep)
+            covered = summary["message_count"] + max(summary["pending_messages"] - len(messages), 0)
+        
+        # Giới hạn số token gửi đi trong một lần tóm tắt
+        batch = []
+        tokens = 0
+        for msg in messages[:len(messages) - keep]:
+            message_tokens = count_tokens(msg["content"][:SUMMARY_MESSAGE_MAX_CHARS])
+            if batch and tokens + message_tokens > SUMMARY_INPUT_TOKENS:
+                break
+            batch.append(msg)
+            tokens += message_tokens
+        
+        if not batch:
+            return False
+        
+        text = self.summarize_messages(summary["text"], batch)
+        if not text:
+            return False
+        
+        updated = storage.update_conversation_summary(
+            conversation_id, text, batch[-1]["id"], covered + len(batch)
+        )
+        
+        if updated:
+            logger.info(f"Đã cập nhật tóm tắt hội thoại {conversation_id} ({covered + len(batch)} tin nhắn)")
+        
+        return updated
+    
+    def summarize_messages(self, previous_summary: Optional[str], messages: List[Dict[str, str]]) -> Optional[str]:
+        """
+        Tạo bản tóm tắt mới từ bản tóm tắt trước và các tin nhắn tiếp theo
+        
+        Args:
+            previous_summary (str, optional): Bản tóm tắt hiện có
+            messages (list): Các tin nhắn cần gộp vào bản tóm tắt (role/content)
+            
+        Returns:
+            Optional[str]: Bản tóm tắt mới hoặc None nếu lỗi
+        """
+        try:
+            transcript = "\n\n".join(
+                f"{'Học sinh' if msg['role'] == 'user' else 'Trợ lý'}: {msg['content'][:SUMMARY_MESSAGE_MAX_CHARS]}"
+                for msg in messages
+            )
+            
+            prompt = ""
+            if previous_summary:
+                prompt += f"Bản tóm tắt hiện có:\n{previous_summary}\n\n"
+            prompt += f"Các tin nhắn tiếp theo:\n{transcript}"
+            
+            response = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": self.summary_prompt},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=SUMMARY_MAX_TOKENS,
+                temperature=0.3,
+                stop=self.default_params["stop"]
+            )
+            
+            text = (response.choices[0].message.content or "").strip()
+            return text or None
+        except Exception as e:
+            logger.error(f"Lỗi khi tóm tắt hội thoại: {str(e)}")
+            return None
+    
+    def _response_cache_ref(self, user_message: str, conversation_history: Optional[List[Dict[str, str]]],
+                            params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Khóa bộ đệm phản hồi của lời gọi, kèm khóa ngữ cảnh và chữ ký MinHash khi bật tra cứu gần trùng
+        (None nếu bộ đệm bị tắt)
+        """
+        if self.response_cache is None:
+            return None
+        
+        cache_ref = {
+            "key": ResponseCache.make_key(self.model_name, self.system_prompt, conversation_history, user_message, params),
+            "context": None,
+            "signature": None
+        }
+        
+        if self.near_duplicate_index is not None:
+            cache_ref["context"] = ResponseCache.make_context_key(
+                self.model_name, self.system_prompt, conversation_history, params
+            )
+            cache_ref["signature"] = minhash_signature(user_message)
+        
+        return cache_ref
+    
+    def _get_cached_response(self, cache_ref: Optional[Dict[str, Any]],
+                             usage: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Lấy phản hồi từ bộ đệm, đánh dấu usage["cached"] = True khi có (để không tính vào độ trễ của mô hình)"""
+        cached = self._find_cached_response(cache_ref)
+        if cached is not None and usage is not None:
+            usage["cached"] = True
+        return cached
+    
+    def _find_cached_response(self, cache_ref: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Lấy phản hồi trùng khớp chính xác, nếu không có thì phản hồi của câu hỏi gần trùng cùng ngữ cảnh"""
+        if cache_ref is None:
+            return None
+        
+        cached = self.response_cache.get(cache_ref["key"])
+        
+        if cache_ref["signature"] is None:
+            return cached
+        
+        if cached is not None:
+            # Đưa vào chỉ mục phản hồi đã có sẵn trên đĩa (chỉ mục không được lưu qua khởi động lại)
+            self.near_duplicate_index.add(cache_ref["context"], cache_ref["signature"], cache_ref["key"])
+            return cached
+        
+        match = self.near_duplicate_index.find(cache_ref["context"], cache_ref["signature"])
+        if match is None:
+            return None
+        
+        response_key, similarity = match
+        cached = self.response_cache.get(response_key)
+        if cached is None:
+            # Phản hồi đã hết hạn hoặc bị loại khỏi bộ đệm
+            self.near_duplicate_index.remove(response_key)
+            return None
+        
+        logger.info(f"Dùng phản hồi của câu hỏi gần trùng (độ tương đồng {similarity:.2f})")
+        return cached
+    
+    def _store_cached_response(self, cache_ref: Optional[Dict[str, Any]], response: str) -> None:
+        """Lưu phản hồi vào bộ đệm và chỉ mục câu hỏi gần trùng"""
+        if cache_ref is None or not self.response_cache.set(cache_ref["key"], response):
+            return
+        
+        if cache_ref["signature"] is not None:
+            self.near_duplicate_index.add(cache_ref["context"], cache_ref["signature"], cache_ref["key"])
+    
+    def get_response_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        Lấy bộ đếm của bộ đệm phản hồi
+        
+        Returns:
+            Optional[Dict]: hits, disk_hits, misses, hit_rate, stores, evictions, entries, bytes,
+            near_duplicate (chỉ mục câu hỏi gần trùng) hoặc None nếu bộ đệm bị tắt
+        """
+        if self.response_cache is None:
+            return None
+        
+        stats = self.response_cache.stats()
+        stats["near_duplicate"] = self.near_duplicate_index.stats() if self.near_duplicate_index else None
+        return stats
+    
+    def get_context_stats(self) -> Dict[str, Any]:
+        """
+        Thống kê cắt lịch sử theo ngân sách token
+        
+        Returns:
+            Dict: budget, requests, trimmed, dropped_messages, dropped_tokens, tokenizer
+        """
+        return self.context_builder.stats()
+    
+    def _build_messages(self, user_message: str, conversation_history: Optional[List[Dict[str, str]]],
+                        params: Dict[str, Any], context: Optional[Dict[str, int]] = None,
+                        summary: Optional[str] = None) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+        """
+        Tạo danh sách messages gửi cho mô hình: system prompt, tóm tắt hội thoại, lịch sử hội thoại
+        và tin nhắn hiện tại, lịch sử được cắt theo ngân sách token (chừa max_tokens của params cho phản hồi)
+        
+        Returns:
+            Tuple: (messages, phần giữa system prompt và tin nhắn hiện tại: tóm tắt và lịch sử được giữ)
+        """
+        messages, _, report = self.context_builder.build(
+            self.system_prompt, conversation_history, user_message, params.get("max_tokens") or 0, summary
+        )
+        
+        if context is not None:
+            context.update(report)
+        
+        return messages, messages[1:-1]
+    
+    def _build_params(self, custom_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Kết hợp tham số mặc định và tùy chỉnh"""
+        params = self.default_params.copy()
+        if custom_params:
+            params.update(custom_params)
+        return params
+    
+    def _chunk_content(self, chunk: Any) -> Optional[str]:
+        """Nội dung văn bản của một chunk stream (None nếu không có)"""
+        if not chunk.choices:
+            return None
+        if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'content'):
+            return chunk.choices[0].delta.content
+        return None
+    
+    def _error_message(self, error: Exception) -> str:
+        """Tạo phản hồi lỗi thân thiện cho người dùng"""
+        error_message = "Xin lỗi, tôi đang gặp khó khăn trong việc xử lý yêu cầu của bạn. "
+        if "rate limit" in str(error).lower():
+            error_message += "Hệ thống đang nhận quá nhiều yêu cầu. Vui lòng thử lại sau vài giây."
+        elif "timeout" in str(error).lower():
+            error_message += "Kết nối đến máy chủ bị chậm. Vui lòng thử lại."
+        else:
+            error_message += f"Lỗi cụ thể: {str(error)}. Vui lòng thử lại hoặc đặt câu hỏi theo cách khác."
+        
+        return error_message
+    
+    def _record_usage(self, response: Any, usage: Dict[str, int]) -> None:
+        """Chép số token (nếu API trả về) từ response/chunk vào usage"""
+        response_usage = getattr(response, "usage", None)
+        if response_usage is None:
+            return
+        
+        for field in ("prompt_tokens", "completion_tokens"):
+            value = getattr(response_usage, field, None)
+            if value is not None:
+                usage[field] = value
+    
     def set_system_prompt(self, new_prompt: str) -> None:
         """
         Thay đổi system prompt
@@ -0,0 +1,218 @@
+"""
+Module xây dựng ngữ cảnh gửi cho mô hình của Code Supporter
+Đếm token cục bộ và cắt bớt lịch sử hội thoại để prompt nằm trong ngân sách token
+(giữ system prompt, tin nhắn hiện tại và các lượt gần nhất, chừa chỗ cho max_tokens)
+"""
+import os
+import re
+import math
+import logging
+import threading
+from typing import Dict, List, Tuple, Optional, Any
+
+try:
+    import tiktoken  # Tokenizer BPE cục bộ (tùy chọn)
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Ngân sách token của một lời gọi (prompt + max_tokens của phản hồi), 0 để không cắt lịch sử
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8192"))
+# Bảng mã tiktoken dùng để đếm token (gần với tokenizer của Llama 3). File bảng mã được tải về
+# khi khởi động nếu chưa có trong TIKTOKEN_CACHE_DIR (máy không có mạng: đặt sẵn file vào thư mục này)
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+# Số token định dạng chat của mỗi tin nhắn (header role, ký tự kết thúc lượt)
+MESSAGE_TOKEN_OVERHEAD = 4
+# Mở đầu của tin nhắn hệ thống chứa tóm tắt hội thoại
+SUMMARY_PREFIX = "Tóm tắt phần trước của hội thoại (các tin nhắn cũ không còn được gửi kèm):"
+
+# Ước lượng khi không có tiktoken: mỗi từ/dấu câu ít nhất một token, khoảng 4 byte UTF-8 mỗi token
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """Bảng mã tiktoken (tải một lần), None nếu chưa cài tiktoken hoặc không tải được"""
+    global _encoding, _encoding_loaded
+
+    if _encoding_loaded:
+        return _encoding
+
+    with _encoding_lock:
+        if not _encoding_loaded:
+            if tiktoken is None:
+                logger.warning("Chưa cài tiktoken, số token của ngữ cảnh được ước lượng theo độ dài văn bản")
+            else:
+                try:
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                    logger.info(
+                        f"Đếm token bằng tiktoken, bảng mã {TOKENIZER_ENCODING} "
+                        f"(TIKTOKEN_CACHE_DIR={os.getenv('TIKTOKEN_CACHE_DIR', 'mặc định')})"
+                    )
+                except Exception as e:
+                    logger.warning(
+                        f"Không tải được bảng mã tiktoken {TOKENIZER_ENCODING}, số token được ước lượng "
+                        f"theo độ dài văn bản (đặt sẵn file bảng mã vào TIKTOKEN_CACHE_DIR): {str(e)}"
+                    )
+            _encoding_loaded = True
+
+    return _encoding
+
+
+def tokenizer_name() -> str:
+    """Tên bộ đếm token đang dùng: bảng mã tiktoken, "estimate" hoặc "not_loaded" (chưa tải bảng mã)"""
+    if not _encoding_loaded:
+        return "not_loaded"
+    return TOKENIZER_ENCODING if _encoding is not None else "estimate"
+
+
+def count_tokens(text: str) -> int:
+    """Số token của văn bản (đếm bằng tiktoken, hoặc ước lượng dư nếu không có tiktoken)"""
+    text = str(text or "")
+    if not text:
+        return 0
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    return max(len(_WORD_RE.findall(text)), math.ceil(len(text.encode("utf-8")) / 4))
+
+
+class ContextBuilder:
+    """
+    Tạo danh sách messages trong ngân sách token
+
+    System prompt và tin nhắn hiện tại luôn được giữ; lịch sử được giữ từ lượt mới nhất trở về trước
+    đến khi hết ngân sách (sau khi chừa max_tokens cho phản hồi), phần cũ hơn bị bỏ.
+    """
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET):
+        self.budget = budget
+
+        # Tải bảng mã khi khởi động, không để lời gọi chat đầu tiên phải chờ tải file
+        _get_encoding()
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.trimmed = 0
+        self.dropped_messages = 0
+        self.dropped_tokens = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Bộ đếm số lời gọi bị cắt lịch sử và tổng số tin nhắn/token đã bỏ"""
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "requests": self.requests,
+                "trimmed": self.trimmed,
+                "dropped_messages": self.dropped_messages,
+                "dropped_tokens": self.dropped_tokens,
+                "tokenizer": tokenizer_name()
+            }
+
+    def max_history_messages(self) -> Optional[int]:
+        """
+        Số tin nhắn lịch sử tối đa có thể vừa ngân sách (mỗi tin nhắn tốn ít nhất
+        MESSAGE_TOKEN_OVERHEAD + 1 token); None nếu không giới hạn ngân sách
+        """
+        if self.budget <= 0:
+            return None
+        return self.budget // (MESSAGE_TOKEN_OVERHEAD + 1)
+
+    def build(self, system_prompt: str, history: Optional[List[Dict[str, str]]], user_message: str,
+              max_tokens: int = 0, summary: Optional[str] = None
+              ) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], Dict[str, int]]:
+        """
+        Tạo messages gửi cho mô hình
+
+        Args:
+            system_prompt (str): System prompt
+            history (list, optional): Lịch sử hội thoại (role/content) theo thứ tự thời gian
+            user_message (str): Tin nhắn hiện tại
+            max_tokens (int): Số token chừa lại cho phản hồi
+            summary (str, optional): Tóm tắt phần trước của hội thoại (luôn được giữ, ngay sau system prompt)
+
+        Returns:
+            Tuple: (messages, lịch sử được giữ, báo cáo gồm budget, prompt_tokens, history_messages,
+            dropped_messages, dropped_tokens)
+        """
+        history = [
+            {"role": entry["role"], "content": entry["content"]}
+            for entry in history or []
+        ]
+
+        report = {
+            "budget": self.budget,
+            "prompt_tokens": 0,
+            "history_messages": len(history),
+            "dropped_messages": 0,
+            "dropped_tokens": 0
+        }
+
+        fixed_tokens = (
+            count_tokens(system_prompt) + count_tokens(user_message) + 2 * MESSAGE_TOKEN_OVERHEAD
+        )
+
+        summary_message = None
+        if summary:
+            summary_message = {"role": "system", "content": f"{SUMMARY_PREFIX}\n{summary}"}
+            fixed_tokens += count_tokens(summary_message["content"]) + MESSAGE_TOKEN_OVERHEAD
+
+        if self.budget > 0:
+            history_tokens = [count_tokens(entry["content"]) + MESSAGE_TOKEN_OVERHEAD for entry in history]
+            available = self.budget - (max_tokens or 0) - fixed_tokens
+
+            # Giữ các lượt gần nhất vừa với phần ngân sách còn lại
+            start = len(history)
+            used = 0
+            while start > 0 and used + history_tokens[start - 1] <= available:
+                start -= 1
+                used += history_tokens[start]
+
+            # Không mở đầu lịch sử bằng phản hồi của trợ lý đã mất câu hỏi tương ứng
+            while 0 < start < len(history) and history[start]["role"] == "assistant":
+                used -= history_tokens[start]
+                start += 1
+
+            if start > 0:
+                report["dropped_messages"] = start
+                report["dropped_tokens"] = sum(history_tokens[:start])
+                history = history[start:]
+
+            if available < 0:
+                logger.warning(
+                    f"System prompt và tin nhắn ({fixed_tokens} token) cùng max_tokens "
+                    f"vượt ngân sách ngữ cảnh {self.budget} token"
+                )
+
+            report["prompt_tokens"] = fixed_tokens + used
+        else:
+            report["prompt_tokens"] = fixed_tokens + sum(
+                count_tokens(entry["content"]) + MESSAGE_TOKEN_OVERHEAD for entry in history
+            )
+
+        with self._lock:
+            self.requests += 1
+            if report["dropped_messages"]:
+                self.trimmed += 1
+                self.dropped_messages += report["dropped_messages"]
+                self.dropped_tokens += report["dropped_tokens"]
+
+        if report["dropped_messages"]:
+            logger.info(
+                f"Bỏ {report['dropped_messages']}/{report['history_messages']} tin nhắn cũ "
+                f"({report['dropped_tokens']} token) để vừa ngân sách ngữ cảnh {self.budget} token"
+            )
+
+        messages = [{"role": "system", "content": system_prompt}]
+        if summary_message:
+            messages.append(summary_message)
+        messages.extend(history)
+        messages.append({"role": "user", "content": user_message})
+
+        return messages, history, report
@@ -0,0 +1,200 @@
+"""
+Module tìm câu hỏi gần trùng cho bộ đệm phản hồi của Code Supporter
+Dấu vân tay MinHash trên n-gram ký tự của tin nhắn (tính cục bộ, không cần dịch vụ embedding)
+và chỉ mục LSH theo băng để tra cứu nhanh khi có hàng trăm nghìn mục
+"""
+import os
+import re
+import hashlib
+import logging
+import random
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from typing import Dict, List, Tuple, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+# Bật/tắt tra cứu gần trùng và ngưỡng độ tương đồng (Jaccard ước lượng) để dùng lại phản hồi
+NEAR_DUPLICATE_CACHE = os.getenv("NEAR_DUPLICATE_CACHE", "false").lower() == "true"
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.9"))
+# Số mục tối đa của chỉ mục (mỗi tiến trình, khoảng 1.5 KB mỗi mục) và độ dài tối thiểu của tin nhắn
+# (tin nhắn ngắn dễ trùng nhầm)
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv("NEAR_DUPLICATE_MAX_ENTRIES", "200000"))
+NEAR_DUPLICATE_MIN_CHARS = int(os.getenv("NEAR_DUPLICATE_MIN_CHARS", "40"))
+
+# MinHash: số hàm băm = số băng LSH x số hàng mỗi băng, độ dài n-gram ký tự
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+MINHASH_NUM_PERM = MINHASH_BANDS * MINHASH_ROWS
+SHINGLE_SIZE = 5
+# Số ứng viên tối đa được so khớp đầy đủ trong một lần tra cứu (ưu tiên ứng viên trùng nhiều băng)
+MAX_CANDIDATES = 1000
+
+_MASK64 = (1 << 64) - 1
+# Hệ số (a lẻ, b) của các hàm băm multiply-shift, cố định để các tiến trình cho cùng dấu vân tay
+_rng = random.Random(0x5EED)
+_HASH_PARAMS = [(_rng.getrandbits(64) | 1, _rng.getrandbits(64)) for _ in range(MINHASH_NUM_PERM)]
+
+
+# Tên do người dùng đặt trong code (hàm, lớp, biến được gán, biến vòng lặp) và danh sách tham số của hàm
+_DEFINED_NAME_RE = re.compile(
+    r"\b(?:def|class|function|let|const|var|for)\s+([A-Za-z_]\w*)|\b([A-Za-z_]\w*)\s*[+\-*/%]?=(?!=)"
+)
+_PARAMS_RE = re.compile(r"\b(?:def|function)\s+\w+\s*\(([^)]*)\)")
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_]\w*")
+
+
+def normalize_for_fingerprint(text: str) -> str:
+    """
+    Chuẩn hóa tin nhắn trước khi lấy dấu vân tay: thay các tên do người dùng đặt trong code bằng "_"
+    (đổi tên biến không làm đổi dấu vân tay), chữ thường, gộp mọi khoảng trắng
+    """
+    text = str(text or "")
+
+    names = {a or b for a, b in _DEFINED_NAME_RE.findall(text)}
+    for params in _PARAMS_RE.findall(text):
+        names.update(m.group(0) for m in map(_IDENTIFIER_RE.search, params.split(",")) if m)
+
+    if names:
+        text = _IDENTIFIER_RE.sub(lambda m: "_" if m.group(0) in names else m.group(0), text)
+
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def minhash_signature(text: str) -> Optional[array]:
+    """
+    Tính chữ ký MinHash của tin nhắn
+
+    Returns:
+        Optional[array]: MINHASH_NUM_PERM giá trị 32-bit, None nếu tin nhắn ngắn hơn NEAR_DUPLICATE_MIN_CHARS
+    """
+    text = normalize_for_fingerprint(text)
+    if len(text) < max(NEAR_DUPLICATE_MIN_CHARS, SHINGLE_SIZE):
+        return None
+
+    hashes = {
+        int.from_bytes(hashlib.blake2b(text[i:i + SHINGLE_SIZE].encode("utf-8"), digest_size=8).digest(), "little")
+        for i in range(len(text) - SHINGLE_SIZE + 1)
+    }
+
+    # Dịch phải đơn điệu nên lấy min trước rồi mới dịch (giữ 32 bit cao của hàm băm multiply-shift)
+    return array("I", (
+        min([(a * h + b) & _MASK64 for h in hashes]) >> 32
+        for a, b in _HASH_PARAMS
+    ))
+
+
+def signature_similarity(first: array, second: array) -> float:
+    """Độ tương đồng Jaccard ước lượng từ hai chữ ký MinHash"""
+    return sum(1 for x, y in zip(first, second) if x == y) / MINHASH_NUM_PERM
+
+
+class NearDuplicateIndex:
+    """
+    Chỉ mục LSH của các tin nhắn đã có phản hồi trong bộ đệm
+
+    Mỗi mục gồm ngữ cảnh (khóa băm của model, system prompt, lịch sử và tham số: chỉ tin nhắn có
+    cùng ngữ cảnh mới được so khớp), chữ ký MinHash của tin nhắn và khóa của phản hồi trong ResponseCache.
+    Chỉ mục nằm trong bộ nhớ của tiến trình, loại mục cũ nhất khi vượt NEAR_DUPLICATE_MAX_ENTRIES.
+    """
+
+    def __init__(self, threshold: float = NEAR_DUPLICATE_THRESHOLD, max_entries: int = NEAR_DUPLICATE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+
+        # response_key -> (context, signature)
+        self._entries: "OrderedDict[str, Tuple[str, array]]" = OrderedDict()
+        # hash(context, băng, giá trị băng) -> response_key, hoặc list khi nhiều mục trùng băng
+        # (phần lớn bucket chỉ có một mục: không tạo tuple/set để chỉ mục lớn vẫn gọn trong bộ nhớ)
+        self._buckets: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "buckets": len(self._buckets),
+                "hits": self.hits,
+                "misses": self.misses,
+                "threshold": self.threshold
+            }
+
+    def _band_keys(self, context: str, signature: array) -> List[int]:
+        return [
+            hash((context, band, signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS].tobytes()))
+            for band in range(MINHASH_BANDS)
+        ]
+
+    def find(self, context: str, signature: array) -> Optional[Tuple[str, float]]:
+        """
+        Tìm mục gần trùng nhất có cùng ngữ cảnh
+
+        Returns:
+            Optional[Tuple[str, float]]: (khóa phản hồi, độ tương đồng) nếu đạt ngưỡng, ngược lại None
+        """
+        with self._lock:
+            candidates = Counter()
+            for band_key in self._band_keys(context, signature):
+                bucket = self._buckets.get(band_key)
+                if isinstance(bucket, list):
+                    candidates.update(bucket)
+                elif bucket is not None:
+                    candidates[bucket] += 1
+
+            best_key, best_similarity = None, 0.0
+            for response_key, _ in candidates.most_common(MAX_CANDIDATES):
+                entry_context, entry_signature = self._entries[response_key]
+                if entry_context != context:
+                    # Trùng giá trị băm của băng giữa hai ngữ cảnh khác nhau
+                    continue
+                similarity = signature_similarity(signature, entry_signature)
+                if similarity > best_similarity:
+                    best_key, best_similarity = response_key, similarity
+
+            if best_key is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return best_key, best_similarity
+
+    def add(self, context: str, signature: array, response_key: str) -> None:
+        """Thêm (hoặc cập nhật) mục vào chỉ mục"""
+        with self._lock:
+            self._remove(response_key)
+
+            self._entries[response_key] = (context, signature)
+            for band_key in self._band_keys(context, signature):
+                bucket = self._buckets.get(band_key)
+                if bucket is None:
+                    self._buckets[band_key] = response_key
+                elif isinstance(bucket, list):
+                    bucket.append(response_key)
+                else:
+                    self._buckets[band_key] = [bucket, response_key]
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def remove(self, response_key: str) -> None:
+        """Xóa mục (ví dụ phản hồi đã hết hạn trong ResponseCache)"""
+        with self._lock:
+            self._remove(response_key)
+
+    def _remove(self, response_key: str) -> None:
+        entry = self._entries.pop(response_key, None)
+        if entry is None:
+            return
+
+        for band_key in self._band_keys(*entry):
+            bucket = self._buckets.get(band_key)
+            if bucket == response_key:
+                del self._buckets[band_key]
+            elif isinstance(bucket, list) and response_key in bucket:
+                bucket.remove(response_key)
+                if len(bucket) == 1:
+                    self._buckets[band_key] = bucket[0]
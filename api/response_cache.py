@@ -0,0 +1,288 @@
+"""
+Module bộ đệm phản hồi của mô hình cho Code Supporter
+Lưu phản hồi theo khóa băm của toàn bộ đầu vào (model, system prompt, lịch sử, tin nhắn, tham số),
+gồm tầng bộ nhớ (LRU + TTL, giới hạn theo byte) và tầng đĩa dùng chung giữa các worker
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bật/tắt bộ đệm, thời gian sống của một phản hồi (giây)
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+# Giới hạn dung lượng tầng bộ nhớ (mỗi tiến trình) và dung lượng tối đa của một phản hồi được lưu
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(64 * 1024)))
+# Tầng đĩa (giữ được qua khởi động lại): thư mục và giới hạn dung lượng, 0 để tắt
+RESPONSE_CACHE_DIR = os.getenv(
+    "RESPONSE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "response_cache")
+)
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+# Dọn tầng đĩa (xóa mục hết hạn, rồi mục cũ nhất khi vượt dung lượng) sau mỗi số lần ghi này
+RESPONSE_CACHE_DISK_PRUNE_EVERY = 200
+
+
+def normalize_text(text: str) -> str:
+    """Chuẩn hóa văn bản cho khóa bộ đệm: xuống dòng kiểu \\n, bỏ khoảng trắng cuối dòng và hai đầu (giữ thụt lề)"""
+    lines = str(text or "").replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+class ResponseCache:
+    """Bộ đệm phản hồi: LRU trong bộ nhớ có TTL và giới hạn byte, kèm tầng đĩa tùy chọn"""
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+                 max_entry_bytes: int = RESPONSE_CACHE_MAX_ENTRY_BYTES, disk_dir: Optional[str] = RESPONSE_CACHE_DIR,
+                 disk_max_bytes: int = RESPONSE_CACHE_DISK_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.disk_dir = disk_dir if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+
+        # key -> {"response", "expires_at" (epoch), "size"}; thứ tự = thứ tự dùng gần nhất
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self._pruning = False
+
+        self.reset_stats()
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+            self.stores = 0
+            self.evictions = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Bộ đếm hit/miss và dung lượng hiện tại"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk": self.disk_dir is not None
+            }
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, history: Optional[List[Dict[str, str]]],
+                 message: str, params: Dict[str, Any]) -> str:
+        """
+        Tạo khóa bộ đệm (SHA-256) từ toàn bộ đầu vào của lời gọi mô hình
+
+        Lịch sử chỉ giữ role/content đã chuẩn hóa; tham số stream không nằm trong khóa nên
+        phản hồi thường và phản hồi stream dùng chung bộ đệm.
+        """
+        return ResponseCache._hash_payload(model, system_prompt, history, params, message=normalize_text(message))
+
+    @staticmethod
+    def make_context_key(model: str, system_prompt: str, history: Optional[List[Dict[str, str]]],
+                         params: Dict[str, Any]) -> str:
+        """Khóa ngữ cảnh (như make_key nhưng không gồm tin nhắn), dùng để nhóm các câu hỏi gần trùng"""
+        return ResponseCache._hash_payload(model, system_prompt, history, params)
+
+    @staticmethod
+    def _hash_payload(model: str, system_prompt: str, history: Optional[List[Dict[str, str]]],
+                      params: Dict[str, Any], **extra: Any) -> str:
+        payload = {
+            "model": model,
+            "system_prompt": system_prompt,
+            "history": [
+                [str(entry.get("role", "")).lower(), normalize_text(entry.get("content", ""))]
+                for entry in history or []
+            ],
+            "params": {k: v for k, v in params.items() if k != "stream"},
+            **extra
+        }
+        encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Lấy phản hồi đã lưu (bộ nhớ trước, sau đó đĩa), None nếu không có hoặc đã hết hạn"""
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                if entry["expires_at"] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry["response"]
+                self._remove(key)
+
+        entry = self._read_disk(key, now)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, entry["response"], entry["expires_at"])
+
+        return entry["response"]
+
+    def set(self, key: str, response: str) -> bool:
+        """
+        Lưu phản hồi vào bộ nhớ và đĩa
+
+        Returns:
+            bool: False nếu phản hồi rỗng hoặc vượt RESPONSE_CACHE_MAX_ENTRY_BYTES (không lưu)
+        """
+        if not response or len(response.encode("utf-8")) > self.max_entry_bytes:
+            return False
+
+        expires_at = time.time() + self.ttl
+
+        with self._lock:
+            self._insert(key, response, expires_at)
+            self.stores += 1
+
+        self._write_disk(key, response, expires_at)
+        return True
+
+    def _insert(self, key: str, response: str, expires_at: float) -> None:
+        """Thêm mục vào tầng bộ nhớ và loại các mục ít dùng nhất khi vượt giới hạn byte (giữ khóa)"""
+        if key in self._entries:
+            self._remove(key)
+
+        size = len(key) + len(response.encode("utf-8"))
+        self._entries[key] = {"response": response, "expires_at": expires_at, "size": size}
+        self._bytes += size
+
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        """Đọc mục từ tầng đĩa (None nếu không có, hỏng hoặc hết hạn)"""
+        if not self.disk_dir:
+            return None
+
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Không đọc được bộ đệm phản hồi trên đĩa {key}: {str(e)}")
+            return None
+
+        if entry.get("expires_at", 0) <= now:
+            return None
+
+        return entry
+
+    def _write_disk(self, key: str, response: str, expires_at: float) -> None:
+        """Ghi mục xuống tầng đĩa (file tạm + os.replace, an toàn giữa các worker)"""
+        if not self.disk_dir:
+            return
+
+        path = self._disk_path(key)
+        tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({"response": response, "expires_at": expires_at}, f, ensure_ascii=False)
+            os.replace(tmp_file, path)
+        except OSError as e:
+            logger.error(f"Lỗi khi ghi bộ đệm phản hồi xuống đĩa: {str(e)}")
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        with self._lock:
+            self._disk_writes += 1
+            if self._disk_writes % RESPONSE_CACHE_DISK_PRUNE_EVERY != 0 or self._pruning:
+                return
+            self._pruning = True
+
+        threading.Thread(target=self.prune_disk, name="response-cache-prune", daemon=True).start()
+
+    def prune_disk(self) -> int:
+        """
+        Dọn tầng đĩa: xóa mục hết hạn, sau đó xóa mục cũ nhất đến khi dưới RESPONSE_CACHE_DISK_MAX_BYTES
+
+        Returns:
+            int: Số file đã xóa
+        """
+        removed = 0
+
+        try:
+            if not self.disk_dir:
+                return 0
+
+            now = time.time()
+            files = []
+            total = 0
+
+            for shard in os.listdir(self.disk_dir):
+                shard_dir = os.path.join(self.disk_dir, shard)
+                if not os.path.isdir(shard_dir):
+                    continue
+
+                for file_name in os.listdir(shard_dir):
+                    path = os.path.join(shard_dir, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+
+                    # File được ghi với mtime lúc tạo: quá TTL là đã hết hạn
+                    if file_name.endswith(".json") and stat.st_mtime + self.ttl > now:
+                        files.append((stat.st_mtime, stat.st_size, path))
+                        total += stat.st_size
+                    elif file_name.endswith(".json") or stat.st_mtime + 3600 < now:
+                        # Mục hết hạn hoặc file tạm bị bỏ lại
+                        removed += self._unlink(path)
+
+            files.sort()
+            for _, size, path in files:
+                if total <= self.disk_max_bytes:
+                    break
+                removed += self._unlink(path)
+                total -= size
+
+            return removed
+        except Exception as e:
+            logger.error(f"Lỗi khi dọn bộ đệm phản hồi trên đĩa: {str(e)}")
+            return removed
+        finally:
+            with self._lock:
+                self._pruning = False
+
+    def _unlink(self, path: str) -> int:
+        try:
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
@@ -11,11 +11,30 @@ from datetime import datetime, timedelta
 import hashlib
 import uuid
 import re
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
+import base64
+import gzip
+import zlib
+import itertools
+import copy
+import sqlite3
+import threading
+import time
+import atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, CollectionInvalid, BulkWriteError
+import bson
 from bson.objectid import ObjectId
 from typing import Dict, List, Tuple, Optional, Any, Union
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from pymongo.server_api import ServerApi
+from pymongo.write_concern import WriteConcern
+from pymongo import monitoring
+
+try:
+    import fcntl  # Khóa file giữa các tiến trình (chỉ có trên POSIX)
+except ImportError:
+    fcntl = None
 
 # Cấu hình logging
 logging.basicConfig(
@@ -27,67 +46,695 @@ logger = logging.getLogger(__name__)
 # Load biến môi trường
 load_dotenv()
 
+# Gộp các lượt ghi đồng thời vào cùng một file thành một lần ghi (group commit)
+FILE_GROUP_COMMIT = os.getenv("FILE_STORAGE_GROUP_COMMIT", "true").lower() == "true"
+
+# Loại lưu trữ: "mongodb" (mặc định khi có MONGODB_URI), "sqlite" hoặc "file"
+STORAGE_TYPE = os.getenv("STORAGE_TYPE", "").lower()
+# Loại lưu trữ dự phòng khi không kết nối được MongoDB: "file" hoặc "sqlite"
+STORAGE_FALLBACK = os.getenv("STORAGE_FALLBACK", "file").lower()
+
+# Write concern MongoDB theo loại thao tác: "majority" hoặc số node cần xác nhận (>= 1)
+#   critical:  người dùng, API key, hội thoại (mặc định của client)
+#   messages:  ghi thêm tin nhắn vào hội thoại
+#   telemetry: last_used của API key, hoạt động người dùng API, thống kê sử dụng
+MONGODB_WRITE_CONCERNS = {
+    "critical": os.getenv("MONGODB_WRITE_CONCERN_CRITICAL", "majority"),
+    "messages": os.getenv("MONGODB_WRITE_CONCERN_MESSAGES", "1"),
+    "telemetry": os.getenv("MONGODB_WRITE_CONCERN_TELEMETRY", "1")
+}
+
+# Cấu hình connection pool MongoDB (dùng chung một MongoClient cho mỗi tiến trình)
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "20"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "60000"))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+
+# MongoClient dùng chung theo (pid, URI): các StorageService trong cùng tiến trình dùng chung pool
+_mongo_clients: Dict[Tuple[int, str], MongoClient] = {}
+_mongo_clients_lock = threading.Lock()
+
+# Khóa trong tiến trình và hàng đợi group commit theo từng file (dùng chung cho mọi StorageService)
+_file_locks: Dict[str, threading.Lock] = {}
+_file_write_queues: Dict[str, Dict[str, Any]] = {}
+_file_registry_lock = threading.Lock()
+
+# Nội dung file JSON trong bộ nhớ (users.json, api_keys.json, manifest hội thoại) theo
+# đường dẫn file, kiểm tra lại bằng inode/mtime/kích thước file. Giới hạn số file (LRU), để
+# manifest của những người dùng không hoạt động không nằm mãi trong bộ nhớ của mỗi worker
+JSON_FILE_CACHE_MAX_ENTRIES = int(os.getenv("JSON_FILE_CACHE_MAX_ENTRIES", "256"))
+_json_file_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_json_file_cache_lock = threading.Lock()
+
+# Bộ đệm ghi sau (write-behind): các cập nhật nhỏ lặp lại trên mỗi request (last_login, last_used)
+# được giữ trong bộ nhớ, gộp theo khóa và ghi xuống theo lô định kỳ và khi tiến trình kết thúc
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "5"))
+_write_behind_buffers: Dict[str, Dict[Any, Any]] = {}
+_write_behind_lock = threading.Lock()
+_write_behind_timer: Optional[threading.Timer] = None
+
+# Thời gian giữ các sự kiện sử dụng API (mỗi request chat công khai một sự kiện)
+USAGE_EVENT_RETENTION = timedelta(days=int(os.getenv("USAGE_EVENT_RETENTION_DAYS", "30")))
+
+# Tổng hợp nền sự kiện sử dụng thành bucket theo giờ/ngày: chu kỳ (giây), thời gian chờ sự kiện
+# còn trong bộ đệm trước khi chốt một giờ, và thời gian giữ bucket
+USAGE_ROLLUP_INTERVAL = float(os.getenv("USAGE_ROLLUP_INTERVAL", "300"))
+USAGE_ROLLUP_GRACE = timedelta(minutes=5)
+USAGE_HOURLY_RETENTION = USAGE_EVENT_RETENTION + timedelta(days=2)
+USAGE_DAILY_RETENTION = timedelta(days=90)
+
+# Lưu trữ lạnh tin nhắn: số ngày không hoạt động trước khi lưu trữ (0 để tắt), chu kỳ chạy (giây)
+# và số tin nhắn trong một khối nén (MongoDB)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_CHUNK_SIZE = 1000
+
+# Các tác vụ nền định kỳ đang chạy của tiến trình (mỗi tác vụ một thread)
+_background_jobs: Dict[str, threading.Thread] = {}
+_background_jobs_lock = threading.Lock()
+
+# Bộ đệm thực thể trong tiến trình (người dùng, API key, chủ sở hữu hội thoại) với bus hủy bộ đệm
+# giữa các worker: MongoDB theo dõi change stream, SQLite/file đọc file phiên bản dùng chung.
+# Bộ đệm chỉ được dùng khi bus đã đồng bộ trong CACHE_INVALIDATION_MAX_LAG giây gần nhất,
+# nên thay đổi từ worker khác được áp dụng trễ tối đa chừng ấy thời gian
+CACHE_INVALIDATION = os.getenv("CACHE_INVALIDATION", "false").lower() == "true"
+CACHE_INVALIDATION_POLL_INTERVAL = float(os.getenv("CACHE_INVALIDATION_POLL_INTERVAL", "1"))
+CACHE_INVALIDATION_MAX_LAG = float(os.getenv("CACHE_INVALIDATION_MAX_LAG", "5"))
+CACHE_INVALIDATION_RETRY_INTERVAL = 30
+CACHE_ENTRY_TTL = float(os.getenv("CACHE_ENTRY_TTL", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_VERSION_LOG_SIZE = 1000
+
+# Các collection được lưu đệm và các trường cập nhật thường xuyên không nằm trong dữ liệu lưu đệm
+# (thay đổi chỉ gồm các trường này không hủy bộ đệm)
+_CACHE_IGNORED_FIELDS = {
+    "users": [],
+    "api_keys": ["last_used"],
+    "conversations": ["updated_at", "last_message_at", "preview", "last_message", "message_count", "archived", "rehydrated_at", "summary"]
+}
+_entity_caches: Dict[str, Dict[Any, Dict[str, Any]]] = {name: {} for name in _CACHE_IGNORED_FIELDS}
+# _id của document -> khóa tra cứu (sự kiện change stream chỉ có _id)
+_entity_cache_ids: Dict[str, Dict[Any, Any]] = {name: {} for name in _CACHE_IGNORED_FIELDS}
+# Tăng sau mỗi lần hủy, để không lưu đệm giá trị đọc trước khi hủy
+_entity_cache_generations: Dict[str, int] = {name: 0 for name in _CACHE_IGNORED_FIELDS}
+_entity_cache_lock = threading.Lock()
+_cache_bus_state: Dict[str, Any] = {
+    "synced_at": None, "version": None, "error": None, "hits": 0, "misses": 0, "evictions": 0
+}
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Ghi nhận số kết nối và thời gian chờ lấy kết nối từ pool MongoDB"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkout_started = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.checkout_wait_ms_total = 0.0
+            self.checkout_wait_ms_max = 0.0
+            self.checked_out = 0
+            self.connections_created = 0
+            self.connections_closed = 0
+            self.pool_cleared = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_wait_ms_avg": round(self.checkout_wait_ms_total / self.checkouts, 3) if self.checkouts else 0.0,
+                "checkout_wait_ms_max": round(self.checkout_wait_ms_max, 3),
+                "checked_out": self.checked_out,
+                "connections_created": self.connections_created,
+                "connections_closed": self.connections_closed,
+                "pool_cleared": self.pool_cleared
+            }
+
+    def _wait_ms(self) -> float:
+        started = getattr(self._checkout_started, "value", None)
+        self._checkout_started.value = None
+        return (time.monotonic() - started) * 1000 if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        # Bắt đầu và kết thúc checkout diễn ra trên cùng một thread
+        self._checkout_started.value = time.monotonic()
+
+    def connection_checked_out(self, event):
+        wait_ms = self._wait_ms()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.checkout_wait_ms_total += wait_ms
+            self.checkout_wait_ms_max = max(self.checkout_wait_ms_max, wait_ms)
+
+    def connection_check_out_failed(self, event):
+        self._wait_ms()
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_cleared += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Ghi nhận số lần gọi, số lỗi và độ trễ theo từng lệnh MongoDB (find, insert, update, ...)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands: Dict[str, Dict[str, Any]] = {}
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                name: {
+                    "count": stats["count"],
+                    "failures": stats["failures"],
+                    "latency_ms_avg": round(stats["latency_ms_total"] / stats["count"], 3),
+                    "latency_ms_max": round(stats["latency_ms_max"], 3)
+                }
+                for name, stats in self.commands.items()
+            }
+
+    def _record(self, event, failed: bool):
+        latency_ms = event.duration_micros / 1000
+        with self._lock:
+            stats = self.commands.setdefault(event.command_name, {
+                "count": 0, "failures": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0
+            })
+            stats["count"] += 1
+            stats["failures"] += 1 if failed else 0
+            stats["latency_ms_total"] += latency_ms
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], latency_ms)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, failed=False)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+
+# Bộ ghi nhận metrics dùng chung cho các MongoClient của tiến trình
+mongo_pool_metrics = MongoPoolMetrics()
+mongo_command_metrics = MongoCommandMetrics()
+
+
+def get_mongo_client(db_uri: str, w: Union[str, int] = "majority") -> MongoClient:
+    """
+    Lấy MongoClient dùng chung của tiến trình cho URI (tạo mới nếu chưa có)
+    
+    Args:
+        db_uri (str): URI kết nối MongoDB
+        w (str|int): Write concern mặc định của client
+        
+    Returns:
+        MongoClient: Client với connection pool theo cấu hình MONGODB_*_POOL_*
+    """
+    # Gắn theo pid để tiến trình con (fork) không dùng lại pool của tiến trình cha
+    key = (os.getpid(), db_uri)
+    
+    with _mongo_clients_lock:
+        client = _mongo_clients.get(key)
+        if client is None:
+            client = MongoClient(db_uri, **mongo_client_options(w))
+            _mongo_clients[key] = client
+        
+        return client
+
+
+def mongo_client_options(w: Union[str, int] = "majority") -> Dict[str, Any]:
+    """Tùy chọn kết nối MongoDB dùng chung cho MongoClient và client Motor (AsyncStorageService)"""
+    return {
+        "server_api": ServerApi('1'),  # Sử dụng Stable API version 1
+        "serverSelectionTimeoutMS": 5000,
+        "connectTimeoutMS": 5000,
+        "retryWrites": True,
+        "w": w,
+        "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+        "minPoolSize": MONGODB_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGODB_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        "event_listeners": [mongo_pool_metrics, mongo_command_metrics]
+    }
+
+
 class StorageService:
     def __init__(self, db_uri=None):
         """Khởi tạo dịch vụ lưu trữ"""
         try:
             self.db_uri = db_uri or os.getenv("MONGODB_URI")
             
-            if not self.db_uri:
+            if STORAGE_TYPE == "sqlite":
+                # Lưu trữ SQLite nhúng (không cần máy chủ cơ sở dữ liệu)
+                self.storage_type = "sqlite"
+                self._setup_sqlite_storage()
+                logger.info(f"Sử dụng lưu trữ SQLite: {self.sqlite_path}")
+            elif STORAGE_TYPE == "file" or not self.db_uri:
                 # Nếu không có URI MongoDB, sử dụng lưu trữ file
-                logger.warning("Không tìm thấy URI MongoDB, sử dụng lưu trữ file")
+                if STORAGE_TYPE != "file":
+                    logger.warning("Không tìm thấy URI MongoDB, sử dụng lưu trữ file")
                 self.storage_type = "file"
-                self.data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
-                os.makedirs(self.data_dir, exist_ok=True)
-                # Tạo các thư mục con nếu cần
-                for subdir in ["users", "conversations", "api_keys", "api_users"]:
-                    os.makedirs(os.path.join(self.data_dir, subdir), exist_ok=True)
+                self._setup_file_storage()
             else:
                 # Kết nối MongoDB với các tùy chọn mới nhất
                 self.storage_type = "mongodb"
                 
-                # Cấu hình kết nối MongoDB Atlas
-                self.client = MongoClient(
-                    self.db_uri,
-                    server_api=ServerApi('1'),  # Sử dụng Stable API version 1
-                    serverSelectionTimeoutMS=5000,
-                    connectTimeoutMS=5000,
-                    retryWrites=True,
-                    w="majority"
-                )
+                # Chính sách write concern theo loại thao tác
+                self.write_concerns = {
+                    tier: self._parse_write_concern(tier, value)
+                    for tier, value in MONGODB_WRITE_CONCERNS.items()
+                }
+                
+                # Kết nối MongoDB Atlas qua client dùng chung của tiến trình
+                self.client = get_mongo_client(self.db_uri, w=self.write_concerns["critical"])
                 
                 # Kiểm tra kết nối bằng ping
                 self.client.admin.command('ping')
                 
                 self.db = self.client.codesupporter
                 
+                # Cùng database nhưng với write concern riêng cho từng loại thao tác
+                self._tier_dbs = {
+                    tier: self.client.get_database(self.db.name, write_concern=WriteConcern(w=w))
+                    for tier, w in self.write_concerns.items()
+                }
+                
                 # Tạo indexes cho các collection
                 self._setup_mongodb_indexes()
                 
+                # Khởi tạo thống kê sử dụng API từ dữ liệu người dùng API có sẵn
+                self._seed_usage_rollups()
+                
+                # Bổ sung message_count/preview cho các hội thoại cũ (chạy nền)
+                threading.Thread(target=self.backfill_conversation_stats, daemon=True).start()
+                
                 logger.info("Kết nối MongoDB Atlas thành công")
                 
         except (ConnectionFailure, ServerSelectionTimeoutError) as e:
             logger.error(f"Không thể kết nối đến MongoDB: {str(e)}")
-            # Fallback sang lưu trữ file nếu kết nối MongoDB thất bại
-            self.storage_type = "file"
-            self.data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
-            os.makedirs(self.data_dir, exist_ok=True)
-            # Tạo các thư mục con nếu cần
-            for subdir in ["users", "conversations", "api_keys", "api_users"]:
-                os.makedirs(os.path.join(self.data_dir, subdir), exist_ok=True)
-            logger.warning("Chuyển sang sử dụng lưu trữ file")
+            # Fallback sang lưu trữ dự phòng nếu kết nối MongoDB thất bại
+            self._setup_fallback_storage()
         except Exception as e:
             logger.error(f"Lỗi không xác định khi khởi tạo lưu trữ: {str(e)}")
-            # Fallback sang lưu trữ file nếu có bất kỳ lỗi nào khác
-            self.storage_type = "file"
-            self.data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
-            os.makedirs(self.data_dir, exist_ok=True)
-            # Tạo các thư mục con nếu cần
-            for subdir in ["users", "conversations", "api_keys", "api_users"]:
-                os.makedirs(os.path.join(self.data_dir, subdir), exist_ok=True)
-            logger.warning("Chuyển sang sử dụng lưu trữ file do lỗi không xác định")
-    
-    
+            # Fallback sang lưu trữ dự phòng nếu có bất kỳ lỗi nào khác
+            self._setup_fallback_storage()
+        
+        # Ghi nốt bộ đệm write-behind khi tiến trình kết thúc
+        atexit.register(self._flush_write_behind)
+        
+        # Tác vụ nền: tổng hợp sự kiện sử dụng API thành bucket theo giờ/ngày, lưu trữ lạnh tin nhắn
+        self._start_background_job("usage_rollup", self.rollup_usage_events, USAGE_ROLLUP_INTERVAL)
+        if ARCHIVE_AFTER_DAYS > 0:
+            self._start_background_job("archive", self.archive_conversations, ARCHIVE_INTERVAL, run_first=False)
+
+        # Bus hủy bộ đệm giữa các worker
+        if CACHE_INVALIDATION:
+            if self.storage_type == "mongodb":
+                self._start_background_job(
+                    "cache_invalidation", self._watch_cache_invalidations, CACHE_INVALIDATION_RETRY_INTERVAL
+                )
+            else:
+                self._start_background_job(
+                    "cache_invalidation", self._sync_cache_versions, CACHE_INVALIDATION_POLL_INTERVAL
+                )
+
+    @staticmethod
+    def _parse_write_concern(tier: str, value: str) -> Union[str, int]:
+        """Chuyển cấu hình write concern ("majority" hoặc số node) thành giá trị w của MongoDB"""
+        value = str(value).strip().lower()
+        if value == "majority":
+            return value
+        
+        try:
+            w = int(value)
+        except ValueError:
+            w = 0
+        
+        # w=0 (không xác nhận) không được hỗ trợ vì cần kết quả ghi (upserted_ids, matched_count)
+        if w < 1:
+            logger.warning(f"Write concern không hợp lệ cho '{tier}': {value}, sử dụng majority")
+            return "majority"
+        
+        return w
+
+    def _mongo_db(self, tier: str):
+        """Lấy database MongoDB với write concern của loại thao tác (critical/messages/telemetry)"""
+        return self._tier_dbs.get(tier, self.db)
+
+    def get_write_concern_policy(self) -> Optional[Dict[str, Union[str, int]]]:
+        """
+        Lấy chính sách write concern theo loại thao tác
+        
+        Returns:
+            Optional[Dict]: {"critical", "messages", "telemetry"} hoặc None nếu không dùng MongoDB
+        """
+        if self.storage_type != "mongodb":
+            return None
+        
+        return dict(self.write_concerns)
+
+    def get_mongo_metrics(self) -> Optional[Dict[str, Any]]:
+        """
+        Lấy cấu hình pool và metrics của MongoDB (thời gian chờ lấy kết nối, độ trễ theo lệnh)
+        
+        Returns:
+            Optional[Dict]: {"pool_config", "pool", "commands"} hoặc None nếu không dùng MongoDB
+        """
+        if self.storage_type != "mongodb":
+            return None
+        
+        return {
+            "pool_config": {
+                "max_pool_size": MONGODB_MAX_POOL_SIZE,
+                "min_pool_size": MONGODB_MIN_POOL_SIZE,
+                "max_idle_time_ms": MONGODB_MAX_IDLE_TIME_MS,
+                "wait_queue_timeout_ms": MONGODB_WAIT_QUEUE_TIMEOUT_MS
+            },
+            "pool": mongo_pool_metrics.snapshot(),
+            "commands": mongo_command_metrics.snapshot()
+        }
+
+    def _start_background_job(self, name: str, job, interval: float, run_first: bool = True) -> None:
+        """
+        Chạy job định kỳ mỗi interval giây trong thread nền (một thread cho mỗi tác vụ trong tiến trình)
+        
+        Args:
+            name (str): Tên tác vụ
+            job (callable): Hàm thực hiện (tự xử lý lỗi)
+            interval (float): Chu kỳ (giây)
+            run_first (bool): Chạy ngay khi khởi động, nếu False chờ hết chu kỳ đầu
+        """
+        with _background_jobs_lock:
+            thread = _background_jobs.get(name)
+            if thread is not None and thread.is_alive():
+                return
+            
+            def run():
+                if not run_first:
+                    time.sleep(interval)
+                while True:
+                    job()
+                    time.sleep(interval)
+            
+            thread = threading.Thread(target=run, name=f"storage-{name}", daemon=True)
+            _background_jobs[name] = thread
+            thread.start()
+
+    def _setup_fallback_storage(self):
+        """Chuyển sang lưu trữ dự phòng (STORAGE_FALLBACK), mặc định là lưu trữ file"""
+        if STORAGE_FALLBACK == "sqlite" and self.storage_type != "sqlite":
+            try:
+                self.storage_type = "sqlite"
+                self._setup_sqlite_storage()
+                logger.warning("Chuyển sang sử dụng lưu trữ SQLite")
+                return
+            except Exception as e:
+                logger.error(f"Không thể khởi tạo lưu trữ SQLite: {str(e)}")
+        
+        self.storage_type = "file"
+        self._setup_file_storage()
+        logger.warning("Chuyển sang sử dụng lưu trữ file")
+
+    def _setup_file_storage(self):
+        """Khởi tạo thư mục dữ liệu cho chế độ lưu trữ file"""
+        self.data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+        os.makedirs(self.data_dir, exist_ok=True)
+        # Tạo các thư mục con nếu cần
+        for subdir in ["users", "conversations", "conversation_index", "api_keys", "api_users", "api_usage", "api_usage_events", "usage_rollups"]:
+            os.makedirs(os.path.join(self.data_dir, subdir), exist_ok=True)
+
+        # Dựng lại index conversation_id -> username nếu chưa có (hoặc lần dựng trước bị gián đoạn)
+        if not os.path.exists(os.path.join(self.data_dir, "conversation_index", "_complete")):
+            self._rebuild_conversation_index()
+
+        # Khởi tạo thống kê sử dụng API từ dữ liệu người dùng API có sẵn
+        self._seed_usage_rollups()
+
+    # --- Lưu trữ SQLite ---
+
+    # Các cột của bảng conversations có thể cập nhật trực tiếp; trường khác lưu trong cột extra (JSON)
+    _SQLITE_CONVERSATION_COLUMNS = ("title", "updated_at")
+
+    _SQLITE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            created_at TEXT,
+            last_login TEXT,
+            settings TEXT NOT NULL DEFAULT '{}'
+        );
+
+        CREATE TABLE IF NOT EXISTS conversation_log (
+            username TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversation_log_username
+            ON conversation_log (username, timestamp);
+
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            title TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            deleted_at TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            preview TEXT,
+            last_message TEXT,
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_username_updated_id
+            ON conversations (username, deleted, updated_at DESC, id DESC);
+
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id TEXT PRIMARY KEY,
+            conversation_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp
+            ON conversation_messages (conversation_id, timestamp);
+
+        CREATE TABLE IF NOT EXISTS api_keys (
+            key TEXT PRIMARY KEY,
+            secret TEXT NOT NULL,
+            name TEXT,
+            permissions TEXT NOT NULL DEFAULT '[]',
+            created_at TEXT,
+            created_by TEXT,
+            last_used TEXT,
+            status TEXT NOT NULL DEFAULT 'active',
+            updated_at TEXT,
+            updated_by TEXT,
+            deleted_at TEXT,
+            deleted_by TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_api_keys_created_by ON api_keys (created_by);
+
+        CREATE TABLE IF NOT EXISTS api_users (
+            api_key TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            first_seen TEXT NOT NULL,
+            last_active TEXT NOT NULL,
+            total_requests INTEGER NOT NULL DEFAULT 0,
+            user_info TEXT,
+            PRIMARY KEY (api_key, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_api_users_last_active ON api_users (last_active DESC);
+        CREATE INDEX IF NOT EXISTS idx_api_users_key_last_active ON api_users (api_key, last_active DESC);
+
+        CREATE TABLE IF NOT EXISTS api_usage_rollups (
+            api_key TEXT NOT NULL,
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            user_count INTEGER NOT NULL DEFAULT 0,
+            last_request TEXT,
+            PRIMARY KEY (api_key, granularity, bucket)
+        );
+        CREATE INDEX IF NOT EXISTS idx_api_usage_rollups_bucket ON api_usage_rollups (granularity, bucket);
+
+        CREATE TABLE IF NOT EXISTS api_usage_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            api_key TEXT NOT NULL,
+            user_id TEXT,
+            timestamp TEXT NOT NULL,
+            latency_ms REAL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            stream INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_api_usage_events_key_timestamp ON api_usage_events (api_key, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_api_usage_events_timestamp ON api_usage_events (timestamp);
+
+        CREATE TABLE IF NOT EXISTS usage_rollups (
+            api_key TEXT NOT NULL,
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            users TEXT NOT NULL DEFAULT '[]',
+            last_request TEXT,
+            latency_ms_total REAL NOT NULL DEFAULT 0,
+            latency_count INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (api_key, granularity, bucket)
+        );
+        CREATE INDEX IF NOT EXISTS idx_usage_rollups_bucket ON usage_rollups (granularity, bucket);
+
+        CREATE TABLE IF NOT EXISTS conversation_archives (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            archived_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversation_archives_conversation ON conversation_archives (conversation_id);
+
+        CREATE TABLE IF NOT EXISTS usage_rollup_state (
+            name TEXT PRIMARY KEY,
+            rolled_until TEXT NOT NULL
+        );
+    """
+
+    # Các bước nâng cấp dữ liệu chạy một lần, theo thứ tự; PRAGMA user_version lưu số bước đã chạy
+    _SQLITE_MIGRATIONS = [
+        [
+            # Index cũ của danh sách hội thoại (thay bằng index có id cho phân trang keyset)
+            "DROP INDEX IF EXISTS idx_conversations_username_updated",
+            # Bucket theo giờ/ngày cũ: thống kê theo khoảng thời gian được tính từ api_usage_events
+            "DROP TABLE IF EXISTS api_usage_rollup_users",
+            "DELETE FROM api_usage_rollups WHERE granularity != 'all'"
+        ],
+        [
+            # Đánh dấu request được trả từ bộ đệm phản hồi (không tính vào độ trễ)
+            "ALTER TABLE api_usage_events ADD COLUMN cached INTEGER NOT NULL DEFAULT 0"
+        ]
+    ]
+
+    def _setup_sqlite_storage(self):
+        """Khởi tạo cơ sở dữ liệu SQLite (chế độ WAL) và tạo bảng, index nếu chưa có"""
+        default_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "codesupporter.db")
+        self.sqlite_path = os.getenv("SQLITE_PATH", default_path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.sqlite_path)), exist_ok=True)
+        
+        # Mỗi thread dùng một kết nối riêng (sqlite3 không chia sẻ kết nối giữa các thread)
+        self._sqlite_local = threading.local()
+        
+        conn = self._sqlite_conn()
+        # WAL cho phép nhiều tiến trình đọc song song trong khi một tiến trình ghi
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self._SQLITE_SCHEMA)
+        self._migrate_sqlite_storage()
+        
+        # Khởi tạo thống kê sử dụng API từ dữ liệu người dùng API có sẵn
+        self._seed_usage_rollups()
+
+    def _migrate_sqlite_storage(self) -> None:
+        """Chạy các bước trong _SQLITE_MIGRATIONS chưa được áp dụng (theo PRAGMA user_version)"""
+        if self._sqlite_conn().execute("PRAGMA user_version").fetchone()[0] >= len(self._SQLITE_MIGRATIONS):
+            return
+        
+        with self._sqlite_transaction() as conn:
+            # Đọc lại trong transaction: worker khác có thể vừa nâng cấp xong
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for statements in self._SQLITE_MIGRATIONS[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {len(self._SQLITE_MIGRATIONS)}")
+        
+        logger.info(f"Đã nâng cấp cơ sở dữ liệu SQLite từ phiên bản {version} lên {len(self._SQLITE_MIGRATIONS)}")
+
+    def _sqlite_conn(self) -> sqlite3.Connection:
+        """Lấy kết nối SQLite của thread hiện tại (tạo mới nếu chưa có)"""
+        conn = getattr(self._sqlite_local, "conn", None)
+        if conn is None:
+            # isolation_level=None: tự quản lý transaction bằng BEGIN/COMMIT
+            conn = sqlite3.connect(self.sqlite_path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._sqlite_local.conn = conn
+        return conn
+
+    @contextmanager
+    def _sqlite_transaction(self):
+        """Transaction ghi SQLite (BEGIN IMMEDIATE giữ khóa ghi ngay từ đầu để đọc-ghi nhất quán)"""
+        conn = self._sqlite_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _sqlite_row_to_dict(self, row: Optional[sqlite3.Row], json_fields: Tuple[str, ...] = ()) -> Optional[Dict]:
+        """Chuyển một dòng SQLite thành dict, giải mã các cột JSON"""
+        if row is None:
+            return None
+        data = dict(row)
+        for field in json_fields:
+            if data.get(field) is not None:
+                data[field] = json.loads(data[field])
+        return data
+
+    def _sqlite_conversation_to_dict(self, row: Optional[sqlite3.Row]) -> Optional[Dict]:
+        """Chuyển một dòng bảng conversations thành dict cùng dạng với các chế độ lưu trữ khác"""
+        conversation = self._sqlite_row_to_dict(row, json_fields=("last_message", "extra"))
+        if conversation is None:
+            return None
+        
+        extra = conversation.pop("extra") or {}
+        conversation.update(extra)
+        conversation["deleted"] = bool(conversation["deleted"])
+        
+        # Chỉ có preview/last_message khi hội thoại đã có tin nhắn
+        if conversation.get("last_message") is None:
+            conversation.pop("last_message", None)
+            conversation.pop("preview", None)
+        
+        return conversation
+
     def _hash_password(self, password: str) -> str:
         """Hash mật khẩu sử dụng SHA-256"""
         return hashlib.sha256(password.encode()).hexdigest()
@@ -136,6 +783,8 @@ class StorageService:
             # Index cho conversations collection
             try:
                 self.db.conversations.create_index([("username", 1), ("updated_at", -1)])
+                # Phân trang keyset theo (updated_at, _id)
+                self.db.conversations.create_index([("username", 1), ("updated_at", -1), ("_id", -1)])
                 logger.info("Đã tạo index cho conversations collection")
             except Exception as e:
                 logger.error(f"Lỗi khi tạo index cho conversations collection: {str(e)}")
@@ -143,6 +792,9 @@ class StorageService:
             # Index cho conversation_messages collection
             try:
                 self.db.conversation_messages.create_index("conversation_id")
+                # Đọc phần đuôi hội thoại theo thứ tự thời gian và tra cứu tin nhắn mốc theo id
+                self.db.conversation_messages.create_index([("conversation_id", 1), ("timestamp", 1), ("_id", 1)])
+                self.db.conversation_messages.create_index([("conversation_id", 1), ("id", 1)])
                 logger.info("Đã tạo index cho conversation_messages collection")
             except Exception as e:
                 logger.error(f"Lỗi khi tạo index cho conversation_messages collection: {str(e)}")
@@ -163,6 +815,52 @@ class StorageService:
             except Exception as e:
                 logger.error(f"Lỗi khi tạo index cho api_users collection: {str(e)}")
             
+            # Index cho api_usage_rollups collection (bucket theo giờ/ngày cũ tự hết hạn qua TTL)
+            try:
+                self.db.api_usage_rollups.create_index(
+                    [("api_key", 1), ("granularity", 1), ("bucket", 1)], unique=True
+                )
+                self.db.api_usage_rollups.create_index([("granularity", 1), ("bucket", 1)])
+                self.db.api_usage_rollups.create_index("expires_at", expireAfterSeconds=0)
+                logger.info("Đã tạo index cho api_usage_rollups collection")
+            except Exception as e:
+                logger.error(f"Lỗi khi tạo index cho api_usage_rollups collection: {str(e)}")
+            
+            # Time-series collection cho sự kiện sử dụng API (meta field = api_key, tự xóa qua TTL)
+            try:
+                try:
+                    self.db.create_collection(
+                        "api_usage_events",
+                        timeseries={"timeField": "timestamp", "metaField": "api_key", "granularity": "minutes"},
+                        expireAfterSeconds=int(USAGE_EVENT_RETENTION.total_seconds())
+                    )
+                except CollectionInvalid:
+                    pass  # Collection đã tồn tại
+                
+                self.db.api_usage_events.create_index([("api_key", 1), ("timestamp", -1)])
+                logger.info("Đã tạo time-series collection api_usage_events")
+            except Exception as e:
+                logger.error(f"Lỗi khi tạo time-series collection api_usage_events: {str(e)}")
+            
+            # Index cho lưu trữ lạnh tin nhắn
+            try:
+                self.db.conversations.create_index([("archived", 1), ("updated_at", 1)])
+                self.db.conversation_archives.create_index("conversation_id")
+                logger.info("Đã tạo index cho conversation_archives collection")
+            except Exception as e:
+                logger.error(f"Lỗi khi tạo index cho conversation_archives collection: {str(e)}")
+            
+            # Index cho usage_rollups collection (khóa $merge của tác vụ tổng hợp, bucket hết hạn qua TTL)
+            try:
+                self.db.usage_rollups.create_index(
+                    [("api_key", 1), ("granularity", 1), ("bucket", 1)], unique=True
+                )
+                self.db.usage_rollups.create_index([("granularity", 1), ("bucket", 1)])
+                self.db.usage_rollups.create_index("expires_at", expireAfterSeconds=0)
+                logger.info("Đã tạo index cho usage_rollups collection")
+            except Exception as e:
+                logger.error(f"Lỗi khi tạo index cho usage_rollups collection: {str(e)}")
+            
             logger.info("Quá trình thiết lập MongoDB indexes đã hoàn tất")
         except Exception as e:
             logger.error(f"Lỗi khi thiết lập MongoDB indexes: {str(e)}")
@@ -172,7 +870,1791 @@ class StorageService:
         if not id_str or not isinstance(id_str, str):
             return False
         return bool(re.match(r'^[0-9a-fA-F]{24}$', id_str))
-    
+
+    # --- Ghi file an toàn giữa các thread/tiến trình (lưu trữ file) ---
+
+    @contextmanager
+    def _locked_file(self, path: str):
+        """
+        Giữ khóa độc quyền cho một file dữ liệu
+
+        Dùng khóa trong tiến trình kết hợp advisory lock (flock) trên file phụ
+        <path>.lock, vì file chính sẽ bị thay thế (os.replace) sau mỗi lần ghi.
+        """
+        with _file_registry_lock:
+            thread_lock = _file_locks.setdefault(path, threading.Lock())
+
+        with thread_lock:
+            with open(f"{path}.lock", "a") as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _atomic_write_json(self, path: str, data: Any, indent: Optional[int] = 2) -> None:
+        """Ghi JSON ra file tạm, fsync rồi thay thế file đích (os.replace)"""
+        tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=indent)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_file, path)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _read_json_file(self, path: str, default: Any = None) -> Any:
+        """Đọc file JSON, trả về bản sao của default nếu file chưa tồn tại"""
+        if not os.path.exists(path):
+            return copy.deepcopy(default)
+
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _update_json_file(self, path: str, mutator, default: Any = None, indent: Optional[int] = 2) -> Any:
+        """
+        Đọc - sửa - ghi một file JSON dưới khóa, commit bằng os.replace
+
+        Khi bật FILE_STORAGE_GROUP_COMMIT, các thread cùng cập nhật một file sẽ được
+        gộp lại: một thread đọc file một lần, áp dụng lần lượt mọi thay đổi đang chờ
+        và ghi một lần cho cả nhóm.
+
+        Args:
+            path (str): Đường dẫn file
+            mutator (callable): Hàm nhận dữ liệu hiện tại, trả về (dữ liệu mới, kết quả)
+            default: Dữ liệu khởi tạo nếu file chưa tồn tại
+            indent (int, optional): Thụt lề khi ghi JSON
+
+        Returns:
+            Kết quả do mutator trả về
+        """
+        if not FILE_GROUP_COMMIT:
+            with self._locked_file(path):
+                data, result = mutator(self._read_json_file(path, default))
+                self._atomic_write_json(path, data, indent)
+            return result
+
+        with _file_registry_lock:
+            queue = _file_write_queues.setdefault(path, {
+                "commit_lock": threading.Lock(),
+                "pending": []
+            })
+            request = {"mutator": mutator, "done": False, "result": None, "error": None}
+            queue["pending"].append(request)
+
+        with queue["commit_lock"]:
+            # Một thread khác có thể đã commit thay đổi này trong nhóm của nó
+            if not request["done"]:
+                with _file_registry_lock:
+                    batch, queue["pending"] = queue["pending"], []
+
+                try:
+                    with self._locked_file(path):
+                        data = self._read_json_file(path, default)
+                        for item in batch:
+                            try:
+                                data, item["result"] = item["mutator"](data)
+                            except Exception as e:
+                                item["error"] = e
+                        self._atomic_write_json(path, data, indent)
+                except Exception as e:
+                    for item in batch:
+                        item["error"] = item["error"] or e
+                finally:
+                    for item in batch:
+                        item["done"] = True
+
+        if request["error"]:
+            raise request["error"]
+
+        return request["result"]
+
+    # --- Bảng JSON trong bộ nhớ cho lưu trữ file ---
+
+    def _users_file(self) -> str:
+        """Đường dẫn file danh sách người dùng"""
+        return os.path.join(self.data_dir, "users", "users.json")
+
+    def _api_keys_file(self) -> str:
+        """Đường dẫn file danh sách API key"""
+        return os.path.join(self.data_dir, "api_keys", "api_keys.json")
+
+    def _get_cached_json(self, path: str, build=None) -> Any:
+        """
+        Đọc file JSON qua bộ nhớ đệm, chỉ đọc lại khi file đã thay đổi (mọi lần ghi đều
+        thay file qua os.replace nên inode/mtime/kích thước đổi theo)
+        
+        Args:
+            path (str): Đường dẫn file JSON
+            build (callable, optional): Chuyển đổi dữ liệu sau mỗi lần đọc lại (kết quả được lưu đệm)
+            
+        Returns:
+            Any: Dữ liệu (chỉ đọc, không sửa trực tiếp) hoặc None nếu file không tồn tại
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        
+        with _json_file_cache_lock:
+            cached = _json_file_cache.get(path)
+            if cached and cached["signature"] == signature:
+                _json_file_cache.move_to_end(path)
+                return cached["value"]
+        
+        with open(path, "r", encoding="utf-8") as f:
+            value = json.load(f)
+        
+        if build:
+            value = build(value)
+        
+        with _json_file_cache_lock:
+            _json_file_cache[path] = {"signature": signature, "value": value}
+            _json_file_cache.move_to_end(path)
+            while len(_json_file_cache) > JSON_FILE_CACHE_MAX_ENTRIES:
+                _json_file_cache.popitem(last=False)
+        
+        return value
+
+    def _get_json_table(self, path: str, key_field: str) -> Dict[str, Dict]:
+        """
+        Lấy nội dung một file danh sách JSON dưới dạng bảng {key: item} từ bộ nhớ đệm
+        
+        Args:
+            path (str): Đường dẫn file JSON (danh sách các dict)
+            key_field (str): Trường dùng làm khóa
+            
+        Returns:
+            Dict[str, Dict]: Bảng dữ liệu (chỉ đọc, không sửa trực tiếp)
+        """
+        table = self._get_cached_json(path, lambda items: {item[key_field]: item for item in items})
+        return table if table is not None else {}
+
+    def _get_users_table(self) -> Dict[str, Dict]:
+        """Bảng người dùng {username: user}"""
+        return self._get_json_table(self._users_file(), "username")
+
+    def _get_api_keys_table(self) -> Dict[str, Dict]:
+        """Bảng API key {key: key_data}"""
+        return self._get_json_table(self._api_keys_file(), "key")
+
+    def _get_cached_user(self, username: str) -> Optional[Dict]:
+        """Tra cứu người dùng theo username trong bảng người dùng (O(1))"""
+        user = self._get_users_table().get(username)
+        if user is None:
+            return None
+        
+        user = copy.deepcopy(user)
+        
+        # last_login mới nhất có thể chưa được ghi xuống file
+        pending = self._get_buffered_write("last_login", username)
+        if pending:
+            user["last_login"] = pending.isoformat()
+        
+        return user
+
+    # --- Bộ đệm thực thể và bus hủy bộ đệm giữa các worker ---
+    # Với lưu trữ file, người dùng và API key đã được đệm qua _get_cached_json (kiểm tra theo file)
+    # nên bộ đệm thực thể chỉ dùng cho chủ sở hữu hội thoại.
+
+    def _cache_bus_healthy(self) -> bool:
+        """Bus hủy bộ đệm đã đồng bộ trong CACHE_INVALIDATION_MAX_LAG giây gần nhất"""
+        synced_at = _cache_bus_state["synced_at"]
+        return (
+            CACHE_INVALIDATION and synced_at is not None
+            and time.monotonic() - synced_at <= CACHE_INVALIDATION_MAX_LAG
+        )
+
+    def _get_cached_entity(self, collection: str, key: Any, load) -> Any:
+        """
+        Lấy dữ liệu qua bộ đệm thực thể của tiến trình (đọc thẳng khi bus hủy bộ đệm chưa đồng bộ)
+
+        Args:
+            collection (str): "users", "api_keys" hoặc "conversations"
+            key: Khóa tra cứu (username, API key, conversation_id)
+            load (callable): Đọc từ lưu trữ, trả về (giá trị, _id của document) hoặc (None, None)
+
+        Returns:
+            Any: Bản sao giá trị hoặc None nếu không tìm thấy (không lưu đệm)
+        """
+        hit, value, generation = self._lookup_cached_entity(collection, key)
+        if hit:
+            return value
+
+        value, doc_id = load()
+        self._store_cached_entity(collection, key, value, doc_id, generation)
+        return value
+
+    def _lookup_cached_entity(self, collection: str, key: Any) -> Tuple[bool, Any, Optional[int]]:
+        """
+        Tra cứu bộ đệm thực thể
+
+        Returns:
+            Tuple[bool, Any, Optional[int]]: (có trong bộ đệm, bản sao giá trị, thế hệ để truyền cho
+            _store_cached_entity; None nếu bộ đệm đang tắt)
+        """
+        if not self._cache_bus_healthy():
+            return False, None, None
+
+        with _entity_cache_lock:
+            entry = _entity_caches[collection].get(key)
+            if entry and entry["expires_at"] > time.monotonic():
+                _cache_bus_state["hits"] += 1
+                return True, copy.deepcopy(entry["value"]), None
+
+            _cache_bus_state["misses"] += 1
+            return False, None, _entity_cache_generations[collection]
+
+    def _store_cached_entity(self, collection: str, key: Any, value: Any, doc_id: Any,
+                             generation: Optional[int]) -> None:
+        """Lưu giá trị vừa đọc vào bộ đệm thực thể (bỏ qua nếu không tìm thấy hoặc bộ đệm đang tắt)"""
+        if value is None or generation is None:
+            return
+
+        with _entity_cache_lock:
+            # Có lần hủy trong lúc đọc: giá trị vừa đọc có thể đã cũ, không lưu đệm
+            if _entity_cache_generations[collection] != generation:
+                return
+
+            cache = _entity_caches[collection]
+            ids = _entity_cache_ids[collection]
+
+            if key not in cache and len(cache) >= CACHE_MAX_ENTRIES:
+                oldest = cache.pop(next(iter(cache)))
+                ids.pop(oldest["doc_id"], None)
+
+            cache[key] = {
+                "value": copy.deepcopy(value), "doc_id": doc_id,
+                "expires_at": time.monotonic() + CACHE_ENTRY_TTL
+            }
+            if doc_id is not None:
+                ids[doc_id] = key
+
+    def _evict_cached_entities(self, collection: str, keys: List[Any] = None, doc_ids: List[Any] = None) -> None:
+        """Xóa các mục khỏi bộ đệm thực thể theo khóa hoặc _id (không truyền cả hai: xóa cả collection)"""
+        with _entity_cache_lock:
+            cache = _entity_caches[collection]
+            ids = _entity_cache_ids[collection]
+            _entity_cache_generations[collection] += 1
+
+            if keys is None and doc_ids is None:
+                evicted = len(cache)
+                cache.clear()
+                ids.clear()
+            else:
+                keys = list(keys or []) + [ids[doc_id] for doc_id in doc_ids or [] if doc_id in ids]
+                evicted = 0
+                for key in keys:
+                    entry = cache.pop(key, None)
+                    if entry:
+                        ids.pop(entry["doc_id"], None)
+                        evicted += 1
+
+            _cache_bus_state["evictions"] += evicted
+
+    def _clear_entity_caches(self) -> None:
+        """Xóa toàn bộ bộ đệm thực thể"""
+        for collection in _entity_caches:
+            self._evict_cached_entities(collection)
+
+    def _invalidate_cached_entity(self, collection: str, key: Any = None) -> None:
+        """
+        Hủy mục bộ đệm sau khi ghi: xóa ngay trong tiến trình hiện tại, với SQLite/file ghi thêm
+        thay đổi vào file phiên bản để các worker khác xóa theo (MongoDB: qua change stream)
+
+        Args:
+            collection (str): "users", "api_keys" hoặc "conversations"
+            key: Khóa tra cứu, None để hủy cả collection
+        """
+        if not CACHE_INVALIDATION:
+            return
+
+        self._evict_cached_entities(collection, keys=None if key is None else [key])
+
+        if self.storage_type == "mongodb":
+            return
+
+        def append_change(versions):
+            version = versions.get("version", 0) + 1
+            changes = versions.get("changes", [])[-(CACHE_VERSION_LOG_SIZE - 1):]
+            changes.append([version, collection, key])
+            return {"version": version, "changes": changes}, version
+
+        try:
+            self._update_json_file(self._cache_versions_file(), append_change, default={}, indent=None)
+        except Exception as e:
+            # Worker khác không nhận được thay đổi: mục của chúng hết hạn sau CACHE_ENTRY_TTL
+            logger.error(f"Lỗi khi ghi file phiên bản bộ đệm: {str(e)}")
+
+    def _cache_bus_failed(self, error: Exception) -> None:
+        """Tắt bộ đệm thực thể đến lần đồng bộ tiếp theo khi bus hủy bộ đệm gặp lỗi"""
+        message = str(error)
+        if _cache_bus_state["error"] != message:
+            logger.error(f"Lỗi bus hủy bộ đệm, tạm ngừng dùng bộ đệm: {message}")
+
+        _cache_bus_state.update(synced_at=None, version=None, error=message)
+        self._clear_entity_caches()
+
+    def _cache_versions_file(self) -> str:
+        """Đường dẫn file phiên bản bộ đệm dùng chung giữa các worker (SQLite/file)"""
+        if self.storage_type == "sqlite":
+            return os.path.join(os.path.dirname(os.path.abspath(self.sqlite_path)), "cache_versions.json")
+        return os.path.join(self.data_dir, "cache_versions.json")
+
+    def _sync_cache_versions(self) -> None:
+        """
+        Áp dụng các thay đổi mới trong file phiên bản bộ đệm (SQLite/file)
+
+        File gồm số phiên bản và CACHE_VERSION_LOG_SIZE thay đổi gần nhất [phiên bản, collection, khóa].
+        Nếu đã lỡ nhiều thay đổi hơn số được giữ lại thì xóa toàn bộ bộ đệm.
+        """
+        try:
+            versions = self._get_cached_json(self._cache_versions_file()) or {}
+            version = versions.get("version", 0)
+            local_version = _cache_bus_state["version"]
+
+            if local_version is not None and version != local_version:
+                changes = [change for change in versions.get("changes", []) if change[0] > local_version]
+
+                if version < local_version or not changes or changes[0][0] != local_version + 1:
+                    self._clear_entity_caches()
+                else:
+                    for _, collection, key in changes:
+                        if collection in _entity_caches:
+                            self._evict_cached_entities(collection, keys=None if key is None else [key])
+
+            _cache_bus_state.update(version=version, synced_at=time.monotonic(), error=None)
+        except Exception as e:
+            self._cache_bus_failed(e)
+
+    def _cache_change_stream_pipeline(self) -> List[Dict]:
+        """Lọc change stream: thay đổi trên các collection được lưu đệm, bỏ qua cập nhật chỉ gồm trường bị bỏ qua"""
+        conditions = [
+            {"ns.coll": {"$in": list(_CACHE_IGNORED_FIELDS)}, "operationType": {"$ne": "update"}},
+            {"operationType": {"$in": ["dropDatabase", "invalidate"]}}
+        ]
+
+        for collection, ignored_fields in _CACHE_IGNORED_FIELDS.items():
+            changed_fields = {"$concatArrays": [
+                {"$map": {"input": {"$objectToArray": "$updateDescription.updatedFields"}, "in": "$$this.k"}},
+                "$updateDescription.removedFields"
+            ]}
+            conditions.append({
+                "ns.coll": collection,
+                "operationType": "update",
+                "$expr": {"$gt": [{"$size": {"$setDifference": [changed_fields, ignored_fields]}}, 0]}
+            })
+
+        return [{"$match": {"$or": conditions}}]
+
+    def _watch_cache_invalidations(self) -> None:
+        """
+        Theo dõi change stream của users, api_keys và conversations và xóa các mục bị ảnh hưởng
+
+        Chạy đến khi gặp lỗi (tác vụ nền mở lại sau CACHE_INVALIDATION_RETRY_INTERVAL giây).
+        Change stream cần replica set; MongoDB standalone sẽ không dùng bộ đệm.
+        """
+        try:
+            with self.db.watch(
+                self._cache_change_stream_pipeline(),
+                max_await_time_ms=int(CACHE_INVALIDATION_POLL_INTERVAL * 1000)
+            ) as stream:
+                # Các mục được đọc trước khi mở stream có thể đã bỏ lỡ thay đổi
+                self._clear_entity_caches()
+
+                while stream.alive:
+                    change = stream.try_next()
+
+                    if change is not None:
+                        collection = change.get("ns", {}).get("coll")
+                        if collection in _entity_caches and "documentKey" in change:
+                            self._evict_cached_entities(collection, doc_ids=[change["documentKey"]["_id"]])
+                        else:
+                            # drop, rename, dropDatabase, invalidate
+                            self._clear_entity_caches()
+
+                    _cache_bus_state.update(synced_at=time.monotonic(), error=None)
+
+            _cache_bus_state["synced_at"] = None
+        except Exception as e:
+            self._cache_bus_failed(e)
+
+    def get_cache_status(self) -> Dict[str, Any]:
+        """
+        Lấy trạng thái bộ đệm thực thể và bus hủy bộ đệm
+
+        Returns:
+            Dict: {"enabled", "bus", "healthy", "lag_seconds", "entries", "hits", "misses", "evictions", "error"}
+        """
+        synced_at = _cache_bus_state["synced_at"]
+
+        with _entity_cache_lock:
+            entries = {collection: len(cache) for collection, cache in _entity_caches.items()}
+
+        return {
+            "enabled": CACHE_INVALIDATION,
+            "bus": "change_stream" if self.storage_type == "mongodb" else "version_file",
+            "healthy": self._cache_bus_healthy(),
+            "lag_seconds": round(time.monotonic() - synced_at, 3) if synced_at is not None else None,
+            "max_lag_seconds": CACHE_INVALIDATION_MAX_LAG,
+            "entries": entries,
+            "hits": _cache_bus_state["hits"],
+            "misses": _cache_bus_state["misses"],
+            "evictions": _cache_bus_state["evictions"],
+            "error": _cache_bus_state["error"]
+        }
+
+    # --- Bộ đệm ghi sau (write-behind) ---
+    # Mỗi bộ đệm <name> có _flush_<name>(entries) để ghi cả lô và _merge_<name>(old, new) để gộp hai giá trị
+
+    def _buffer_write(self, buffer_name: str, key: Any, value: Any) -> None:
+        """Ghi nhận một cập nhật vào bộ đệm, gộp với giá trị đang chờ cùng khóa"""
+        global _write_behind_timer
+        
+        merge = getattr(self, f"_merge_{buffer_name}")
+        
+        with _write_behind_lock:
+            buffer = _write_behind_buffers.setdefault(buffer_name, {})
+            buffer[key] = merge(buffer[key], value) if key in buffer else value
+            
+            if _write_behind_timer is None:
+                _write_behind_timer = threading.Timer(WRITE_BEHIND_FLUSH_INTERVAL, self._flush_write_behind)
+                _write_behind_timer.daemon = True
+                _write_behind_timer.start()
+
+    def _get_buffered_write(self, buffer_name: str, key: Any) -> Any:
+        """Lấy giá trị đang chờ ghi trong bộ đệm (None nếu không có)"""
+        with _write_behind_lock:
+            return _write_behind_buffers.get(buffer_name, {}).get(key)
+
+    def _flush_write_behind(self) -> None:
+        """Ghi toàn bộ bộ đệm write-behind xuống lưu trữ (mỗi bộ đệm một lần ghi theo lô)"""
+        global _write_behind_timer
+        
+        with _write_behind_lock:
+            buffers = dict(_write_behind_buffers)
+            _write_behind_buffers.clear()
+            _write_behind_timer = None
+        
+        for buffer_name, entries in buffers.items():
+            if not entries:
+                continue
+            try:
+                getattr(self, f"_flush_{buffer_name}")(entries)
+            except Exception as e:
+                logger.error(f"Lỗi khi ghi bộ đệm {buffer_name}: {str(e)}")
+                # Đưa lại vào bộ đệm để thử ghi ở lần sau
+                for key, value in entries.items():
+                    self._buffer_write(buffer_name, key, value)
+
+    def _merge_last_login(self, old: datetime, new: datetime) -> datetime:
+        return max(old, new)
+
+    def _flush_last_login(self, entries: Dict[str, datetime]) -> None:
+        """Ghi last_login đang chờ xuống users.json (chỉ dùng cho lưu trữ file)"""
+        def stamp_logins(users):
+            for user in users:
+                if user["username"] in entries:
+                    user["last_login"] = entries[user["username"]].isoformat()
+            return users, True
+        
+        self._update_json_file(self._users_file(), stamp_logins, default=[])
+
+    def _merge_api_key_last_used(self, old: datetime, new: datetime) -> datetime:
+        return max(old, new)
+
+    def _flush_api_key_last_used(self, entries: Dict[str, datetime]) -> None:
+        """Ghi last_used đang chờ của các API key"""
+        if self.storage_type == "mongodb":
+            self._mongo_db("telemetry").api_keys.bulk_write(
+                [UpdateOne({"key": key}, {"$max": {"last_used": last_used}})
+                 for key, last_used in entries.items()],
+                ordered=False
+            )
+        elif self.storage_type == "sqlite":
+            with self._sqlite_transaction() as conn:
+                conn.executemany(
+                    "UPDATE api_keys SET last_used = MAX(COALESCE(last_used, ''), ?) WHERE key = ?",
+                    [(last_used.isoformat(), key) for key, last_used in entries.items()]
+                )
+        else:
+            def stamp_last_used(api_keys):
+                for key_data in api_keys:
+                    if key_data["key"] in entries:
+                        key_data["last_used"] = entries[key_data["key"]].isoformat()
+                return api_keys, True
+            
+            self._update_json_file(self._api_keys_file(), stamp_last_used, default=[])
+
+    def _merge_api_user_activity(self, old: Dict, new: Dict) -> Dict:
+        return {
+            "requests": old["requests"] + new["requests"],
+            "first_seen": min(old["first_seen"], new["first_seen"]),
+            "last_active": max(old["last_active"], new["last_active"]),
+            "user_info": new["user_info"] or old["user_info"]
+        }
+
+    def _flush_api_user_activity(self, entries: Dict[Tuple[str, str], Dict]) -> None:
+        """Ghi hoạt động người dùng API đang chờ (số request, thời gian, user_info) theo lô"""
+        activities = dict(entries)
+        new_users = set()  # Các (api_key, user_id) lần đầu xuất hiện
+        
+        if self.storage_type == "mongodb":
+            keys = list(entries.keys())
+            operations = []
+            for (api_key, user_id), activity in entries.items():
+                update = {
+                    "$setOnInsert": {"first_seen": activity["first_seen"]},
+                    "$max": {"last_active": activity["last_active"]},
+                    "$inc": {"total_requests": activity["requests"]}
+                }
+                if activity["user_info"]:
+                    update["$set"] = {"user_info": activity["user_info"]}
+                
+                operations.append(UpdateOne({"api_key": api_key, "user_id": user_id}, update, upsert=True))
+            
+            result = self._mongo_db("telemetry").api_users.bulk_write(operations, ordered=False)
+            new_users = {keys[index] for index in result.upserted_ids}
+            
+        elif self.storage_type == "sqlite":
+            with self._sqlite_transaction() as conn:
+                for api_key, user_id in entries:
+                    if not conn.execute(
+                        "SELECT 1 FROM api_users WHERE api_key = ? AND user_id = ?", (api_key, user_id)
+                    ).fetchone():
+                        new_users.add((api_key, user_id))
+                
+                conn.executemany(
+                    """
+                    INSERT INTO api_users (api_key, user_id, first_seen, last_active, total_requests, user_info)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (api_key, user_id) DO UPDATE SET
+                        last_active = MAX(api_users.last_active, excluded.last_active),
+                        total_requests = api_users.total_requests + excluded.total_requests,
+                        user_info = COALESCE(excluded.user_info, api_users.user_info)
+                    """,
+                    [
+                        (
+                            api_key,
+                            user_id,
+                            activity["first_seen"].isoformat(),
+                            activity["last_active"].isoformat(),
+                            activity["requests"],
+                            json.dumps(activity["user_info"], ensure_ascii=False) if activity["user_info"] else None
+                        )
+                        for (api_key, user_id), activity in entries.items()
+                    ]
+                )
+                
+        else:
+            # Lưu trữ file - gom theo API key: mỗi người dùng ghi một lần, _summary.json ghi một lần
+            by_api_key: Dict[str, Dict[str, Dict]] = {}
+            for (api_key, user_id), activity in entries.items():
+                by_api_key.setdefault(api_key, {})[user_id] = activity
+            
+            for api_key, users in by_api_key.items():
+                # Sử dụng API key làm thư mục để phân tách dữ liệu
+                api_key_dir = os.path.join(self.data_dir, "api_users", self._sanitize_filename(api_key))
+                os.makedirs(api_key_dir, exist_ok=True)
+                
+                for user_id, activity in users.items():
+                    # File cho từng user (để tránh file quá lớn)
+                    user_file = os.path.join(api_key_dir, f"{self._sanitize_filename(user_id)}.json")
+                    
+                    def apply_activity(api_user_data, user_id=user_id, activity=activity):
+                        created = not api_user_data
+                        if created:
+                            api_user_data = {
+                                "api_key": api_key,
+                                "user_id": user_id,
+                                "first_seen": activity["first_seen"].isoformat(),
+                                "last_active": activity["last_active"].isoformat(),
+                                "total_requests": 0
+                            }
+                        
+                        api_user_data["last_active"] = max(
+                            api_user_data["last_active"], activity["last_active"].isoformat()
+                        )
+                        api_user_data["total_requests"] += activity["requests"]
+                        
+                        # Cập nhật thông tin bổ sung nếu có
+                        if activity["user_info"]:
+                            api_user_data["user_info"] = activity["user_info"]
+                        
+                        return api_user_data, created
+                    
+                    if self._update_json_file(user_file, apply_activity):
+                        new_users.add((api_key, user_id))
+                    
+                    # Đã ghi xong: không đưa lại vào bộ đệm nếu phần sau bị lỗi
+                    entries.pop((api_key, user_id))
+                
+                # Cập nhật danh sách tổng hợp
+                summary_file = os.path.join(api_key_dir, "_summary.json")
+                new_user_count = sum(1 for user_id in users if (api_key, user_id) in new_users)
+                total_requests = sum(activity["requests"] for activity in users.values())
+                last_updated = max(activity["last_active"] for activity in users.values()).isoformat()
+                
+                def apply_summary(summary_data):
+                    summary_data["total_users"] += new_user_count
+                    summary_data["total_requests"] += total_requests
+                    summary_data["last_updated"] = max(summary_data["last_updated"], last_updated)
+                    return summary_data, True
+                
+                self._update_json_file(summary_file, apply_summary, default={
+                    "total_users": 0,
+                    "total_requests": 0,
+                    "last_updated": last_updated
+                })
+        
+        # Cộng số người dùng mới vào thống kê tổng
+        totals = {}
+        for api_key, user_id in new_users:
+            total = totals.setdefault(api_key, {
+                "requests": 0, "new_users": 0, "last_request": activities[(api_key, user_id)]["last_active"]
+            })
+            total["new_users"] += 1
+            total["last_request"] = max(total["last_request"], activities[(api_key, user_id)]["last_active"])
+        
+        self._record_usage_totals(totals)
+
+    # --- Sự kiện sử dụng API ---
+    # Mỗi request chat công khai là một sự kiện (api_key, user_id, thời gian, độ trễ, số token),
+    # dùng để trả lời thống kê theo khoảng thời gian (24h, 7 ngày, 30 ngày). MongoDB lưu trong
+    # time-series collection, SQLite trong bảng api_usage_events, lưu trữ file trong các file JSONL
+    # theo API key và ngày; sự kiện quá USAGE_EVENT_RETENTION bị xóa.
+
+    def record_api_usage_event(self, api_key: str, user_id: str = None, latency_ms: float = None,
+                               prompt_tokens: int = None, completion_tokens: int = None,
+                               stream: bool = False, cached: bool = False) -> bool:
+        """
+        Ghi nhận một request chat công khai (qua bộ đệm write-behind, ghi theo lô)
+        
+        Args:
+            api_key (str): API key được sử dụng
+            user_id (str, optional): ID của người dùng từ ứng dụng tích hợp
+            latency_ms (float, optional): Thời gian tạo phản hồi (ms)
+            prompt_tokens (int, optional): Số token đầu vào
+            completion_tokens (int, optional): Số token phản hồi
+            stream (bool): Request dạng stream
+            cached (bool): Phản hồi lấy từ bộ đệm (độ trễ không được tính vào thống kê độ trễ)
+            
+        Returns:
+            bool: True nếu thành công, False nếu thất bại
+        """
+        try:
+            self._buffer_write("api_usage_events", uuid.uuid4().hex, {
+                "api_key": api_key,
+                "user_id": user_id,
+                "timestamp": datetime.now(),
+                "latency_ms": latency_ms,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "stream": stream,
+                "cached": cached
+            })
+            
+            return True
+            
+        except Exception as e:
+            logger.error(f"Lỗi khi ghi nhận sự kiện sử dụng API: {str(e)}")
+            return False
+
+    def _merge_api_usage_events(self, old: Dict, new: Dict) -> Dict:
+        return new  # Mỗi sự kiện có khóa riêng, không gộp
+
+    def _usage_events_file(self, api_key: str, day: str) -> str:
+        """Đường dẫn file sự kiện sử dụng của một API key trong một ngày (lưu trữ file)"""
+        return os.path.join(self.data_dir, "api_usage_events", self._sanitize_filename(api_key), f"{day}.jsonl")
+
+    def _flush_api_usage_events(self, entries: Dict[str, Dict]) -> None:
+        """
+        Ghi các sự kiện sử dụng API đang chờ theo lô và xóa sự kiện quá hạn
+        
+        Sự kiện đã ghi được bỏ khỏi entries ngay sau khi ghi, nên khi có lỗi chỉ các sự kiện chưa ghi
+        được đưa lại vào bộ đệm (không ghi trùng). Thống kê tổng được cộng riêng, chỉ từ các sự kiện đã ghi.
+        """
+        event_keys = list(entries.keys())
+        events = list(entries.values())
+        cutoff = datetime.now() - USAGE_EVENT_RETENTION
+        committed = []
+        
+        try:
+            if self.storage_type == "mongodb":
+                # Time-series collection tự xóa sự kiện quá hạn qua TTL
+                try:
+                    self._mongo_db("telemetry").api_usage_events.insert_many(
+                        [dict(event) for event in events], ordered=False
+                    )
+                    failed = set()
+                except BulkWriteError as e:
+                    failed = {error["index"] for error in e.details.get("writeErrors", [])}
+                    if len(failed) == len(events):
+                        raise
+                
+                for index, event_key in enumerate(event_keys):
+                    if index not in failed:
+                        committed.append(entries.pop(event_key))
+                
+                if failed:
+                    raise RuntimeError(f"{len(failed)}/{len(events)} sự kiện sử dụng API chưa được ghi")
+            
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    conn.executemany(
+                        "INSERT INTO api_usage_events "
+                        "(api_key, user_id, timestamp, latency_ms, prompt_tokens, completion_tokens, stream, cached) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            (event["api_key"], event["user_id"], event["timestamp"].isoformat(), event["latency_ms"],
+                             event["prompt_tokens"], event["completion_tokens"], int(event["stream"]),
+                             int(event.get("cached", False)))
+                            for event in events
+                        ]
+                    )
+                    conn.execute("DELETE FROM api_usage_events WHERE timestamp < ?", (cutoff.isoformat(),))
+                
+                # Đã commit: không đưa lại vào bộ đệm nếu phần sau bị lỗi
+                committed = [entries.pop(event_key) for event_key in event_keys]
+            
+            else:
+                # Lưu trữ file - mỗi (API key, ngày) một lần append
+                event_files = {}
+                for event_key, event in entries.items():
+                    event_file = self._usage_events_file(event["api_key"], event["timestamp"].strftime("%Y-%m-%d"))
+                    event_files.setdefault(event_file, []).append(event_key)
+                
+                for event_file, event_keys in event_files.items():
+                    os.makedirs(os.path.dirname(event_file), exist_ok=True)
+                    self._append_jsonl(event_file, [
+                        dict(entries[event_key], timestamp=entries[event_key]["timestamp"].isoformat())
+                        for event_key in event_keys
+                    ])
+                    
+                    # Đã ghi xong: không đưa lại vào bộ đệm nếu phần sau bị lỗi
+                    for event_key in event_keys:
+                        committed.append(entries.pop(event_key))
+                
+                # Xóa file (và file khóa) của các ngày quá hạn
+                cutoff_day = cutoff.strftime("%Y-%m-%d")
+                for key_dir in {os.path.dirname(event_file) for event_file in event_files}:
+                    for file_name in os.listdir(key_dir):
+                        if file_name.split(".", 1)[0] < cutoff_day:
+                            try:
+                                os.remove(os.path.join(key_dir, file_name))
+                            except FileNotFoundError:
+                                pass
+        finally:
+            # Cộng số request vào thống kê tổng (chỉ các sự kiện đã ghi, kể cả khi phần còn lại lỗi)
+            self._record_usage_totals(self._usage_event_totals(committed))
+
+    def _usage_event_totals(self, events: List[Dict]) -> Dict[str, Dict]:
+        """Số request và thời điểm request cuối của từng API key trong các sự kiện (cho _record_usage_totals)"""
+        totals = {}
+        for event in events:
+            total = totals.setdefault(event["api_key"], {
+                "requests": 0, "new_users": 0, "last_request": event["timestamp"]
+            })
+            total["requests"] += 1
+            total["last_request"] = max(total["last_request"], event["timestamp"])
+        return totals
+
+    def _new_usage_aggregate(self) -> Dict[str, Any]:
+        """Tổng hợp rỗng của một API key trên một khoảng thời gian (dùng chung cho sự kiện và bucket)"""
+        return {
+            "requests": 0, "users": set(), "last_request": None,
+            "latency_ms_total": 0.0, "latency_count": 0, "prompt_tokens": 0, "completion_tokens": 0
+        }
+
+    def _add_usage_event(self, aggregate: Dict[str, Any], event: Dict) -> None:
+        """Cộng một sự kiện sử dụng (timestamp dạng ISO) vào tổng hợp"""
+        aggregate["requests"] += 1
+        if event.get("user_id"):
+            aggregate["users"].add(event["user_id"])
+        aggregate["last_request"] = max(aggregate["last_request"] or "", event["timestamp"])
+        # Phản hồi từ bộ đệm không gọi mô hình: không tính vào độ trễ
+        if event.get("latency_ms") is not None and not event.get("cached"):
+            aggregate["latency_ms_total"] += event["latency_ms"]
+            aggregate["latency_count"] += 1
+        aggregate["prompt_tokens"] += event.get("prompt_tokens") or 0
+        aggregate["completion_tokens"] += event.get("completion_tokens") or 0
+
+    def _merge_usage_aggregate(self, aggregate: Dict[str, Any], other: Dict[str, Any]) -> None:
+        """Gộp tổng hợp other vào aggregate (người dùng được hợp theo tập)"""
+        for field in ("requests", "latency_ms_total", "latency_count", "prompt_tokens", "completion_tokens"):
+            aggregate[field] += other[field] or 0
+        aggregate["users"] |= set(other["users"])
+        aggregate["last_request"] = max(aggregate["last_request"] or "", other["last_request"] or "") or None
+
+    def _iter_usage_events(self, api_key: Optional[str], since: datetime, until: Optional[datetime] = None):
+        """Đọc các sự kiện sử dụng trong khoảng [since, until) (SQLite và lưu trữ file, timestamp dạng ISO)"""
+        since_iso = since.isoformat()
+        until_iso = until.isoformat() if until else None
+        
+        if self.storage_type == "sqlite":
+            where = "timestamp >= ?"
+            params = [since_iso]
+            if until_iso:
+                where += " AND timestamp < ?"
+                params.append(until_iso)
+            if api_key:
+                where += " AND api_key = ?"
+                params.append(api_key)
+            
+            cursor = self._sqlite_conn().execute(
+                "SELECT api_key, user_id, timestamp, latency_ms, prompt_tokens, completion_tokens, cached "
+                f"FROM api_usage_events WHERE {where}",
+                params
+            )
+            for row in cursor:
+                yield dict(row)
+        else:
+            # Lưu trữ file - chỉ đọc file của các ngày trong khoảng thời gian
+            events_dir = os.path.join(self.data_dir, "api_usage_events")
+            if api_key:
+                key_dirs = [os.path.join(events_dir, self._sanitize_filename(api_key))]
+            else:
+                key_dirs = [os.path.join(events_dir, d) for d in os.listdir(events_dir)]
+            
+            since_day = since.strftime("%Y-%m-%d")
+            until_day = until.strftime("%Y-%m-%d") if until else None
+            
+            for key_dir in key_dirs:
+                if not os.path.isdir(key_dir):
+                    continue
+                
+                for file_name in sorted(os.listdir(key_dir)):
+                    day = file_name[:-len(".jsonl")]
+                    if not file_name.endswith(".jsonl") or day < since_day or (until_day and day > until_day):
+                        continue
+                    
+                    for event in self._iter_messages(os.path.join(key_dir, file_name)):
+                        if event["timestamp"] >= since_iso and (not until_iso or event["timestamp"] < until_iso):
+                            yield event
+
+    def _get_usage_event_aggregates(self, api_key: Optional[str], since: datetime,
+                                    until: Optional[datetime] = None) -> Dict[str, Dict]:
+        """
+        Tổng hợp trực tiếp các sự kiện sử dụng trong khoảng [since, until) theo API key
+        
+        Returns:
+            Dict[str, Dict]: {api_key: tổng hợp (xem _new_usage_aggregate)}
+        """
+        aggregates = {}
+        
+        if self.storage_type == "mongodb":
+            timestamp = {"$gte": since}
+            if until:
+                timestamp["$lt"] = until
+            match = {"timestamp": timestamp}
+            if api_key:
+                match["api_key"] = api_key
+            
+            for doc in self.db.api_usage_events.aggregate([
+                {"$match": match},
+                {"$group": dict(_id="$api_key", **self._usage_group_fields())}
+            ]):
+                aggregates[doc["_id"]] = self._usage_aggregate_from_doc(doc)
+        else:
+            for event in self._iter_usage_events(api_key, since, until):
+                aggregate = aggregates.setdefault(event["api_key"], self._new_usage_aggregate())
+                self._add_usage_event(aggregate, event)
+        
+        return aggregates
+
+    # --- Bucket thống kê sử dụng theo giờ/ngày (usage_rollups) ---
+    # Tác vụ nền (rollup_usage_events) định kỳ tổng hợp các giờ đã kết thúc của api_usage_events
+    # thành bucket theo giờ và theo ngày cho mỗi API key, và lưu mốc rolled_until. Thống kê theo
+    # khoảng thời gian đọc các bucket trước mốc này, chỉ tổng hợp trực tiếp các sự kiện còn lại
+    # (phần đầu khoảng chưa trọn giờ và phần sau rolled_until).
+
+    def _usage_group_fields(self) -> Dict[str, Any]:
+        """Các trường $group tổng hợp sự kiện sử dụng (MongoDB)"""
+        return {
+            "requests": {"$sum": 1},
+            "users": {"$addToSet": "$user_id"},
+            "last_request": {"$max": "$timestamp"},
+            # Phản hồi từ bộ đệm không gọi mô hình: không tính vào độ trễ
+            "latency_ms_total": {"$sum": {"$cond": [{"$eq": ["$cached", True]}, 0, "$latency_ms"]}},
+            "latency_count": {"$sum": {"$cond": [
+                {"$and": [{"$isNumber": "$latency_ms"}, {"$ne": ["$cached", True]}]}, 1, 0
+            ]}},
+            "prompt_tokens": {"$sum": "$prompt_tokens"},
+            "completion_tokens": {"$sum": "$completion_tokens"}
+        }
+
+    def _usage_aggregate_from_doc(self, doc: Dict) -> Dict[str, Any]:
+        """Chuyển document tổng hợp/bucket (MongoDB) thành tổng hợp"""
+        return {
+            "requests": doc["requests"],
+            "users": {user_id for user_id in doc["users"] if user_id},
+            "last_request": doc["last_request"].isoformat() if doc.get("last_request") else None,
+            "latency_ms_total": doc["latency_ms_total"],
+            "latency_count": doc["latency_count"],
+            "prompt_tokens": doc["prompt_tokens"],
+            "completion_tokens": doc["completion_tokens"]
+        }
+
+    def _usage_bucket_start(self, timestamp: datetime, granularity: str) -> datetime:
+        """Thời điểm bắt đầu bucket giờ/ngày chứa timestamp"""
+        bucket = timestamp.replace(minute=0, second=0, microsecond=0)
+        return bucket.replace(hour=0) if granularity == "day" else bucket
+
+    def _usage_rollups_state_file(self) -> str:
+        """Đường dẫn file lưu mốc rolled_until (lưu trữ file)"""
+        return os.path.join(self.data_dir, "usage_rollups_state.json")
+
+    def _usage_bucket_rollups_file(self, api_key: str) -> str:
+        """Đường dẫn file bucket giờ/ngày của một API key (lưu trữ file)"""
+        return os.path.join(self.data_dir, "usage_rollups", f"{self._sanitize_filename(api_key)}.json")
+
+    def _get_usage_rolled_until(self) -> Optional[datetime]:
+        """Mốc thời gian mà các sự kiện trước đó đã được tổng hợp vào bucket (None nếu chưa chạy)"""
+        if self.storage_type == "mongodb":
+            state = self.db.usage_rollup_state.find_one({"_id": "api_usage_events"})
+            return state["rolled_until"] if state else None
+        elif self.storage_type == "sqlite":
+            row = self._sqlite_conn().execute(
+                "SELECT rolled_until FROM usage_rollup_state WHERE name = 'api_usage_events'"
+            ).fetchone()
+            return datetime.fromisoformat(row["rolled_until"]) if row else None
+        else:
+            state = self._read_json_file(self._usage_rollups_state_file())
+            return datetime.fromisoformat(state["rolled_until"]) if state else None
+
+    def rollup_usage_events(self) -> bool:
+        """
+        Tổng hợp các giờ đã kết thúc của sự kiện sử dụng vào bucket theo giờ/ngày
+        (tính lại toàn bộ bucket bị ảnh hưởng nên chạy lặp lại hoặc song song giữa các worker vẫn đúng)
+        
+        Returns:
+            bool: True nếu thành công, False nếu thất bại
+        """
+        try:
+            now = datetime.now()
+            
+            # Chỉ tổng hợp các giờ đã kết thúc, chừa thời gian cho sự kiện còn trong bộ đệm write-behind
+            rolled_until = self._usage_bucket_start(now - USAGE_ROLLUP_GRACE, "hour")
+            previous = self._get_usage_rolled_until()
+            hour_start = previous or self._usage_bucket_start(now - USAGE_EVENT_RETENTION, "day")
+            
+            if rolled_until <= hour_start:
+                return True
+            
+            # Bucket ngày được tính lại từ đầu ngày để luôn đầy đủ
+            day_start = self._usage_bucket_start(hour_start, "day")
+            ranges = {"hour": hour_start, "day": day_start}
+            retentions = {"hour": USAGE_HOURLY_RETENTION, "day": USAGE_DAILY_RETENTION}
+            
+            if self.storage_type == "mongodb":
+                events = self._mongo_db("telemetry").api_usage_events
+                
+                for granularity, start in ranges.items():
+                    events.aggregate([
+                        {"$match": {"timestamp": {"$gte": start, "$lt": rolled_until}}},
+                        {"$group": dict(
+                            _id={
+                                "api_key": "$api_key",
+                                "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": granularity}}
+                            },
+                            **self._usage_group_fields()
+                        )},
+                        {"$project": {
+                            "_id": 0,
+                            "api_key": "$_id.api_key",
+                            "granularity": {"$literal": granularity},
+                            "bucket": "$_id.bucket",
+                            "requests": 1,
+                            "users": {"$setDifference": ["$users", [None]]},
+                            "last_request": 1,
+                            "latency_ms_total": 1,
+                            "latency_count": 1,
+                            "prompt_tokens": 1,
+                            "completion_tokens": 1,
+                            "expires_at": {"$add": ["$_id.bucket", int(retentions[granularity].total_seconds() * 1000)]}
+                        }},
+                        {"$merge": {
+                            "into": "usage_rollups",
+                            "on": ["api_key", "granularity", "bucket"],
+                            "whenMatched": "replace",
+                            "whenNotMatched": "insert"
+                        }}
+                    ])
+                
+                self._mongo_db("telemetry").usage_rollup_state.update_one(
+                    {"_id": "api_usage_events"},
+                    {"$max": {"rolled_until": rolled_until}},
+                    upsert=True
+                )
+                return True
+            
+            # SQLite và lưu trữ file: tổng hợp trong bộ nhớ rồi thay thế các bucket
+            buckets = {}
+            for event in self._iter_usage_events(None, day_start, rolled_until):
+                timestamp = datetime.fromisoformat(event["timestamp"])
+                for granularity, start in ranges.items():
+                    if timestamp < start:
+                        continue
+                    bucket = self._usage_bucket_start(timestamp, granularity).isoformat()
+                    aggregate = buckets.setdefault((event["api_key"], granularity, bucket), self._new_usage_aggregate())
+                    self._add_usage_event(aggregate, event)
+            
+            if self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO usage_rollups (api_key, granularity, bucket, requests, users, "
+                        "last_request, latency_ms_total, latency_count, prompt_tokens, completion_tokens) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            (api_key, granularity, bucket, a["requests"], json.dumps(sorted(a["users"])),
+                             a["last_request"], a["latency_ms_total"], a["latency_count"],
+                             a["prompt_tokens"], a["completion_tokens"])
+                            for (api_key, granularity, bucket), a in buckets.items()
+                        ]
+                    )
+                    
+                    # Xóa các bucket quá hạn
+                    for granularity, retention in retentions.items():
+                        conn.execute(
+                            "DELETE FROM usage_rollups WHERE granularity = ? AND bucket < ?",
+                            (granularity, (now - retention).isoformat())
+                        )
+                    
+                    conn.execute(
+                        "INSERT INTO usage_rollup_state (name, rolled_until) VALUES ('api_usage_events', ?) "
+                        "ON CONFLICT (name) DO UPDATE SET rolled_until = MAX(rolled_until, excluded.rolled_until)",
+                        (rolled_until.isoformat(),)
+                    )
+            else:
+                # Lưu trữ file - mỗi API key một file, ghi một lần cho mỗi lượt tổng hợp
+                key_buckets = {}
+                for (api_key, granularity, bucket), aggregate in buckets.items():
+                    key_buckets.setdefault(api_key, {}).setdefault(granularity, {})[bucket] = aggregate
+                
+                for api_key, granularities in key_buckets.items():
+                    def apply_buckets(rollups, granularities=granularities):
+                        for granularity, retention in retentions.items():
+                            cutoff = (now - retention).isoformat()
+                            entries = {
+                                bucket: entry for bucket, entry in rollups[granularity].items() if bucket >= cutoff
+                            }
+                            for bucket, aggregate in granularities.get(granularity, {}).items():
+                                entries[bucket] = dict(aggregate, users=sorted(aggregate["users"]))
+                            rollups[granularity] = entries
+                        return rollups, True
+                    
+                    self._update_json_file(
+                        self._usage_bucket_rollups_file(api_key), apply_buckets,
+                        default={"api_key": api_key, "hour": {}, "day": {}}, indent=None
+                    )
+                
+                def advance(state):
+                    if state.get("rolled_until", "") >= rolled_until.isoformat():
+                        return state, False
+                    state["rolled_until"] = rolled_until.isoformat()
+                    return state, True
+                
+                self._update_json_file(self._usage_rollups_state_file(), advance, default={})
+            
+            return True
+            
+        except Exception as e:
+            logger.error(f"Lỗi khi tổng hợp bucket thống kê sử dụng API: {str(e)}")
+            return False
+
+    def _get_usage_rollup_aggregates(self, api_key: Optional[str], granularity: str,
+                                     start: datetime, end: datetime) -> Dict[str, Dict]:
+        """
+        Gộp các bucket giờ/ngày trong khoảng [start, end) theo API key
+        
+        Returns:
+            Dict[str, Dict]: {api_key: tổng hợp (xem _new_usage_aggregate)}
+        """
+        aggregates = {}
+        
+        if self.storage_type == "mongodb":
+            query = {"granularity": granularity, "bucket": {"$gte": start, "$lt": end}}
+            if api_key:
+                query["api_key"] = api_key
+            
+            for doc in self.db.usage_rollups.find(query):
+                aggregate = aggregates.setdefault(doc["api_key"], self._new_usage_aggregate())
+                self._merge_usage_aggregate(aggregate, self._usage_aggregate_from_doc(doc))
+                
+        elif self.storage_type == "sqlite":
+            where = "granularity = ? AND bucket >= ? AND bucket < ?"
+            params = [granularity, start.isoformat(), end.isoformat()]
+            if api_key:
+                where += " AND api_key = ?"
+                params.append(api_key)
+            
+            for row in self._sqlite_conn().execute(f"SELECT * FROM usage_rollups WHERE {where}", params):
+                aggregate = aggregates.setdefault(row["api_key"], self._new_usage_aggregate())
+                self._merge_usage_aggregate(aggregate, dict(row, users=json.loads(row["users"])))
+                
+        else:
+            rollups_dir = os.path.join(self.data_dir, "usage_rollups")
+            if api_key:
+                rollup_files = [self._usage_bucket_rollups_file(api_key)]
+            else:
+                rollup_files = [os.path.join(rollups_dir, f) for f in os.listdir(rollups_dir) if f.endswith(".json")]
+            
+            start_iso, end_iso = start.isoformat(), end.isoformat()
+            for rollup_file in rollup_files:
+                rollups = self._read_json_file(rollup_file)
+                if not rollups:
+                    continue
+                
+                for bucket, entry in rollups[granularity].items():
+                    if start_iso <= bucket < end_iso:
+                        aggregate = aggregates.setdefault(rollups["api_key"], self._new_usage_aggregate())
+                        self._merge_usage_aggregate(aggregate, entry)
+        
+        return aggregates
+
+    def _get_usage_event_summary(self, api_key: Optional[str], since: datetime) -> Dict[str, Dict]:
+        """
+        Thống kê sử dụng từ thời điểm since theo API key: các bucket đã tổng hợp trước rolled_until
+        (bucket ngày cho các ngày trọn vẹn, bucket giờ cho phần còn lại) cộng với các sự kiện chưa
+        được tổng hợp (phần đầu chưa trọn giờ và phần sau rolled_until)
+        
+        Args:
+            api_key (str, optional): API key cụ thể hoặc tất cả
+            since (datetime): Thời điểm bắt đầu
+            
+        Returns:
+            Dict[str, Dict]: {api_key: {"requests", "users" (số người dùng khác nhau), "last_request",
+                "avg_latency_ms", "prompt_tokens", "completion_tokens"}}
+        """
+        rolled_until = self._get_usage_rolled_until()
+        first_hour = self._usage_bucket_start(since, "hour")
+        if first_hour < since:
+            first_hour += timedelta(hours=1)
+        
+        segments = []  # (nguồn, bắt đầu, kết thúc)
+        if not rolled_until or rolled_until <= first_hour:
+            segments.append(("events", since, None))
+        else:
+            first_day = self._usage_bucket_start(first_hour, "day")
+            if first_day < first_hour:
+                first_day += timedelta(days=1)
+            last_day = self._usage_bucket_start(rolled_until, "day")
+            
+            segments.append(("events", since, first_hour))
+            if first_day < last_day:
+                segments.append(("hour", first_hour, first_day))
+                segments.append(("day", first_day, last_day))
+                segments.append(("hour", last_day, rolled_until))
+            else:
+                segments.append(("hour", first_hour, rolled_until))
+            segments.append(("events", rolled_until, None))
+        
+        aggregates = {}
+        for source, start, end in segments:
+            if end is not None and start >= end:
+                continue
+            
+            if source == "events":
+                parts = self._get_usage_event_aggregates(api_key, start, end)
+            else:
+                parts = self._get_usage_rollup_aggregates(api_key, source, start, end)
+            
+            for key, part in parts.items():
+                self._merge_usage_aggregate(aggregates.setdefault(key, self._new_usage_aggregate()), part)
+        
+        return {
+            key: {
+                "requests": a["requests"],
+                "users": len(a["users"]),
+                "last_request": a["last_request"],
+                "avg_latency_ms": round(a["latency_ms_total"] / a["latency_count"], 1) if a["latency_count"] else None,
+                "prompt_tokens": a["prompt_tokens"],
+                "completion_tokens": a["completion_tokens"]
+            }
+            for key, a in aggregates.items()
+        }
+
+    # --- Thống kê sử dụng API tổng (bucket "all") ---
+    # Tổng số request và số người dùng từ trước tới nay của mỗi API key, không bị giới hạn
+    # bởi thời gian giữ sự kiện.
+
+    def _usage_rollups_file(self, api_key: str) -> str:
+        """Đường dẫn file thống kê sử dụng của một API key (lưu trữ file)"""
+        return os.path.join(self.data_dir, "api_usage", f"{self._sanitize_filename(api_key)}.json")
+
+    def _record_usage_totals(self, totals: Dict[str, Dict]) -> None:
+        """Cộng số request và số người dùng mới của từng API key vào bucket "all" """
+        if not totals:
+            return
+        
+        try:
+            if self.storage_type == "mongodb":
+                self._mongo_db("telemetry").api_usage_rollups.bulk_write([
+                    UpdateOne(
+                        {"api_key": api_key, "granularity": "all", "bucket": None},
+                        {
+                            "$inc": {"requests": total["requests"], "user_count": total["new_users"]},
+                            "$max": {"last_request": total["last_request"]}
+                        },
+                        upsert=True
+                    )
+                    for api_key, total in totals.items()
+                ], ordered=False)
+                
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    conn.executemany(
+                        """
+                        INSERT INTO api_usage_rollups (api_key, granularity, bucket, requests, user_count, last_request)
+                        VALUES (?, 'all', 'all', ?, ?, ?)
+                        ON CONFLICT (api_key, granularity, bucket) DO UPDATE SET
+                            requests = requests + excluded.requests,
+                            user_count = user_count + excluded.user_count,
+                            last_request = MAX(COALESCE(last_request, ''), excluded.last_request)
+                        """,
+                        [
+                            (api_key, total["requests"], total["new_users"], total["last_request"].isoformat())
+                            for api_key, total in totals.items()
+                        ]
+                    )
+                
+            else:
+                # Lưu trữ file - mỗi API key một file
+                for api_key, total in totals.items():
+                    def apply_total(rollups, total=total):
+                        # Bỏ các bucket theo giờ/ngày cũ
+                        rollups.pop("hour", None)
+                        rollups.pop("day", None)
+                        
+                        rollups["all"]["requests"] += total["requests"]
+                        rollups["all"]["user_count"] += total["new_users"]
+                        rollups["all"]["last_request"] = max(
+                            rollups["all"]["last_request"] or "", total["last_request"].isoformat()
+                        )
+                        return rollups, True
+                    
+                    self._update_json_file(
+                        self._usage_rollups_file(api_key), apply_total,
+                        default=self._empty_usage_rollups(api_key), indent=None
+                    )
+        except Exception as e:
+            # Không đưa lại lô vào bộ đệm: sự kiện/api_users đã được ghi, thử lại sẽ đếm trùng
+            logger.error(f"Lỗi khi cập nhật thống kê sử dụng API: {str(e)}")
+
+    def _empty_usage_rollups(self, api_key: str) -> Dict:
+        """Dữ liệu thống kê rỗng của một API key (lưu trữ file)"""
+        return {
+            "api_key": api_key,
+            "all": {"requests": 0, "user_count": 0, "last_request": None}
+        }
+
+    def _get_usage_totals(self, api_key: Optional[str]) -> Dict[str, Dict]:
+        """
+        Lấy thống kê tổng (bucket "all") theo API key
+        
+        Args:
+            api_key (str, optional): API key cụ thể hoặc tất cả
+            
+        Returns:
+            Dict[str, Dict]: {api_key: {"requests", "users", "last_request"}}
+        """
+        summary = {}
+        
+        if self.storage_type == "mongodb":
+            match = {"granularity": "all"}
+            if api_key:
+                match["api_key"] = api_key
+            
+            for doc in self.db.api_usage_rollups.find(match):
+                summary[doc["api_key"]] = {
+                    "requests": doc.get("requests", 0),
+                    "users": doc.get("user_count", 0),
+                    "last_request": doc["last_request"].isoformat() if doc.get("last_request") else None
+                }
+                    
+        elif self.storage_type == "sqlite":
+            where = "granularity = 'all'"
+            params = []
+            if api_key:
+                where += " AND api_key = ?"
+                params.append(api_key)
+            
+            for row in self._sqlite_conn().execute(
+                "SELECT api_key, requests, user_count AS users, last_request "
+                f"FROM api_usage_rollups WHERE {where}",
+                params
+            ).fetchall():
+                summary[row["api_key"]] = {
+                    "requests": row["requests"],
+                    "users": row["users"],
+                    "last_request": row["last_request"]
+                }
+                
+        else:
+            # Lưu trữ file
+            usage_dir = os.path.join(self.data_dir, "api_usage")
+            if api_key:
+                rollup_files = [self._usage_rollups_file(api_key)]
+            else:
+                rollup_files = [
+                    os.path.join(usage_dir, f) for f in os.listdir(usage_dir)
+                    if f.endswith(".json")
+                ]
+            
+            for rollup_file in rollup_files:
+                rollups = self._read_json_file(rollup_file)
+                if not rollups:
+                    continue
+                
+                total = rollups["all"]
+                summary[rollups["api_key"]] = {
+                    "requests": total["requests"],
+                    "users": total["user_count"],
+                    "last_request": total["last_request"]
+                }
+        
+        return summary
+
+    def _seed_usage_rollups(self) -> None:
+        """
+        Khởi tạo bucket "all" từ dữ liệu api_users có sẵn (chỉ chạy khi chưa có thống kê),
+        để tổng số request/người dùng trước khi có bucket không bị mất
+        """
+        try:
+            if self.storage_type == "mongodb":
+                if self.db.api_usage_rollups.count_documents({}, limit=1):
+                    return
+                
+                for row in self.db.api_users.aggregate([{"$group": {
+                    "_id": "$api_key",
+                    "requests": {"$sum": "$total_requests"},
+                    "user_count": {"$sum": 1},
+                    "last_request": {"$max": "$last_active"}
+                }}]):
+                    self.db.api_usage_rollups.update_one(
+                        {"api_key": row["_id"], "granularity": "all", "bucket": None},
+                        {"$setOnInsert": {
+                            "requests": row["requests"],
+                            "user_count": row["user_count"],
+                            "last_request": row["last_request"]
+                        }},
+                        upsert=True
+                    )
+                    
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    if conn.execute("SELECT 1 FROM api_usage_rollups LIMIT 1").fetchone():
+                        return
+                    
+                    conn.execute(
+                        "INSERT OR IGNORE INTO api_usage_rollups "
+                        "(api_key, granularity, bucket, requests, user_count, last_request) "
+                        "SELECT api_key, 'all', 'all', SUM(total_requests), COUNT(*), MAX(last_active) "
+                        "FROM api_users GROUP BY api_key"
+                    )
+                    
+            else:
+                api_users_dir = os.path.join(self.data_dir, "api_users")
+                
+                for dir_name in os.listdir(api_users_dir):
+                    api_key_dir = os.path.join(api_users_dir, dir_name)
+                    if not os.path.isdir(api_key_dir):
+                        continue
+                    
+                    # Tên thư mục là API key đã làm sạch, trùng tên file thống kê: bỏ qua key đã khởi tạo
+                    # trước khi đọc bất kỳ file người dùng nào
+                    rollup_file = os.path.join(self.data_dir, "api_usage", f"{dir_name}.json")
+                    if os.path.exists(rollup_file):
+                        continue
+                    
+                    user_files = [
+                        f for f in os.listdir(api_key_dir)
+                        if f.endswith('.json') and f != "_summary.json"
+                    ]
+                    if not user_files:
+                        continue
+                    
+                    api_key = self._read_json_file(os.path.join(api_key_dir, user_files[0])).get("api_key", dir_name)
+                    
+                    # _summary.json đã có tổng số người dùng/request; chỉ đọc từng người dùng khi thiếu
+                    summary = self._read_json_file(os.path.join(api_key_dir, "_summary.json"))
+                    if summary:
+                        totals = {
+                            "requests": summary.get("total_requests", 0),
+                            "user_count": summary.get("total_users", 0),
+                            "last_request": summary.get("last_updated")
+                        }
+                    else:
+                        users = [self._read_json_file(os.path.join(api_key_dir, f)) for f in user_files]
+                        totals = {
+                            "requests": sum(user.get("total_requests", 0) for user in users),
+                            "user_count": len(users),
+                            "last_request": max(user["last_active"] for user in users)
+                        }
+                    
+                    def seed(rollups, totals=totals):
+                        # Chỉ khởi tạo nếu chưa có tiến trình nào khác ghi trước
+                        if rollups["all"]["requests"] == 0:
+                            rollups["all"] = totals
+                        return rollups, True
+                    
+                    self._update_json_file(rollup_file, seed, default=self._empty_usage_rollups(api_key), indent=None)
+        except Exception as e:
+            logger.error(f"Lỗi khi khởi tạo thống kê sử dụng API: {str(e)}")
+
+    # --- Index conversation_id -> username cho lưu trữ file ---
+
+    def _conversation_index_file(self, conversation_id: str) -> str:
+        """Đường dẫn file index của một hội thoại"""
+        return os.path.join(
+            self.data_dir, "conversation_index", f"{self._sanitize_filename(conversation_id)}.json"
+        )
+
+    def _index_conversation_owner(self, conversation_id: str, username: str) -> None:
+        """Ghi (atomic) chủ sở hữu của hội thoại vào index"""
+        self._atomic_write_json(
+            self._conversation_index_file(conversation_id), {"username": username}, indent=None
+        )
+
+    def _find_conversation_owner(self, conversation_id: str) -> Optional[str]:
+        """Tra cứu username sở hữu hội thoại qua index (không quét thư mục)"""
+        index_file = self._conversation_index_file(conversation_id)
+
+        try:
+            with open(index_file, "r", encoding="utf-8") as f:
+                return json.load(f).get("username")
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"Lỗi đọc index hội thoại {conversation_id}: {str(e)}")
+            return None
+
+    def _locate_conversation(self, conversation_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Xác định vị trí lưu trữ của hội thoại
+
+        Returns:
+            Tuple[Optional[str], Optional[str]]: (Thư mục người dùng, file metadata)
+            hoặc (None, None) nếu không tìm thấy
+        """
+        username = self._find_conversation_owner(conversation_id)
+        if not username:
+            return None, None
+
+        user_dir = os.path.join(self.data_dir, "conversations", username)
+        meta_file = os.path.join(user_dir, "metadata", f"{conversation_id}.json")
+
+        # Index có thể trỏ tới hội thoại chưa kịp ghi metadata (tiến trình dừng giữa chừng)
+        if not os.path.exists(meta_file):
+            return None, None
+
+        return user_dir, meta_file
+
+    def _rebuild_conversation_index(self) -> None:
+        """Dựng lại index conversation_id -> username từ thư mục metadata của từng người dùng"""
+        conversations_dir = os.path.join(self.data_dir, "conversations")
+        index_dir = os.path.join(self.data_dir, "conversation_index")
+        indexed = 0
+
+        for user_dir in os.listdir(conversations_dir):
+            meta_dir = os.path.join(conversations_dir, user_dir, "metadata")
+            if not os.path.isdir(meta_dir):
+                continue
+
+            for meta_file in os.listdir(meta_dir):
+                if not meta_file.endswith('.json'):
+                    continue
+
+                self._index_conversation_owner(meta_file[:-len('.json')], user_dir)
+                indexed += 1
+
+        # Đánh dấu index đã hoàn chỉnh
+        with open(os.path.join(index_dir, "_complete"), "w", encoding="utf-8") as f:
+            f.write(datetime.now().isoformat())
+
+        logger.info(f"Đã dựng lại index cho {indexed} hội thoại")
+
+    # --- Tiện ích cho file tin nhắn dạng JSONL (append-only) ---
+
+    def _get_messages_file(self, user_dir: str, conversation_id: str) -> str:
+        """
+        Lấy đường dẫn file tin nhắn (JSONL) của hội thoại
+
+        File cũ dạng mảng JSON (<conversation_id>.json) sẽ được tự động chuyển đổi
+        sang định dạng JSONL (<conversation_id>.jsonl) ở lần truy cập đầu tiên.
+        """
+        messages_file = os.path.join(user_dir, f"{conversation_id}.jsonl")
+        legacy_file = os.path.join(user_dir, f"{conversation_id}.json")
+
+        if not os.path.exists(messages_file) and os.path.exists(legacy_file):
+            with self._locked_file(messages_file):
+                # Kiểm tra lại sau khi có khóa: tiến trình khác có thể đã chuyển đổi xong
+                if not os.path.exists(messages_file) and os.path.exists(legacy_file):
+                    self._migrate_legacy_messages_file(legacy_file, messages_file)
+
+        return messages_file
+
+    def _migrate_legacy_messages_file(self, legacy_file: str, messages_file: str) -> None:
+        """Chuyển đổi file tin nhắn dạng mảng JSON sang JSONL (gọi khi đang giữ khóa)"""
+        with open(legacy_file, "r", encoding="utf-8") as f:
+            messages = json.load(f)
+
+        tmp_file = f"{messages_file}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                for message in messages:
+                    f.write(json.dumps(message, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_file, messages_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        os.remove(legacy_file)
+
+        logger.info(f"Đã chuyển đổi file tin nhắn sang JSONL: {messages_file}")
+
+    def _append_jsonl(self, jsonl_file: str, records: List[Dict]) -> None:
+        """Ghi thêm các bản ghi (tin nhắn, sự kiện) vào cuối file JSONL (một lần append + fsync cho cả lô)"""
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+
+        with self._locked_file(jsonl_file):
+            with open(jsonl_file, "a+b") as f:
+                # Nếu dòng cuối bị ghi dở (không có ký tự xuống dòng), tách dòng mới ra
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        data = b"\n" + data
+
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _parse_message_line(self, line: str, messages_file: str) -> Optional[Dict]:
+        """Giải mã một dòng JSONL thành tin nhắn (None nếu dòng rỗng hoặc bị ghi dở)"""
+        line = line.strip()
+        if not line:
+            return None
+
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            # Dòng bị ghi dở do tiến trình dừng đột ngột, bỏ qua
+            logger.warning(f"Bỏ qua dòng tin nhắn không hợp lệ trong {messages_file}")
+            return None
+
+        # Đảm bảo mỗi tin nhắn có trường id
+        if "_id" in message and "id" not in message:
+            message["id"] = message["_id"]
+
+        return message
+
+    def _iter_messages(self, messages_file: str):
+        """Đọc lần lượt từng tin nhắn trong file JSONL (không tải toàn bộ file)"""
+        if not os.path.exists(messages_file):
+            return
+
+        with open(messages_file, "r", encoding="utf-8") as f:
+            for line in f:
+                message = self._parse_message_line(line, messages_file)
+                if message is not None:
+                    yield message
+
+    def _iter_messages_reversed(self, messages_file: str, chunk_size: int = 65536):
+        """Đọc tin nhắn trong file JSONL từ cuối lên đầu, theo từng khối (chỉ đọc phần đuôi cần thiết)"""
+        if not os.path.exists(messages_file):
+            return
+
+        with open(messages_file, "rb") as f:
+            position = f.seek(0, os.SEEK_END)
+            remainder = b""
+
+            while position > 0:
+                read_size = min(chunk_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b"\n")
+
+                # Dòng đầu tiên có thể chưa đầy đủ, ghép với khối đọc tiếp theo
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    message = self._parse_message_line(line.decode("utf-8"), messages_file)
+                    if message is not None:
+                        yield message
+
+            message = self._parse_message_line(remainder.decode("utf-8"), messages_file)
+            if message is not None:
+                yield message
+
+    # --- Manifest danh sách hội thoại của từng người dùng (lưu trữ file) ---
+
+    def _manifest_file(self, user_dir: str) -> str:
+        """Đường dẫn file manifest của người dùng"""
+        return os.path.join(user_dir, "_manifest.json")
+
+    def _build_manifest_entry(self, user_dir: str, conversation_id: str) -> Optional[Dict]:
+        """Tạo bản ghi manifest cho một hội thoại từ metadata và file tin nhắn"""
+        meta_file = os.path.join(user_dir, "metadata", f"{conversation_id}.json")
+        if not os.path.exists(meta_file):
+            return None
+
+        with open(meta_file, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+
+        # Đảm bảo có trường id
+        if "_id" in entry and "id" not in entry:
+            entry["id"] = entry["_id"]
+
+        # Bản tóm tắt hội thoại chỉ nằm trong file metadata
+        entry.pop("summary", None)
+
+        entry["message_count"] = 0
+        entry["preview"] = ""
+
+        last_message = None
+        messages_file = self._get_messages_file(user_dir, conversation_id)
+        for message in itertools.chain(self._iter_archived_messages(messages_file), self._iter_messages(messages_file)):
+            entry["message_count"] += 1
+            last_message = message
+
+        if last_message:
+            self._set_manifest_last_message(entry, last_message)
+
+        return entry
+
+    def _set_manifest_last_message(self, entry: Dict, message: Dict) -> None:
+        """Ghi preview và tin nhắn cuối (nội dung rút gọn) vào bản ghi manifest"""
+        preview = message.get("content", "")[:100]
+        entry["preview"] = preview
+        entry["last_message"] = {
+            "id": message.get("id"),
+            "role": message.get("role"),
+            "content": preview,
+            "timestamp": message.get("timestamp")
+        }
+
+    def _collect_manifest_entries(self, user_dir: str) -> List[Dict]:
+        """Tạo danh sách bản ghi manifest từ toàn bộ metadata của người dùng"""
+        entries = []
+
+        meta_dir = os.path.join(user_dir, "metadata")
+        if os.path.exists(meta_dir):
+            for meta_file in os.listdir(meta_dir):
+                if not meta_file.endswith('.json'):
+                    continue
+
+                try:
+                    entry = self._build_manifest_entry(user_dir, meta_file[:-len('.json')])
+                    if entry:
+                        entries.append(entry)
+                except Exception as e:
+                    logger.error(f"Lỗi đọc file hội thoại khi dựng manifest: {str(e)}")
+
+        logger.info(f"Đã dựng lại manifest hội thoại: {user_dir}")
+        return entries
+
+    def _manifest_sort_key(self, entry: Dict) -> Tuple[str, str]:
+        """Khóa sắp xếp (updated_at, id) của bản ghi manifest, trùng với khóa của cursor phân trang"""
+        return entry.get("updated_at", entry.get("created_at", "")), entry.get("id", "")
+
+    def _sort_manifest_entries(self, entries: List[Dict]) -> List[Dict]:
+        """Sắp xếp bản ghi manifest theo (updated_at, id) giảm dần"""
+        entries.sort(key=self._manifest_sort_key, reverse=True)
+        return entries
+
+    def _load_conversation_manifest(self, user_dir: str, cache: bool = True) -> List[Dict]:
+        """
+        Đọc manifest hội thoại của người dùng (đã sắp xếp theo (updated_at, id) giảm dần,
+        lưu đệm trong bộ nhớ - chỉ đọc, không sửa trực tiếp)
+
+        Manifest được dựng lại từ metadata nếu chưa tồn tại hoặc bị hỏng.
+
+        Args:
+            user_dir (str): Thư mục của người dùng
+            cache (bool): Lưu đệm manifest (False cho các lượt quét toàn bộ người dùng)
+        """
+        manifest_file = self._manifest_file(user_dir)
+
+        try:
+            manifest = self._get_cached_json(manifest_file) if cache else self._read_json_file(manifest_file)
+        except json.JSONDecodeError as e:
+            logger.error(f"Manifest hội thoại không hợp lệ, dựng lại: {str(e)}")
+            manifest = None
+
+        if isinstance(manifest, dict) and isinstance(manifest.get("conversations"), list):
+            return manifest["conversations"]
+
+        return self._update_conversation_manifest_entries(user_dir, lambda entries, rebuilt: None)
+
+    def _update_conversation_manifest_entries(self, user_dir: str, modify) -> List[Dict]:
+        """
+        Sửa danh sách bản ghi manifest dưới khóa rồi ghi lại (đã sắp xếp)
+
+        Args:
+            user_dir (str): Thư mục của người dùng
+            modify (callable): Hàm nhận (danh sách bản ghi, cờ vừa dựng lại từ metadata)
+                và sửa trực tiếp trên danh sách
+
+        Returns:
+            List[Dict]: Danh sách bản ghi sau khi cập nhật
+        """
+        def mutator(manifest):
+            if isinstance(manifest, dict) and isinstance(manifest.get("conversations"), list):
+                entries, rebuilt = manifest["conversations"], False
+            else:
+                entries, rebuilt = self._collect_manifest_entries(user_dir), True
+
+            modify(entries, rebuilt)
+            self._sort_manifest_entries(entries)
+            return {"conversations": entries}, entries
+
+        return self._update_json_file(self._manifest_file(user_dir), mutator, indent=None)
+
+    def _update_conversation_manifest(self, user_dir: str, conversation_id: str,
+                                      fields: Dict = None, messages: List[Dict] = None) -> None:
+        """
+        Cập nhật bản ghi của một hội thoại trong manifest
+
+        Args:
+            user_dir (str): Thư mục của người dùng
+            conversation_id (str): ID hội thoại
+            fields (dict, optional): Các trường metadata đã thay đổi
+            messages (list, optional): Các tin nhắn vừa được thêm vào hội thoại
+        """
+        def modify(entries, rebuilt):
+            # Metadata và tin nhắn đã được ghi trước khi gọi hàm này, nên manifest
+            # vừa dựng lại (hoặc bản ghi mới dựng) đã phản ánh thay đổi
+            if rebuilt:
+                return
+
+            entry = next((e for e in entries if e.get("id") == conversation_id), None)
+
+            if entry is None:
+                entry = self._build_manifest_entry(user_dir, conversation_id)
+                if entry is not None:
+                    entries.append(entry)
+                return
+
+            if fields:
+                entry.update(fields)
+
+            if messages:
+                entry["message_count"] = entry.get("message_count", 0) + len(messages)
+                self._set_manifest_last_message(entry, messages[-1])
+
+        self._update_conversation_manifest_entries(user_dir, modify)
+
     def authenticate_user(self, username: str, password: str) -> bool:
         """Xác thực người dùng"""
         try:
@@ -190,31 +2672,36 @@ class StorageService:
                         {"_id": user["_id"]},
                         {"$set": {"last_login": datetime.now()}}
                     )
+                    self._invalidate_cached_entity("users", username)
                     return True
                 
                 return False
                 
-            else:
-                # Lưu trữ file
-                users_file = os.path.join(self.data_dir, "users", "users.json")
+            elif self.storage_type == "sqlite":
+                # Xác thực và cập nhật thời gian đăng nhập trong một câu lệnh
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute(
+                        "UPDATE users SET last_login = ? WHERE username = ? AND password = ?",
+                        (datetime.now().isoformat(), username, hashed_password)
+                    )
                 
-                if not os.path.exists(users_file):
+                if cursor.rowcount == 0:
                     return False
                 
-                with open(users_file, "r", encoding="utf-8") as f:
-                    users = json.load(f)
+                self._invalidate_cached_entity("users", username)
+                return True
                 
-                for i, user in enumerate(users):
-                    if user["username"] == username and user["password"] == hashed_password:
-                        # Cập nhật thời gian đăng nhập
-                        users[i]["last_login"] = datetime.now().isoformat()
-                        
-                        with open(users_file, "w", encoding="utf-8") as f:
-                            json.dump(users, f, ensure_ascii=False, indent=2)
-                        
-                        return True
+            else:
+                # Lưu trữ file - tra cứu trong bảng người dùng trong bộ nhớ
+                user = self._get_cached_user(username)
                 
-                return False
+                if not user or user["password"] != hashed_password:
+                    return False
+                
+                # Cập nhật thời gian đăng nhập (ghi xuống file sau, gộp theo lô)
+                self._buffer_write("last_login", username, datetime.now())
+                
+                return True
                 
         except Exception as e:
             logger.error(f"Lỗi khi xác thực người dùng: {str(e)}")
@@ -255,21 +2742,31 @@ class StorageService:
                 
                 return True, "Đăng ký thành công"
                 
-            else:
-                # Lưu trữ file
-                users_file = os.path.join(self.data_dir, "users", "users.json")
+            elif self.storage_type == "sqlite":
+                # Hash mật khẩu
+                hashed_password = self._hash_password(password)
+                
+                try:
+                    with self._sqlite_transaction() as conn:
+                        conn.execute(
+                            "INSERT INTO users (username, password, created_at, last_login, settings) "
+                            "VALUES (?, ?, ?, NULL, '{}')",
+                            (username, hashed_password, datetime.now().isoformat())
+                        )
+                except sqlite3.IntegrityError:
+                    # Khóa chính username đã tồn tại
+                    return False, "Tên đăng nhập đã tồn tại"
                 
-                # Tạo file mới nếu chưa tồn tại
-                if not os.path.exists(users_file):
-                    with open(users_file, "w", encoding="utf-8") as f:
-                        json.dump([], f)
+                logger.info(f"Đã tạo người dùng mới: {username}")
+                
+                return True, "Đăng ký thành công"
                 
-                # Đọc danh sách người dùng
-                with open(users_file, "r", encoding="utf-8") as f:
-                    users = json.load(f)
+            else:
+                # Lưu trữ file
+                users_file = self._users_file()
                 
-                # Kiểm tra tên đăng nhập đã tồn tại chưa
-                if any(user["username"] == username for user in users):
+                # Kiểm tra nhanh trong bộ nhớ (kiểm tra lại dưới khóa khi ghi)
+                if username in self._get_users_table():
                     return False, "Tên đăng nhập đã tồn tại"
                 
                 # Hash mật khẩu
@@ -284,11 +2781,17 @@ class StorageService:
                     "settings": {}
                 }
                 
-                users.append(user_data)
+                def add_user(users):
+                    # Kiểm tra tên đăng nhập đã tồn tại chưa (dưới khóa để tránh tạo trùng)
+                    if any(user["username"] == username for user in users):
+                        return users, False
+                    
+                    users.append(user_data)
+                    return users, True
                 
-                # Lưu lại danh sách người dùng
-                with open(users_file, "w", encoding="utf-8") as f:
-                    json.dump(users, f, ensure_ascii=False, indent=2)
+                # Lưu lại danh sách người dùng (tạo file mới nếu chưa tồn tại)
+                if not self._update_json_file(users_file, add_user, default=[]):
+                    return False, "Tên đăng nhập đã tồn tại"
                 
                 logger.info(f"Đã tạo người dùng mới: {username}")
                 
@@ -306,27 +2809,31 @@ class StorageService:
                     {"username": username},
                     {"$set": {"settings": settings}}
                 )
+                self._invalidate_cached_entity("users", username)
                 return result.modified_count > 0
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute(
+                        "UPDATE users SET settings = ? WHERE username = ?",
+                        (json.dumps(settings, ensure_ascii=False), username)
+                    )
+                self._invalidate_cached_entity("users", username)
+                return cursor.rowcount > 0
             else:
                 # Lưu trữ file
-                users_file = os.path.join(self.data_dir, "users", "users.json")
+                users_file = self._users_file()
                 
-                if not os.path.exists(users_file):
+                if username not in self._get_users_table():
                     return False
                 
-                with open(users_file, "r", encoding="utf-8") as f:
-                    users = json.load(f)
+                def apply_settings(users):
+                    for user in users:
+                        if user["username"] == username:
+                            user["settings"] = settings
+                            return users, True
+                    return users, False
                 
-                for i, user in enumerate(users):
-                    if user["username"] == username:
-                        users[i]["settings"] = settings
-                        
-                        with open(users_file, "w", encoding="utf-8") as f:
-                            json.dump(users, f, ensure_ascii=False, indent=2)
-                        
-                        return True
-                
-                return False
+                return self._update_json_file(users_file, apply_settings, default=[])
         except Exception as e:
             logger.error(f"Lỗi khi cập nhật cài đặt người dùng: {str(e)}")
             return False
@@ -335,28 +2842,32 @@ class StorageService:
         """Lấy thông tin người dùng (ngoại trừ mật khẩu)"""
         try:
             if self.storage_type == "mongodb":
-                user = self.db.users.find_one({"username": username}, {"password": 0})
-                if user:
-                    # Convert MongoDB _id to string for serialization
-                    return self._sanitize_mongodb_doc(user)
-                return None
+                def load_user():
+                    user = self.db.users.find_one({"username": username}, {"password": 0})
+                    if user:
+                        # Convert MongoDB _id to string for serialization
+                        return self._sanitize_mongodb_doc(user), user["_id"]
+                    return None, None
+                
+                return self._get_cached_entity("users", username, load_user)
+            elif self.storage_type == "sqlite":
+                def load_user():
+                    row = self._sqlite_conn().execute(
+                        "SELECT username, created_at, last_login, settings FROM users WHERE username = ?",
+                        (username,)
+                    ).fetchone()
+                    return self._sqlite_row_to_dict(row, json_fields=("settings",)), None
+                
+                return self._get_cached_entity("users", username, load_user)
             else:
-                # Lưu trữ file
-                users_file = os.path.join(self.data_dir, "users", "users.json")
+                # Lưu trữ file - tra cứu trong bảng người dùng trong bộ nhớ
+                user = self._get_cached_user(username)
                 
-                if not os.path.exists(users_file):
+                if not user:
                     return None
                 
-                with open(users_file, "r", encoding="utf-8") as f:
-                    users = json.load(f)
-                
-                for user in users:
-                    if user["username"] == username:
-                        # Không trả về mật khẩu
-                        user_info = {k: v for k, v in user.items() if k != "password"}
-                        return user_info
-                
-                return None
+                # Không trả về mật khẩu
+                return {k: v for k, v in user.items() if k != "password"}
         except Exception as e:
             logger.error(f"Lỗi khi lấy thông tin người dùng: {str(e)}")
             return None
@@ -375,24 +2886,28 @@ class StorageService:
                     {"username": username},
                     {"$set": {"password": hashed_new_password}}
                 )
+                self._invalidate_cached_entity("users", username)
                 return result.modified_count > 0
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute(
+                        "UPDATE users SET password = ? WHERE username = ?",
+                        (hashed_new_password, username)
+                    )
+                self._invalidate_cached_entity("users", username)
+                return cursor.rowcount > 0
             else:
                 # Lưu trữ file
-                users_file = os.path.join(self.data_dir, "users", "users.json")
+                users_file = self._users_file()
                 
-                with open(users_file, "r", encoding="utf-8") as f:
-                    users = json.load(f)
+                def apply_password(users):
+                    for user in users:
+                        if user["username"] == username:
+                            user["password"] = hashed_new_password
+                            return users, True
+                    return users, False
                 
-                for i, user in enumerate(users):
-                    if user["username"] == username:
-                        users[i]["password"] = hashed_new_password
-                        
-                        with open(users_file, "w", encoding="utf-8") as f:
-                            json.dump(users, f, ensure_ascii=False, indent=2)
-                        
-                        return True
-                        
-                return False
+                return self._update_json_file(users_file, apply_password, default=[])
         except Exception as e:
             logger.error(f"Lỗi khi thay đổi mật khẩu: {str(e)}")
             return False
@@ -411,6 +2926,12 @@ class StorageService:
             
             if self.storage_type == "mongodb":
                 self.db.conversations.insert_one(conversation_data)
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    conn.execute(
+                        "INSERT INTO conversation_log (username, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                        (username, role, content, timestamp.isoformat())
+                    )
             else:
                 # Lưu trữ file
                 # Sử dụng mô hình lưu trữ phân tách theo người dùng
@@ -421,17 +2942,13 @@ class StorageService:
                 month_key = timestamp.strftime("%Y-%m")
                 conversations_file = os.path.join(conversation_dir, f"{month_key}.json")
                 
-                if os.path.exists(conversations_file):
-                    with open(conversations_file, "r", encoding="utf-8") as f:
-                        conversations = json.load(f)
-                else:
-                    conversations = []
-                
                 conversation_data["timestamp"] = timestamp.isoformat()
-                conversations.append(conversation_data)
                 
-                with open(conversations_file, "w", encoding="utf-8") as f:
-                    json.dump(conversations, f, ensure_ascii=False, indent=2)
+                def append_entry(conversations):
+                    conversations.append(conversation_data)
+                    return conversations, True
+                
+                self._update_json_file(conversations_file, append_entry, default=[])
                     
             logger.info(f"Lưu tin nhắn thành công cho {username}")
             return True
@@ -440,64 +2957,6 @@ class StorageService:
             logger.error(f"Lỗi khi lưu tin nhắn: {str(e)}")
             return False
     
-    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
-        """
-        Lấy thông tin hội thoại
-        
-        Args:
-            conversation_id (str): ID hội thoại
-            
-        Returns:
-            Optional[Dict]: Thông tin hội thoại hoặc None nếu không tìm thấy
-        """
-        try:
-            if not conversation_id:
-                return None
-                
-            if self.storage_type == "mongodb":
-                try:
-                    obj_id = ObjectId(conversation_id) if isinstance(conversation_id, str) else conversation_id
-                except:
-                    return None
-                    
-                conversation = self.db.conversations.find_one({
-                    "_id": obj_id,
-                    "deleted": {"$ne": True}
-                })
-                
-                if not conversation:
-                    return None
-                
-                return self._sanitize_mongodb_doc(conversation)
-            else:
-                # Lưu trữ file - tìm trong tất cả người dùng
-                conversations_dir = os.path.join(self.data_dir, "conversations")
-                
-                # Tìm trong thư mục của tất cả người dùng
-                for user_dir in os.listdir(conversations_dir):
-                    if not os.path.isdir(os.path.join(conversations_dir, user_dir)):
-                        continue
-                    
-                    meta_dir = os.path.join(conversations_dir, user_dir, "metadata")
-                    if not os.path.exists(meta_dir):
-                        continue
-                    
-                    meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                    if os.path.exists(meta_file):
-                        with open(meta_file, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Kiểm tra nếu đã xóa
-                        if conversation.get("deleted", False):
-                            return None
-                        
-                        return conversation
-                
-                return None
-        except Exception as e:
-            logger.error(f"Lỗi khi lấy thông tin hội thoại: {str(e)}")
-            return None
-    
     def delete_conversations(self, username: str) -> bool:
         """Xóa tất cả lịch sử hội thoại của người dùng"""
         try:
@@ -505,6 +2964,23 @@ class StorageService:
                 result = self.db.conversations.delete_many({"username": username})
                 deleted_count = result.deleted_count
                 logger.info(f"Đã xóa {deleted_count} tin nhắn của {username}")
+                self._invalidate_cached_entity("conversations")
+                return True
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute("DELETE FROM conversation_log WHERE username = ?", (username,))
+                    deleted_count = cursor.rowcount
+                    
+                    # Xóa cả hội thoại và tin nhắn của người dùng (giống chế độ MongoDB/file)
+                    conn.execute(
+                        "DELETE FROM conversation_messages WHERE conversation_id IN "
+                        "(SELECT id FROM conversations WHERE username = ?)",
+                        (username,)
+                    )
+                    conn.execute("DELETE FROM conversations WHERE username = ?", (username,))
+                
+                logger.info(f"Đã xóa {deleted_count} tin nhắn của {username}")
+                self._invalidate_cached_entity("conversations")
                 return True
             else:
                 # Lưu trữ file
@@ -516,7 +2992,7 @@ class StorageService:
                 # Lấy danh sách file hội thoại
                 conversation_files = [
                     f for f in os.listdir(conversation_dir) 
-                    if f.endswith('.json')
+                    if f.endswith(('.json', '.jsonl'))
                 ]
                 
                 # Xóa từng file
@@ -529,6 +3005,7 @@ class StorageService:
                     os.rmdir(conversation_dir)
                 
                 logger.info(f"Đã xóa tất cả lịch sử hội thoại của {username}")
+                self._invalidate_cached_entity("conversations")
                 return True
                 
         except Exception as e:
@@ -554,21 +3031,32 @@ class StorageService:
             
             if self.storage_type == "mongodb":
                 self.db.api_keys.insert_one(api_data)
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    conn.execute(
+                        "INSERT INTO api_keys (key, secret, name, permissions, created_at, created_by, last_used, status) "
+                        "VALUES (?, ?, ?, ?, ?, ?, NULL, ?)",
+                        (
+                            api_key,
+                            api_data["secret"],
+                            name,
+                            json.dumps(api_data["permissions"]),
+                            api_data["created_at"].isoformat(),
+                            created_by,
+                            api_data["status"]
+                        )
+                    )
             else:
                 # Lưu trữ file
-                api_keys_file = os.path.join(self.data_dir, "api_keys", "api_keys.json")
-                
-                if os.path.exists(api_keys_file):
-                    with open(api_keys_file, "r", encoding="utf-8") as f:
-                        api_keys = json.load(f)
-                else:
-                    api_keys = []
+                api_keys_file = self._api_keys_file()
                 
                 api_data["created_at"] = api_data["created_at"].isoformat()
-                api_keys.append(api_data)
                 
-                with open(api_keys_file, "w", encoding="utf-8") as f:
-                    json.dump(api_keys, f, ensure_ascii=False, indent=2)
+                def add_key(api_keys):
+                    api_keys.append(api_data)
+                    return api_keys, True
+                
+                self._update_json_file(api_keys_file, add_key, default=[])
             
             logger.info(f"Tạo API key thành công: {name}")
             return api_key, api_secret
@@ -578,42 +3066,52 @@ class StorageService:
             return None, None
     
     def verify_api_key(self, api_key: str) -> Tuple[bool, List[str]]:
-        """Xác thực API key"""
+        """
+        Xác thực API key
+        
+        Thời gian sử dụng (last_used) được ghi vào bộ đệm write-behind và ghi xuống theo lô,
+        nên xác thực không phát sinh thao tác ghi nào.
+        """
         try:
             if self.storage_type == "mongodb":
-                key_data = self.db.api_keys.find_one({"key": api_key, "status": "active"})
-                
-                if key_data:
-                    # Cập nhật thời gian sử dụng
-                    self.db.api_keys.update_one(
-                        {"_id": key_data["_id"]},
-                        {"$set": {"last_used": datetime.now()}}
+                def load_permissions():
+                    key_data = self.db.api_keys.find_one(
+                        {"key": api_key, "status": "active"},
+                        {"permissions": 1}
                     )
-                    return True, key_data["permissions"]
+                    return (key_data["permissions"], key_data["_id"]) if key_data else (None, None)
                 
-                return False, []
+                permissions = self._get_cached_entity("api_keys", api_key, load_permissions)
                 
-            else:
-                # Lưu trữ file
-                api_keys_file = os.path.join(self.data_dir, "api_keys", "api_keys.json")
+                if permissions is None:
+                    return False, []
                 
-                if not os.path.exists(api_keys_file):
+            elif self.storage_type == "sqlite":
+                def load_permissions():
+                    row = self._sqlite_conn().execute(
+                        "SELECT permissions FROM api_keys WHERE key = ? AND status = 'active'",
+                        (api_key,)
+                    ).fetchone()
+                    return (json.loads(row["permissions"]), None) if row else (None, None)
+                
+                permissions = self._get_cached_entity("api_keys", api_key, load_permissions)
+                
+                if permissions is None:
                     return False, []
                 
-                with open(api_keys_file, "r", encoding="utf-8") as f:
-                    api_keys = json.load(f)
+            else:
+                # Lưu trữ file - tra cứu trong bảng API key trong bộ nhớ
+                key_data = self._get_api_keys_table().get(api_key)
                 
-                for i, key_data in enumerate(api_keys):
-                    if key_data["key"] == api_key and key_data.get("status", "active") == "active":
-                        # Cập nhật thời gian sử dụng
-                        api_keys[i]["last_used"] = datetime.now().isoformat()
-                        
-                        with open(api_keys_file, "w", encoding="utf-8") as f:
-                            json.dump(api_keys, f, ensure_ascii=False, indent=2)
-                        
-                        return True, key_data["permissions"]
+                if not key_data or key_data.get("status", "active") != "active":
+                    return False, []
                 
-                return False, []
+                permissions = list(key_data["permissions"])
+            
+            # Cập nhật thời gian sử dụng (ghi sau)
+            self._buffer_write("api_key_last_used", api_key, datetime.now())
+            
+            return True, permissions
                 
         except Exception as e:
             logger.error(f"Lỗi khi xác thực API key: {str(e)}")
@@ -636,29 +3134,33 @@ class StorageService:
                         }
                     }
                 )
+                self._invalidate_cached_entity("api_keys", api_key)
                 return result.modified_count > 0
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute(
+                        "UPDATE api_keys SET status = ?, updated_at = ?, updated_by = ? WHERE key = ?",
+                        (status, datetime.now().isoformat(), updated_by, api_key)
+                    )
+                self._invalidate_cached_entity("api_keys", api_key)
+                return cursor.rowcount > 0
             else:
                 # Lưu trữ file
-                api_keys_file = os.path.join(self.data_dir, "api_keys", "api_keys.json")
+                api_keys_file = self._api_keys_file()
                 
                 if not os.path.exists(api_keys_file):
                     return False
                 
-                with open(api_keys_file, "r", encoding="utf-8") as f:
-                    api_keys = json.load(f)
-                
-                for i, key_data in enumerate(api_keys):
-                    if key_data["key"] == api_key:
-                        api_keys[i]["status"] = status
-                        api_keys[i]["updated_at"] = datetime.now().isoformat()
-                        api_keys[i]["updated_by"] = updated_by
-                        
-                        with open(api_keys_file, "w", encoding="utf-8") as f:
-                            json.dump(api_keys, f, ensure_ascii=False, indent=2)
-                        
-                        return True
+                def apply_status(api_keys):
+                    for key_data in api_keys:
+                        if key_data["key"] == api_key:
+                            key_data["status"] = status
+                            key_data["updated_at"] = datetime.now().isoformat()
+                            key_data["updated_by"] = updated_by
+                            return api_keys, True
+                    return api_keys, False
                 
-                return False
+                return self._update_json_file(api_keys_file, apply_status, default=[])
         except Exception as e:
             logger.error(f"Lỗi khi cập nhật trạng thái API key: {str(e)}")
             return False
@@ -673,22 +3175,37 @@ class StorageService:
                 
                 keys = list(self.db.api_keys.find(query, {"secret": 0}))
                 # Convert MongoDB _id to string for serialization
-                return [self._sanitize_mongodb_doc(key) for key in keys]
+                keys = [self._sanitize_mongodb_doc(key) for key in keys]
+            elif self.storage_type == "sqlite":
+                # Không trả về secret
+                query = (
+                    "SELECT key, name, permissions, created_at, created_by, last_used, status, "
+                    "updated_at, updated_by, deleted_at, deleted_by FROM api_keys"
+                )
+                params = []
+                if created_by:
+                    query += " WHERE created_by = ?"
+                    params.append(created_by)
+                
+                rows = self._sqlite_conn().execute(query + " ORDER BY created_at", params).fetchall()
+                keys = [self._sqlite_row_to_dict(row, json_fields=("permissions",)) for row in rows]
             else:
                 # Lưu trữ file
-                api_keys_file = os.path.join(self.data_dir, "api_keys", "api_keys.json")
-                
-                if not os.path.exists(api_keys_file):
-                    return []
-                
-                with open(api_keys_file, "r", encoding="utf-8") as f:
-                    api_keys = json.load(f)
+                api_keys = list(self._get_api_keys_table().values())
                 
                 if created_by:
                     api_keys = [key for key in api_keys if key.get("created_by") == created_by]
                 
                 # Không trả về secret
-                return [{k: v for k, v in key.items() if k != "secret"} for key in api_keys]
+                keys = [{k: v for k, v in key.items() if k != "secret"} for key in api_keys]
+            
+            # Thời gian sử dụng mới nhất có thể còn trong bộ đệm write-behind
+            for key in keys:
+                last_used = self._get_buffered_write("api_key_last_used", key["key"])
+                if last_used:
+                    key["last_used"] = last_used if self.storage_type == "mongodb" else last_used.isoformat()
+            
+            return keys
                 
         except Exception as e:
             logger.error(f"Lỗi khi lấy danh sách API keys: {str(e)}")
@@ -709,30 +3226,35 @@ class StorageService:
                         }
                     }
                 )
+                self._invalidate_cached_entity("api_keys", api_key)
                 return result.modified_count > 0
+            elif self.storage_type == "sqlite":
+                # Cập nhật trạng thái thay vì xóa
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute(
+                        "UPDATE api_keys SET status = 'deleted', deleted_at = ?, deleted_by = ? WHERE key = ?",
+                        (datetime.now().isoformat(), deleted_by, api_key)
+                    )
+                self._invalidate_cached_entity("api_keys", api_key)
+                return cursor.rowcount > 0
             else:
                 # Lưu trữ file
-                api_keys_file = os.path.join(self.data_dir, "api_keys", "api_keys.json")
+                api_keys_file = self._api_keys_file()
                 
                 if not os.path.exists(api_keys_file):
                     return False
                 
-                with open(api_keys_file, "r", encoding="utf-8") as f:
-                    api_keys = json.load(f)
-                
-                for i, key_data in enumerate(api_keys):
-                    if key_data["key"] == api_key:
-                        # Cập nhật trạng thái thay vì xóa
-                        api_keys[i]["status"] = "deleted"
-                        api_keys[i]["deleted_at"] = datetime.now().isoformat()
-                        api_keys[i]["deleted_by"] = deleted_by
-                        
-                        with open(api_keys_file, "w", encoding="utf-8") as f:
-                            json.dump(api_keys, f, ensure_ascii=False, indent=2)
-                        
-                        return True
-                
-                return False
+                def mark_deleted(api_keys):
+                    for key_data in api_keys:
+                        if key_data["key"] == api_key:
+                            # Cập nhật trạng thái thay vì xóa
+                            key_data["status"] = "deleted"
+                            key_data["deleted_at"] = datetime.now().isoformat()
+                            key_data["deleted_by"] = deleted_by
+                            return api_keys, True
+                    return api_keys, False
+                
+                return self._update_json_file(api_keys_file, mark_deleted, default=[])
         except Exception as e:
             logger.error(f"Lỗi khi xóa API key: {str(e)}")
             return False
@@ -751,148 +3273,59 @@ class StorageService:
                         }
                     }
                 )
+                self._invalidate_cached_entity("api_keys", api_key)
                 return result.modified_count > 0
+            elif self.storage_type == "sqlite":
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute(
+                        "UPDATE api_keys SET permissions = ?, updated_at = ?, updated_by = ? WHERE key = ?",
+                        (json.dumps(permissions), datetime.now().isoformat(), updated_by, api_key)
+                    )
+                self._invalidate_cached_entity("api_keys", api_key)
+                return cursor.rowcount > 0
             else:
                 # Lưu trữ file
-                api_keys_file = os.path.join(self.data_dir, "api_keys", "api_keys.json")
+                api_keys_file = self._api_keys_file()
                 
                 if not os.path.exists(api_keys_file):
                     return False
                 
-                with open(api_keys_file, "r", encoding="utf-8") as f:
-                    api_keys = json.load(f)
+                def apply_permissions(api_keys):
+                    for key_data in api_keys:
+                        if key_data["key"] == api_key:
+                            key_data["permissions"] = permissions
+                            key_data["updated_at"] = datetime.now().isoformat()
+                            key_data["updated_by"] = updated_by
+                            return api_keys, True
+                    return api_keys, False
                 
-                for i, key_data in enumerate(api_keys):
-                    if key_data["key"] == api_key:
-                        api_keys[i]["permissions"] = permissions
-                        api_keys[i]["updated_at"] = datetime.now().isoformat()
-                        api_keys[i]["updated_by"] = updated_by
-                        
-                        with open(api_keys_file, "w", encoding="utf-8") as f:
-                            json.dump(api_keys, f, ensure_ascii=False, indent=2)
-                        
-                        return True
-                
-                return False
+                return self._update_json_file(api_keys_file, apply_permissions, default=[])
         except Exception as e:
             logger.error(f"Lỗi khi cập nhật quyền hạn API key: {str(e)}")
             return False
-    
-    def track_api_user(self, api_key: str, user_id: str, user_info: Dict = None) -> bool:
-        """
-        Theo dõi người dùng qua API
-        
-        Args:
-            api_key (str): API key được sử dụng
-            user_id (str): ID của người dùng từ ứng dụng tích hợp
-            user_info (dict, optional): Thông tin bổ sung về người dùng
-        """
-        try:
-            timestamp = datetime.now()
-            
-            # Đảm bảo user_id là chuỗi an toàn để dùng làm filename
-            safe_user_id = self._sanitize_filename(user_id)
-            
-            if self.storage_type == "mongodb":
-                # Kiểm tra xem đã có bản ghi chưa
-                existing_user = self.db.api_users.find_one({
-                    "api_key": api_key, 
-                    "user_id": user_id
-                })
-                
-                if existing_user:
-                    # Cập nhật bản ghi hiện có
-                    update_data = {
-                        "$set": {
-                            "last_active": timestamp,
-                            "user_info": user_info or existing_user.get("user_info")
-                        },
-                        "$inc": {"total_requests": 1}
-                    }
-                    
-                    self.db.api_users.update_one(
-                        {"_id": existing_user["_id"]},
-                        update_data
-                    )
-                else:
-                    # Tạo bản ghi mới
-                    api_user_data = {
-                        "api_key": api_key,
-                        "user_id": user_id,
-                        "first_seen": timestamp,
-                        "last_active": timestamp,
-                        "total_requests": 1
-                    }
-                    
-                    # Thêm thông tin bổ sung nếu có
-                    if user_info:
-                        api_user_data["user_info"] = user_info
-                        
-                    self.db.api_users.insert_one(api_user_data)
-            else:
-                # Lưu trữ file
-                api_users_dir = os.path.join(self.data_dir, "api_users")
-                os.makedirs(api_users_dir, exist_ok=True)
-                
-                # Sử dụng API key làm thư mục để phân tách dữ liệu
-                api_key_dir = os.path.join(api_users_dir, self._sanitize_filename(api_key))
-                os.makedirs(api_key_dir, exist_ok=True)
-                
-                # File cho từng user (để tránh file quá lớn)
-                user_file = os.path.join(api_key_dir, f"{safe_user_id}.json")
-                
-                api_user_data = None
-                
-                if os.path.exists(user_file):
-                    # Cập nhật dữ liệu hiện có
-                    with open(user_file, "r", encoding="utf-8") as f:
-                        api_user_data = json.load(f)
-                    
-                    api_user_data["last_active"] = timestamp.isoformat()
-                    api_user_data["total_requests"] += 1
-                    
-                    # Cập nhật thông tin nếu có
-                    if user_info:
-                        api_user_data["user_info"] = user_info
-                else:
-                    # Tạo dữ liệu mới
-                    api_user_data = {
-                        "api_key": api_key,
-                        "user_id": user_id,
-                        "first_seen": timestamp.isoformat(),
-                        "last_active": timestamp.isoformat(),
-                        "total_requests": 1
-                    }
-                    
-                    # Thêm thông tin bổ sung nếu có
-                    if user_info:
-                        api_user_data["user_info"] = user_info
-                
-                # Lưu dữ liệu
-                with open(user_file, "w", encoding="utf-8") as f:
-                    json.dump(api_user_data, f, ensure_ascii=False, indent=2)
-                
-                # Cập nhật danh sách tổng hợp nếu cần
-                summary_file = os.path.join(api_key_dir, "_summary.json")
-                
-                summary_data = {
-                    "total_users": 0,
-                    "total_requests": 0,
-                    "last_updated": timestamp.isoformat()
-                }
-                
-                if os.path.exists(summary_file):
-                    with open(summary_file, "r", encoding="utf-8") as f:
-                        summary_data = json.load(f)
-                
-                # Cập nhật tổng số request
-                summary_data["total_requests"] += 1
-                summary_data["last_updated"] = timestamp.isoformat()
-                
-                # Lưu tổng hợp
-                with open(summary_file, "w", encoding="utf-8") as f:
-                    json.dump(summary_data, f, ensure_ascii=False, indent=2)
-                    
+    
+    def track_api_user(self, api_key: str, user_id: str, user_info: Dict = None) -> bool:
+        """
+        Theo dõi người dùng qua API
+        
+        Hoạt động được gộp trong bộ đệm write-behind theo (api_key, user_id) và ghi xuống
+        theo lô (xem _flush_api_user_activity), không ghi trực tiếp trên mỗi request.
+        
+        Args:
+            api_key (str): API key được sử dụng
+            user_id (str): ID của người dùng từ ứng dụng tích hợp
+            user_info (dict, optional): Thông tin bổ sung về người dùng
+        """
+        try:
+            timestamp = datetime.now()
+            
+            self._buffer_write("api_user_activity", (api_key, user_id), {
+                "requests": 1,
+                "first_seen": timestamp,
+                "last_active": timestamp,
+                "user_info": user_info or None
+            })
+            
             return True
             
         except Exception as e:
@@ -918,6 +3351,19 @@ class StorageService:
                 
                 # Convert MongoDB _id to string for serialization
                 return [self._sanitize_mongodb_doc(user) for user in users]
+            elif self.storage_type == "sqlite":
+                # Chỉ lấy người dùng hoạt động gần đây
+                query = "SELECT * FROM api_users WHERE last_active >= ?"
+                params = [since.isoformat()]
+                if api_key:
+                    query += " AND api_key = ?"
+                    params.append(api_key)
+                
+                query += " ORDER BY last_active DESC LIMIT ?"
+                params.append(limit)
+                
+                rows = self._sqlite_conn().execute(query, params).fetchall()
+                return [self._sqlite_row_to_dict(row, json_fields=("user_info",)) for row in rows]
             else:
                 # Lưu trữ file
                 api_users_dir = os.path.join(self.data_dir, "api_users")
@@ -989,7 +3435,8 @@ class StorageService:
     
     def get_api_usage_stats(self, api_key: str = None, time_period: str = "all") -> Dict:
         """
-        Lấy thống kê sử dụng API
+        Lấy thống kê sử dụng API: theo khoảng thời gian từ các bucket giờ/ngày đã tổng hợp
+        cộng các sự kiện chưa tổng hợp, "all" từ bucket thống kê tổng
         
         Args:
             api_key (str, optional): API key cụ thể hoặc tất cả
@@ -999,177 +3446,51 @@ class StorageService:
             dict: Thống kê sử dụng
         """
         try:
-            # Xác định thời gian bắt đầu dựa trên time_period
             now = datetime.now()
+            last_24h = now - timedelta(days=1)
+            last_7d = now - timedelta(days=7)
+            
+            # Số người dùng hoạt động trong 24h và 7 ngày
+            summary_24h = self._get_usage_event_summary(api_key, last_24h)
+            summary_7d = self._get_usage_event_summary(api_key, last_7d)
+            active_24h = sum(r["users"] for r in summary_24h.values())
+            active_7d = sum(r["users"] for r in summary_7d.values())
             
             if time_period == "day":
-                since = now - timedelta(days=1)
+                results = summary_24h
             elif time_period == "week":
-                since = now - timedelta(days=7)
+                results = summary_7d
             elif time_period == "month":
-                since = now - timedelta(days=30)
+                results = self._get_usage_event_summary(api_key, now - timedelta(days=30))
             else:  # "all"
-                since = datetime(2000, 1, 1)  # Ngày xa trong quá khứ
+                results = self._get_usage_totals(api_key)
             
-            if self.storage_type == "mongodb":
-                # Chuẩn bị query
-                match_query = {"last_active": {"$gte": since}}
-                if api_key:
-                    match_query["api_key"] = api_key
-                
-                # Tổng hợp dữ liệu
-                pipeline = [
-                    {"$match": match_query},
-                    {"$group": {
-                        "_id": "$api_key",
-                        "total_users": {"$sum": 1},
-                        "total_requests": {"$sum": "$total_requests"},
-                        "last_request": {"$max": "$last_active"}
-                    }},
-                    {"$sort": {"last_request": -1}}
-                ]
-                
-                results = list(self.db.api_users.aggregate(pipeline))
-                
-                # Xác định số người dùng hoạt động trong 24h và 7 ngày
-                active_24h = 0
-                active_7d = 0
-                
-                # Query cho người dùng hoạt động trong 24h
-                query_24h = {"last_active": {"$gte": now - timedelta(hours=24)}}
-                if api_key:
-                    query_24h["api_key"] = api_key
-                active_24h = self.db.api_users.count_documents(query_24h)
-                
-                # Query cho người dùng hoạt động trong 7 ngày
-                query_7d = {"last_active": {"$gte": now - timedelta(days=7)}}
-                if api_key:
-                    query_7d["api_key"] = api_key
-                active_7d = self.db.api_users.count_documents(query_7d)
-                
-                # Tổng hợp kết quả
-                stats = {
-                    "total_users": sum(r["total_users"] for r in results),
-                    "total_requests": sum(r["total_requests"] for r in results),
-                    "active_users_24h": active_24h,
-                    "active_users_7d": active_7d,
-                    "api_keys": [
-                        {
-                            "api_key": r["_id"],
-                            "total_users": r["total_users"],
-                            "total_requests": r["total_requests"],
-                            "last_request": r["last_request"].isoformat()
-                        }
-                        for r in results
-                    ]
-                }
-                
-                return stats
-            else:
-                # Lưu trữ file
-                api_users_dir = os.path.join(self.data_dir, "api_users")
-                
-                if not os.path.exists(api_users_dir):
-                    return {
-                        "total_users": 0,
-                        "total_requests": 0,
-                        "active_users_24h": 0,
-                        "active_users_7d": 0,
-                        "api_keys": []
-                    }
-                
-                # Các thư mục API key cần xử lý
-                api_key_dirs = []
-                
-                if api_key:
-                    api_key_dir = os.path.join(api_users_dir, self._sanitize_filename(api_key))
-                    if os.path.exists(api_key_dir) and os.path.isdir(api_key_dir):
-                        api_key_dirs.append((api_key, api_key_dir))
-                else:
-                    # Tất cả thư mục API key
-                    for dir_name in os.listdir(api_users_dir):
-                        dir_path = os.path.join(api_users_dir, dir_name)
-                        if os.path.isdir(dir_path):
-                            api_key_dirs.append((dir_name, dir_path))
-                
-                # Khởi tạo kết quả
-                stats = {
-                    "total_users": 0,
-                    "total_requests": 0,
-                    "active_users_24h": 0,
-                    "active_users_7d": 0,
-                    "api_keys": []
+            api_keys = []
+            for key, r in results.items():
+                key_stats = {
+                    "api_key": key,
+                    "total_users": r["users"],
+                    "total_requests": r["requests"],
+                    "last_request": r["last_request"]
                 }
-                
-                for api_key_name, api_key_path in api_key_dirs:
-                    api_key_stats = {
-                        "api_key": api_key_name,
-                        "total_users": 0,
-                        "total_requests": 0,
-                        "last_request": None
-                    }
-                    
-                    # Đọc tất cả file người dùng
-                    user_files = [
-                        f for f in os.listdir(api_key_path)
-                        if f.endswith('.json') and f != "_summary.json"
-                    ]
-                    
-                    active_users_24h = 0
-                    active_users_7d = 0
-                    total_requests = 0
-                    total_users = 0
-                    last_request = None
-                    
-                    for file_name in user_files:
-                        file_path = os.path.join(api_key_path, file_name)
-                        
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            user_data = json.load(f)
-                        
-                        # Chuyển đổi string thành datetime
-                        last_active = datetime.fromisoformat(user_data["last_active"])
-                        
-                        # Chỉ tính người dùng trong khoảng thời gian
-                        if last_active >= since:
-                            total_users += 1
-                            total_requests += user_data["total_requests"]
-                            
-                            # Cập nhật thời gian cuối cùng
-                            if last_request is None or last_active > last_request:
-                                last_request = last_active
-                            
-                            # Kiểm tra hoạt động trong 24h
-                            if last_active >= now - timedelta(hours=24):
-                                active_users_24h += 1
-                            
-                            # Kiểm tra hoạt động trong 7 ngày
-                            if last_active >= now - timedelta(days=7):
-                                active_users_7d += 1
-                    
-                    # Cập nhật thống kê API key
-                    api_key_stats["total_users"] = total_users
-                    api_key_stats["total_requests"] = total_requests
-                    if last_request:
-                        api_key_stats["last_request"] = last_request.isoformat()
-                    
-                    # Cập nhật thống kê tổng
-                    stats["total_users"] += total_users
-                    stats["total_requests"] += total_requests
-                    stats["active_users_24h"] += active_users_24h
-                    stats["active_users_7d"] += active_users_7d
-                    
-                    # Thêm vào danh sách API keys
-                    if total_users > 0:
-                        stats["api_keys"].append(api_key_stats)
-                
-                # Sắp xếp API keys theo thời gian sử dụng gần nhất
-                stats["api_keys"].sort(
-                    key=lambda x: x["last_request"] if x["last_request"] else "0", 
-                    reverse=True
-                )
-                
-                return stats
+                if "avg_latency_ms" in r:
+                    key_stats.update({
+                        "avg_latency_ms": r["avg_latency_ms"],
+                        "prompt_tokens": r["prompt_tokens"],
+                        "completion_tokens": r["completion_tokens"]
+                    })
+                api_keys.append(key_stats)
+            
+            # Sắp xếp API keys theo thời gian sử dụng gần nhất
+            api_keys.sort(key=lambda x: x["last_request"] or "0", reverse=True)
+            
+            return {
+                "total_users": sum(r["users"] for r in results.values()),
+                "total_requests": sum(r["requests"] for r in results.values()),
+                "active_users_24h": active_24h,
+                "active_users_7d": active_7d,
+                "api_keys": api_keys
+            }
         except Exception as e:
             logger.error(f"Lỗi khi lấy thống kê sử dụng API: {str(e)}")
             return {
@@ -1181,56 +3502,238 @@ class StorageService:
                 "error": str(e)
             }
         
+    # --- Thông tin tóm tắt tin nhắn trên hội thoại (MongoDB) ---
+
+    def _last_message_summary(self, message: Dict) -> Dict:
+        """Tin nhắn cuối rút gọn lưu trên hội thoại (nội dung cắt còn 100 ký tự)"""
+        return {
+            "id": message.get("id", str(message.get("_id", ""))),
+            "role": message["role"],
+            "content": message.get("content", "")[:100],
+            "timestamp": message["timestamp"]
+        }
+
+    def _update_conversation_stats(self, conversation_id: Any, messages: List[Dict]) -> None:
+        """
+        Cập nhật updated_at, message_count, last_message_at, preview và last_message
+        của hội thoại sau khi thêm tin nhắn
+        """
+        summary = self._conversation_stats_summary(messages)
+        
+        conversations = self._mongo_db("messages").conversations
+        # Cờ archived được giữ nguyên: chỉ _rehydrate_conversation bỏ cờ khi đưa tin nhắn lưu trữ trở lại
+        result = conversations.update_one(
+            {"_id": conversation_id, "message_count": {"$exists": True}},
+            {"$set": summary, "$inc": {"message_count": len(messages)}}
+        )
+        
+        if result.matched_count == 0:
+            # Hội thoại cũ chưa có message_count: để backfill_conversation_stats đếm lại từ tin nhắn
+            conversations.update_one({"_id": conversation_id}, {"$set": summary})
+
+    def _conversation_stats_summary(self, messages: List[Dict]) -> Dict:
+        """Các trường tóm tắt của hội thoại ($set) sau khi thêm tin nhắn (MongoDB)"""
+        last_message = messages[-1]
+        return {
+            "updated_at": last_message["timestamp"],
+            "last_message_at": last_message["timestamp"],
+            "preview": last_message.get("content", "")[:100],
+            "last_message": self._last_message_summary(last_message)
+        }
+
+    def _compute_conversation_stats(self, conversation_id: Any) -> Dict:
+        """Tính thông tin tóm tắt của một hội thoại từ collection conversation_messages"""
+        message_count = self.db.conversation_messages.count_documents({"conversation_id": conversation_id})
+        last_messages = list(self.db.conversation_messages.find(
+            {"conversation_id": conversation_id}
+        ).sort("timestamp", -1).limit(1))
+        
+        stats = {"message_count": message_count, "last_message_at": None}
+        if last_messages:
+            stats["last_message_at"] = last_messages[0]["timestamp"]
+            stats["preview"] = last_messages[0].get("content", "")[:100]
+            stats["last_message"] = self._last_message_summary(last_messages[0])
+        
+        return stats
+
+    def backfill_conversation_stats(self, batch_size: int = 500) -> int:
+        """
+        Bổ sung message_count/last_message_at/preview cho các hội thoại MongoDB tạo trước
+        khi có các trường này (an toàn khi chạy lại hoặc chạy song song nhiều worker)
+        
+        Args:
+            batch_size (int): Số hội thoại xử lý mỗi lượt
+            
+        Returns:
+            int: Số hội thoại đã được cập nhật
+        """
+        if self.storage_type != "mongodb":
+            return 0
+        
+        updated = 0
+        
+        try:
+            while True:
+                conversation_ids = [
+                    conv["_id"] for conv in self.db.conversations.find(
+                        {"message_count": {"$exists": False}}, {"_id": 1}
+                    ).limit(batch_size)
+                ]
+                if not conversation_ids:
+                    break
+                
+                # Đếm và lấy tin nhắn cuối của cả lô trong một aggregation
+                stats = {
+                    row["_id"]: row for row in self.db.conversation_messages.aggregate([
+                        {"$match": {"conversation_id": {"$in": conversation_ids}}},
+                        {"$sort": {"conversation_id": 1, "timestamp": 1}},
+                        {"$group": {
+                            "_id": "$conversation_id",
+                            "message_count": {"$sum": 1},
+                            "last_message": {"$last": "$$ROOT"}
+                        }}
+                    ])
+                }
+                
+                for conversation_id in conversation_ids:
+                    row = stats.get(conversation_id)
+                    fields = {"message_count": 0, "last_message_at": None}
+                    if row:
+                        last_message = row["last_message"]
+                        fields = {
+                            "message_count": row["message_count"],
+                            "last_message_at": last_message["timestamp"],
+                            "preview": last_message.get("content", "")[:100],
+                            "last_message": self._last_message_summary(last_message)
+                        }
+                    
+                    result = self.db.conversations.update_one(
+                        {"_id": conversation_id, "message_count": {"$exists": False}},
+                        {"$set": fields}
+                    )
+                    updated += result.modified_count
+            
+            if updated:
+                logger.info(f"Đã bổ sung thông tin tóm tắt cho {updated} hội thoại")
+        except Exception as e:
+            logger.error(f"Lỗi khi bổ sung thông tin tóm tắt hội thoại: {str(e)}")
+        
+        return updated
+
     # --- Các phương thức quản lý hội thoại ---
 
-    def get_conversations(self, username: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+    def make_conversation_cursor(self, conversation: Dict) -> str:
+        """
+        Tạo cursor phân trang (keyset) trỏ tới sau một hội thoại trong danh sách
+        
+        Args:
+            conversation (Dict): Hội thoại cuối cùng của trang hiện tại
+            
+        Returns:
+            str: Cursor dạng base64 của (updated_at, id)
+        """
+        updated_at = conversation.get("updated_at") or conversation.get("created_at")
+        if isinstance(updated_at, datetime):
+            updated_at = updated_at.isoformat()
+        
+        payload = json.dumps([updated_at, str(conversation["id"])])
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+    def parse_conversation_cursor(self, cursor: str) -> Optional[Tuple[str, str]]:
+        """
+        Giải mã cursor phân trang
+        
+        Returns:
+            Optional[Tuple[str, str]]: (updated_at, id) hoặc None nếu cursor không hợp lệ (kể cả khi id
+            không đúng định dạng ID hội thoại của kiểu lưu trữ đang dùng)
+        """
+        try:
+            updated_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            datetime.fromisoformat(updated_at)
+        except Exception:
+            return None
+        
+        if not isinstance(conversation_id, str) or not conversation_id:
+            return None
+        if self.storage_type == "mongodb" and not self._is_valid_object_id(conversation_id):
+            return None
+        
+        return str(updated_at), conversation_id
+
+    def get_conversations(self, username: str, limit: int = 20, offset: int = 0,
+                          cursor: Optional[str] = None) -> List[Dict]:
         """
-        Lấy danh sách hội thoại của người dùng
+        Lấy danh sách hội thoại của người dùng, sắp xếp theo (updated_at, id) giảm dần
         
         Args:
             username (str): Tên người dùng
             limit (int): Số lượng hội thoại tối đa
-            offset (int): Vị trí bắt đầu
+            offset (int): Vị trí bắt đầu (bỏ qua khi có cursor)
+            cursor (str, optional): Cursor từ make_conversation_cursor, lấy các hội thoại sau vị trí này
             
         Returns:
             List[Dict]: Danh sách hội thoại
         """
         try:
+            position = None
+            if cursor:
+                position = self.parse_conversation_cursor(cursor)
+                if not position:
+                    logger.warning(f"Cursor phân trang không hợp lệ: {cursor}")
+                    return []
+            
             if self.storage_type == "mongodb":
+                query = {"username": username, "deleted": {"$ne": True}}
+                
+                if position:
+                    # Keyset: các hội thoại đứng sau (updated_at, _id) của cursor
+                    updated_at = datetime.fromisoformat(position[0])
+                    obj_id = ObjectId(position[1])
+                    query["$or"] = [
+                        {"updated_at": {"$lt": updated_at}},
+                        {"updated_at": updated_at, "_id": {"$lt": obj_id}}
+                    ]
+                
                 # Lấy danh sách hội thoại từ MongoDB
-                conversations = list(self.db.conversations.find(
-                    {"username": username, "deleted": {"$ne": True}}
-                ).sort("updated_at", -1).skip(offset).limit(limit))
+                # Bản tóm tắt hội thoại chỉ dùng cho prompt, không trả về trong danh sách
+                find_cursor = self.db.conversations.find(query, {"summary": 0}).sort([("updated_at", -1), ("_id", -1)])
+                if not position:
+                    find_cursor = find_cursor.skip(offset)
+                conversations = list(find_cursor.limit(limit))
                 
-                # Chuẩn bị dữ liệu phản hồi
+                # Chuẩn bị dữ liệu phản hồi (message_count/preview/last_message được lưu sẵn trên hội thoại)
                 result = []
                 for conv in conversations:
-                    # Chuyển đổi ObjectId thành string và đổi tên trường _id thành id
-                    conv_data = self._sanitize_mongodb_doc(conv)
-                    
-                    # Lấy tin nhắn cuối cùng để tạo preview
-                    last_message = None
-                    last_messages = list(self.db.conversation_messages.find(
-                        {"conversation_id": conv["_id"]}
-                    ).sort("timestamp", -1).limit(1))
-                    
-                    if last_messages:
-                        last_message = self._sanitize_mongodb_doc(last_messages[0])
-                    
-                    # Đếm số tin nhắn
-                    message_count = self.db.conversation_messages.count_documents(
-                        {"conversation_id": conv["_id"]}
-                    )
-                    
-                    # Thêm thông tin bổ sung
-                    conv_data["message_count"] = message_count
-                    if last_message:
-                        conv_data["last_message"] = last_message
-                        conv_data["preview"] = last_message.get("content", "")[:100]  # Tạo preview
+                    if "message_count" not in conv:
+                        # Hội thoại cũ chưa được backfill_conversation_stats xử lý
+                        conv.update(self._compute_conversation_stats(conv["_id"]))
                     
-                    result.append(conv_data)
+                    # Chuyển đổi ObjectId thành string và đổi tên trường _id thành id
+                    result.append(self._sanitize_mongodb_doc(conv))
                 
                 return result
+            elif self.storage_type == "sqlite":
+                # message_count/preview/last_message được lưu sẵn trên bảng conversations
+                if position:
+                    # Keyset: các hội thoại đứng sau (updated_at, id) của cursor
+                    rows = self._sqlite_conn().execute(
+                        "SELECT * FROM conversations WHERE username = ? AND deleted = 0 "
+                        "AND (updated_at < ? OR (updated_at = ? AND id < ?)) "
+                        "ORDER BY updated_at DESC, id DESC LIMIT ?",
+                        (username, position[0], position[0], position[1], limit)
+                    ).fetchall()
+                else:
+                    rows = self._sqlite_conn().execute(
+                        "SELECT * FROM conversations WHERE username = ? AND deleted = 0 "
+                        "ORDER BY updated_at DESC, id DESC LIMIT ? OFFSET ?",
+                        (username, limit, offset)
+                    ).fetchall()
+                
+                conversations = [self._sqlite_conversation_to_dict(row) for row in rows]
+                for conversation in conversations:
+                    conversation.pop("summary", None)
+                
+                return conversations
             else:
                 # Lưu trữ file
                 conversations_dir = os.path.join(self.data_dir, "conversations")
@@ -1239,120 +3742,402 @@ class StorageService:
                 if not os.path.exists(user_dir):
                     return []
                 
-                # Lấy danh sách file hội thoại metadata
-                meta_dir = os.path.join(user_dir, "metadata")
-                if not os.path.exists(meta_dir):
-                    os.makedirs(meta_dir, exist_ok=True)
-                    return []
-                
-                meta_files = [f for f in os.listdir(meta_dir) if f.endswith('.json')]
-                
-                # Đọc thông tin hội thoại
-                conversations = []
-                for meta_file in meta_files:
-                    file_path = os.path.join(meta_dir, meta_file)
-                    try:
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Kiểm tra nếu đã xóa
-                        if conversation.get("deleted", False):
-                            continue
-                        
-                        # Đảm bảo có trường id
-                        if "_id" in conversation and "id" not in conversation:
-                            conversation["id"] = conversation["_id"]
-                        
-                        # Lấy tin nhắn cuối cùng
-                        conversation_id = conversation["id"]
-                        messages_file = os.path.join(user_dir, f"{conversation_id}.json")
-                        
-                        if os.path.exists(messages_file):
-                            with open(messages_file, "r", encoding="utf-8") as f:
-                                messages = json.load(f)
-                            
-                            if messages:
-                                last_message = messages[-1]
-                                conversation["last_message"] = last_message
-                                conversation["preview"] = last_message.get("content", "")[:100]
-                                conversation["message_count"] = len(messages)
-                            else:
-                                conversation["message_count"] = 0
+                # Đọc manifest (đã sắp xếp theo (updated_at, id) giảm dần, có sẵn
+                # message_count/preview) thay vì mở từng file hội thoại
+                entries = self._load_conversation_manifest(user_dir)
+                
+                start = 0
+                if position:
+                    # Tìm nhị phân vị trí đầu tiên đứng sau cursor
+                    end = len(entries)
+                    while start < end:
+                        middle = (start + end) // 2
+                        if self._manifest_sort_key(entries[middle]) < position:
+                            end = middle
                         else:
-                            conversation["message_count"] = 0
-                        
-                        conversations.append(conversation)
-                    except Exception as e:
-                        logger.error(f"Lỗi đọc file hội thoại: {str(e)}")
+                            start = middle + 1
+                    offset = 0
                 
-                # Sắp xếp theo thời gian cập nhật giảm dần
-                conversations.sort(key=lambda x: x.get("updated_at", x.get("created_at", "")), reverse=True)
+                # Áp dụng limit và offset, bỏ qua hội thoại đã xóa
+                conversations = []
+                for conversation in entries[start:]:
+                    if conversation.get("deleted", False):
+                        continue
+                    if offset > 0:
+                        offset -= 1
+                        continue
+                    conversations.append(conversation)
+                    if len(conversations) >= limit:
+                        break
                 
-                # Áp dụng limit và offset
-                return conversations[offset:offset+limit]
+                return conversations
         except Exception as e:
             logger.error(f"Lỗi khi lấy danh sách hội thoại: {str(e)}")
             return []
 
-    def check_conversation_access(self, username: str, conversation_id: str) -> bool:
+    def check_conversation_access(self, username: str, conversation_id: str) -> bool:
+        """
+        Kiểm tra quyền truy cập hội thoại
+        
+        Args:
+            username (str): Tên người dùng
+            conversation_id (str): ID hội thoại
+            
+        Returns:
+            bool: True nếu có quyền truy cập, False nếu không
+        """
+        try:
+            # Kiểm tra conversation_id có giá trị không
+            if not conversation_id:
+                logger.warning(f"Conversation ID rỗng khi kiểm tra quyền truy cập: username={username}")
+                return False
+                
+            if self.storage_type == "mongodb":
+                # Xử lý conversation_id
+                obj_id = None
+                try:
+                    if self._is_valid_object_id(conversation_id):
+                        obj_id = ObjectId(conversation_id)
+                    else:
+                        # Nếu không phải là ObjectId hợp lệ, có thể là UUID từ lưu trữ file
+                        logger.warning(f"Conversation ID không phải ObjectId hợp lệ: {conversation_id}")
+                        return False
+                except Exception as e:
+                    logger.error(f"Lỗi chuyển đổi conversation_id sang ObjectId: {str(e)}")
+                    return False
+                
+                def load_owner():
+                    conversation = self.db.conversations.find_one({"_id": obj_id}, {"username": 1})
+                    return (conversation.get("username"), obj_id) if conversation else (None, None)
+            elif self.storage_type == "sqlite":
+                def load_owner():
+                    row = self._sqlite_conn().execute(
+                        "SELECT username FROM conversations WHERE id = ?",
+                        (conversation_id,)
+                    ).fetchone()
+                    return (row["username"], None) if row else (None, None)
+            else:
+                # Lưu trữ file - tra cứu chủ sở hữu qua index
+                def load_owner():
+                    user_dir, _ = self._locate_conversation(conversation_id)
+                    return (os.path.basename(user_dir), None) if user_dir else (None, None)
+            
+            # Chủ sở hữu hội thoại qua bộ đệm thực thể
+            owner = self._get_cached_entity("conversations", conversation_id, load_owner)
+            
+            if not owner:
+                logger.warning(f"Không tìm thấy hội thoại với ID: {conversation_id}")
+                return False
+            
+            return owner == username
+        except Exception as e:
+            logger.error(f"Lỗi khi kiểm tra quyền truy cập hội thoại: {str(e)}")
+            return False
+
+    # --- Lưu trữ lạnh tin nhắn (archival) ---
+    # Tin nhắn của hội thoại không hoạt động quá ARCHIVE_AFTER_DAYS ngày và của hội thoại đã xóa
+    # được chuyển khỏi kho tin nhắn chính sang kho lạnh nén: MongoDB collection
+    # conversation_archives và SQLite bảng conversation_archives (mỗi bản ghi một khối tin nhắn
+    # nén zlib), lưu trữ file <conversation_id>.jsonl.gz. Khi hội thoại được đọc lại, tin nhắn được
+    # đưa trở lại kho chính (_rehydrate_conversation) và rehydrated_at được ghi lại để hội thoại
+    # không bị lưu trữ lại trước ARCHIVE_AFTER_DAYS ngày kể từ lúc đó. MongoDB đánh dấu hội thoại có
+    # tin nhắn trong kho lạnh bằng cờ archived, nên lượt đọc hội thoại chưa lưu trữ không phải tìm
+    # trong conversation_archives.
+
+    def archive_conversations(self, inactive_days: int = None, limit: int = 500) -> int:
+        """
+        Chuyển tin nhắn của các hội thoại không hoạt động và hội thoại đã xóa sang kho lạnh
+        
+        Args:
+            inactive_days (int, optional): Số ngày không hoạt động (mặc định ARCHIVE_AFTER_DAYS)
+            limit (int): Số hội thoại tối đa xử lý trong một lần chạy
+            
+        Returns:
+            int: Số hội thoại đã được lưu trữ
+        """
+        cutoff = datetime.now() - timedelta(days=inactive_days or ARCHIVE_AFTER_DAYS)
+        archived = 0
+        
+        try:
+            if self.storage_type == "mongodb":
+                candidates = self.db.conversations.find(
+                    {
+                        "archived": {"$ne": True},
+                        "message_count": {"$exists": True},  # Hội thoại cũ chờ backfill được bỏ qua
+                        "$or": [
+                            {"deleted": True},
+                            {"updated_at": {"$lt": cutoff}, "rehydrated_at": {"$not": {"$gte": cutoff}}}
+                        ]
+                    },
+                    {"_id": 1, "updated_at": 1}
+                ).limit(limit)
+                
+                for conversation in list(candidates):
+                    if self._archive_mongodb_conversation(conversation):
+                        archived += 1
+                        
+            elif self.storage_type == "sqlite":
+                conversation_ids = [row["id"] for row in self._sqlite_conn().execute(
+                    "SELECT c.id FROM conversations c WHERE (c.deleted = 1 OR (c.updated_at < ? "
+                    "AND COALESCE(json_extract(c.extra, '$.rehydrated_at'), '') < ?)) "
+                    "AND EXISTS (SELECT 1 FROM conversation_messages m WHERE m.conversation_id = c.id) LIMIT ?",
+                    (cutoff.isoformat(), cutoff.isoformat(), limit)
+                ).fetchall()]
+                
+                for conversation_id in conversation_ids:
+                    if self._archive_sqlite_conversation(conversation_id, cutoff):
+                        archived += 1
+                        
+            else:
+                conversations_dir = os.path.join(self.data_dir, "conversations")
+                
+                for username in os.listdir(conversations_dir):
+                    user_dir = os.path.join(conversations_dir, username)
+                    if not os.path.isdir(user_dir):
+                        continue
+                    
+                    for entry in self._load_conversation_manifest(user_dir, cache=False):
+                        if archived >= limit:
+                            break
+                        if not entry.get("deleted") and max(
+                            self._manifest_sort_key(entry)[0], entry.get("rehydrated_at") or ""
+                        ) >= cutoff.isoformat():
+                            continue
+                        if self._archive_file_conversation(user_dir, entry["id"], cutoff):
+                            archived += 1
+            
+            if archived:
+                logger.info(f"Đã lưu trữ tin nhắn của {archived} hội thoại")
+        except Exception as e:
+            logger.error(f"Lỗi khi lưu trữ tin nhắn hội thoại: {str(e)}")
+        
+        return archived
+
+    def _archive_mongodb_conversation(self, conversation: Dict) -> bool:
+        """Nén tin nhắn của một hội thoại vào conversation_archives rồi xóa khỏi conversation_messages"""
+        conversation_id = conversation["_id"]
+        messages = list(self.db.conversation_messages.find(
+            {"conversation_id": conversation_id}
+        ).sort([("timestamp", 1), ("_id", 1)]))
+        
+        if messages:
+            archived_at = datetime.now()
+            self.db.conversation_archives.insert_many([
+                {
+                    "conversation_id": conversation_id,
+                    "message_count": len(messages[i:i + ARCHIVE_CHUNK_SIZE]),
+                    "data": zlib.compress(bson.encode({"messages": messages[i:i + ARCHIVE_CHUNK_SIZE]})),
+                    "archived_at": archived_at
+                }
+                for i in range(0, len(messages), ARCHIVE_CHUNK_SIZE)
+            ])
+            
+            # Chỉ xóa đúng các tin nhắn đã lưu trữ (tin nhắn mới thêm trong lúc này được giữ lại)
+            self.db.conversation_messages.delete_many({"_id": {"$in": [m["_id"] for m in messages]}})
+        
+        # Hội thoại có tin nhắn trong kho lạnh luôn được đánh dấu (lượt đọc dựa vào cờ này để đưa tin nhắn
+        # trở lại); hội thoại không có tin nhắn chỉ được đánh dấu nếu không được cập nhật trong lúc này
+        marker = {"_id": conversation_id}
+        if not messages:
+            marker["updated_at"] = conversation.get("updated_at")
+        self.db.conversations.update_one(marker, {"$set": {"archived": True}})
+        return bool(messages)
+
+    def _archive_sqlite_conversation(self, conversation_id: str, cutoff: datetime) -> bool:
+        """Nén tin nhắn của một hội thoại vào bảng conversation_archives (một transaction)"""
+        with self._sqlite_transaction() as conn:
+            # Kiểm tra lại trong transaction: hội thoại có thể vừa có tin nhắn mới
+            if not conn.execute(
+                "SELECT 1 FROM conversations WHERE id = ? AND (deleted = 1 OR (updated_at < ? "
+                "AND COALESCE(json_extract(extra, '$.rehydrated_at'), '') < ?))",
+                (conversation_id, cutoff.isoformat(), cutoff.isoformat())
+            ).fetchone():
+                return False
+            
+            messages = [dict(row) for row in conn.execute(
+                "SELECT id, conversation_id, role, content, timestamp FROM conversation_messages "
+                "WHERE conversation_id = ? ORDER BY timestamp, rowid",
+                (conversation_id,)
+            ).fetchall()]
+            
+            if not messages:
+                return False
+            
+            conn.execute(
+                "INSERT INTO conversation_archives (conversation_id, message_count, data, archived_at) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    conversation_id, len(messages),
+                    zlib.compress(json.dumps(messages, ensure_ascii=False).encode("utf-8")),
+                    datetime.now().isoformat()
+                )
+            )
+            conn.execute("DELETE FROM conversation_messages WHERE conversation_id = ?", (conversation_id,))
+        
+        return True
+
+    def _archive_file_conversation(self, user_dir: str, conversation_id: str, cutoff: datetime) -> bool:
+        """Nén file tin nhắn JSONL của một hội thoại vào <conversation_id>.jsonl.gz"""
+        messages_file = self._get_messages_file(user_dir, conversation_id)
+        if not os.path.exists(messages_file):
+            return False
+        
+        with self._locked_file(messages_file):
+            if not os.path.exists(messages_file):
+                return False
+            
+            # Kiểm tra lại dưới khóa: metadata được cập nhật trước khi ghi thêm tin nhắn
+            conversation = self._read_json_file(os.path.join(user_dir, "metadata", f"{conversation_id}.json"))
+            if not conversation:
+                return False
+            if not conversation.get("deleted") and max(
+                conversation.get("updated_at", ""), conversation.get("rehydrated_at") or ""
+            ) >= cutoff.isoformat():
+                return False
+            
+            with open(messages_file, "rb") as f:
+                data = f.read()
+            
+            # Thêm một gzip member vào cuối file lưu trữ (đọc lại được như một luồng liên tục)
+            with open(f"{messages_file}.gz", "ab") as f:
+                f.write(gzip.compress(data))
+                f.flush()
+                os.fsync(f.fileno())
+            
+            os.remove(messages_file)
+        
+        return True
+
+    def _iter_archived_messages(self, messages_file: str):
+        """Đọc tin nhắn đã lưu trữ trong <messages_file>.gz (lưu trữ file)"""
+        archive_file = f"{messages_file}.gz"
+        if not os.path.exists(archive_file):
+            return
+        
+        with gzip.open(archive_file, "rt", encoding="utf-8") as f:
+            for line in f:
+                message = self._parse_message_line(line, archive_file)
+                if message is not None:
+                    yield message
+
+    def _rehydrate_if_archived(self, conversation_id: str, user_dir: str = None) -> None:
         """
-        Kiểm tra quyền truy cập hội thoại
+        Đưa tin nhắn lưu trữ trở lại kho chính nếu hội thoại đã được lưu trữ
         
-        Args:
-            username (str): Tên người dùng
-            conversation_id (str): ID hội thoại
-            
-        Returns:
-            bool: True nếu có quyền truy cập, False nếu không
+        Kiểm tra trên mỗi lượt đọc (MongoDB: cờ archived qua index _id), để tin nhắn do worker khác
+        vừa lưu trữ luôn được đưa trở lại trước khi đọc.
         """
-        try:
-            # Kiểm tra conversation_id có giá trị không
-            if not conversation_id:
-                logger.warning(f"Conversation ID rỗng khi kiểm tra quyền truy cập: username={username}")
-                return False
+        if self.storage_type == "mongodb":
+            archived = self.db.conversations.find_one(
+                {"_id": ObjectId(conversation_id), "archived": True}, {"_id": 1}
+            ) is not None
+        else:
+            archived = True  # SQLite/file: _rehydrate_conversation tự kiểm tra cục bộ
+        
+        if archived:
+            self._rehydrate_conversation(conversation_id, user_dir)
+
+    def _rehydrate_conversation(self, conversation_id: str, user_dir: str = None) -> None:
+        """Đưa tin nhắn đã lưu trữ của hội thoại trở lại kho chính (không làm gì nếu chưa lưu trữ)"""
+        rehydrated_at = datetime.now()
+        
+        if self.storage_type == "mongodb":
+            obj_id = ObjectId(conversation_id)
+            archives = list(self.db.conversation_archives.find({"conversation_id": obj_id}))
+            if not archives:
+                # Hội thoại đánh dấu đã lưu trữ nhưng không có tin nhắn nào: chỉ bỏ cờ
+                self.db.conversations.update_one(
+                    {"_id": obj_id, "archived": True},
+                    {"$set": {"rehydrated_at": rehydrated_at}, "$unset": {"archived": ""}}
+                )
+                return
+            
+            messages = []
+            for archive in archives:
+                messages.extend(bson.decode(zlib.decompress(archive["data"]))["messages"])
+            
+            try:
+                self.db.conversation_messages.insert_many(messages, ordered=False)
+            except BulkWriteError as e:
+                # Tin nhắn đã có sẵn (lần đưa trở lại trước bị gián đoạn) thì bỏ qua
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+            
+            self.db.conversation_archives.delete_many({"_id": {"$in": [a["_id"] for a in archives]}})
+            self.db.conversations.update_one(
+                {"_id": obj_id}, {"$set": {"rehydrated_at": rehydrated_at}, "$unset": {"archived": ""}}
+            )
+            
+        elif self.storage_type == "sqlite":
+            conn = self._sqlite_conn()
+            if not conn.execute(
+                "SELECT 1 FROM conversation_archives WHERE conversation_id = ? LIMIT 1", (conversation_id,)
+            ).fetchone():
+                return
+            
+            with self._sqlite_transaction() as conn:
+                archives = conn.execute(
+                    "SELECT id, data FROM conversation_archives WHERE conversation_id = ? ORDER BY id",
+                    (conversation_id,)
+                ).fetchall()
+                
+                for archive in archives:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO conversation_messages (id, conversation_id, role, content, timestamp) "
+                        "VALUES (:id, :conversation_id, :role, :content, :timestamp)",
+                        json.loads(zlib.decompress(archive["data"]).decode("utf-8"))
+                    )
                 
-            if self.storage_type == "mongodb":
-                # Xử lý conversation_id
-                obj_id = None
+                conn.execute("DELETE FROM conversation_archives WHERE conversation_id = ?", (conversation_id,))
+                conn.execute(
+                    "UPDATE conversations SET extra = json_set(extra, '$.rehydrated_at', ?) WHERE id = ?",
+                    (rehydrated_at.isoformat(), conversation_id)
+                )
+                
+        else:
+            messages_file = self._get_messages_file(user_dir, conversation_id)
+            archive_file = f"{messages_file}.gz"
+            if not os.path.exists(archive_file):
+                return
+            
+            with self._locked_file(messages_file):
+                if not os.path.exists(archive_file):
+                    return
+                
+                # Tin nhắn lưu trữ (cũ hơn) trước, tin nhắn mới thêm sau khi lưu trữ ở sau
+                seen_ids = set()
+                tmp_file = f"{messages_file}.{uuid.uuid4().hex}.tmp"
                 try:
-                    if self._is_valid_object_id(conversation_id):
-                        obj_id = ObjectId(conversation_id)
-                    else:
-                        # Nếu không phải là ObjectId hợp lệ, có thể là UUID từ lưu trữ file
-                        logger.warning(f"Conversation ID không phải ObjectId hợp lệ: {conversation_id}")
-                        return False
-                except Exception as e:
-                    logger.error(f"Lỗi chuyển đổi conversation_id sang ObjectId: {str(e)}")
-                    return False
+                    with open(tmp_file, "w", encoding="utf-8") as f:
+                        for message in itertools.chain(
+                            self._iter_archived_messages(messages_file), self._iter_messages(messages_file)
+                        ):
+                            if message.get("id") in seen_ids:
+                                continue
+                            seen_ids.add(message.get("id"))
+                            f.write(json.dumps(message, ensure_ascii=False) + "\n")
+                        f.flush()
+                        os.fsync(f.fileno())
                     
-                conversation = self.db.conversations.find_one({"_id": obj_id})
+                    os.replace(tmp_file, messages_file)
+                finally:
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
                 
+                os.remove(archive_file)
+            
+            fields = {"rehydrated_at": rehydrated_at.isoformat()}
+            
+            def mark_rehydrated(conversation):
                 if not conversation:
-                    logger.warning(f"Không tìm thấy hội thoại với ID: {conversation_id}")
-                    return False
-                
-                return conversation.get("username") == username
-            else:
-                # Lưu trữ file
-                conversations_dir = os.path.join(self.data_dir, "conversations")
-                user_dir = os.path.join(conversations_dir, username)
-                
-                if not os.path.exists(user_dir):
-                    return False
-                
-                # Kiểm tra file metadata
-                meta_dir = os.path.join(user_dir, "metadata")
-                if not os.path.exists(meta_dir):
-                    os.makedirs(meta_dir, exist_ok=True)
-                    return False
-                
-                meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                
-                # Kiểm tra xem file có tồn tại không
-                return os.path.exists(meta_file)
-        except Exception as e:
-            logger.error(f"Lỗi khi kiểm tra quyền truy cập hội thoại: {str(e)}")
-            return False
+                    return conversation, False
+                conversation.update(fields)
+                return conversation, True
+            
+            if self._update_json_file(os.path.join(user_dir, "metadata", f"{conversation_id}.json"), mark_rehydrated):
+                self._update_conversation_manifest(user_dir, conversation_id, fields=fields)
+        
+        logger.info(f"Đã đưa tin nhắn đã lưu trữ của hội thoại {conversation_id} trở lại")
 
     def get_conversation(self, conversation_id: str) -> Optional[Dict]:
         """
@@ -1391,36 +4176,44 @@ class StorageService:
                     return None
                 
                 return self._sanitize_mongodb_doc(conversation)
-            else:
-                # Lưu trữ file - tìm trong tất cả người dùng
-                conversations_dir = os.path.join(self.data_dir, "conversations")
+            elif self.storage_type == "sqlite":
+                row = self._sqlite_conn().execute(
+                    "SELECT * FROM conversations WHERE id = ? AND deleted = 0",
+                    (conversation_id,)
+                ).fetchone()
                 
-                # Tìm trong thư mục của tất cả người dùng
-                for user_dir in os.listdir(conversations_dir):
-                    if not os.path.isdir(os.path.join(conversations_dir, user_dir)):
-                        continue
-                    
-                    meta_dir = os.path.join(conversations_dir, user_dir, "metadata")
-                    if not os.path.exists(meta_dir):
-                        continue
-                    
-                    meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                    if os.path.exists(meta_file):
-                        with open(meta_file, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Kiểm tra nếu đã xóa
-                        if conversation.get("deleted", False):
-                            return None
-                        
-                        # Đảm bảo có trường id
-                        if "_id" in conversation and "id" not in conversation:
-                            conversation["id"] = conversation["_id"]
-                        
-                        return conversation
+                if not row:
+                    logger.warning(f"Không tìm thấy hội thoại với ID: {conversation_id}")
+                    return None
                 
-                logger.warning(f"Không tìm thấy metadata cho hội thoại với ID: {conversation_id}")
-                return None
+                return self._sqlite_conversation_to_dict(row)
+            else:
+                # Lưu trữ file - tra cứu chủ sở hữu qua index
+                _, meta_file = self._locate_conversation(conversation_id)
+
+                if not meta_file:
+                    logger.warning(f"Không tìm thấy metadata cho hội thoại với ID: {conversation_id}")
+                    return None
+
+                with open(meta_file, "r", encoding="utf-8") as f:
+                    conversation = json.load(f)
+
+                # Kiểm tra nếu đã xóa
+                if conversation.get("deleted", False):
+                    return None
+
+                # Đảm bảo có trường id
+                if "_id" in conversation and "id" not in conversation:
+                    conversation["id"] = conversation["_id"]
+
+                # Số tin nhắn lấy từ manifest của người dùng
+                user_dir = os.path.dirname(os.path.dirname(meta_file))
+                for entry in self._load_conversation_manifest(user_dir):
+                    if entry.get("id") == conversation_id:
+                        conversation["message_count"] = entry.get("message_count", 0)
+                        break
+
+                return conversation
         except Exception as e:
             logger.error(f"Lỗi khi lấy thông tin hội thoại: {str(e)}")
             return None
@@ -1451,319 +4244,256 @@ class StorageService:
                 except Exception as e:
                     logger.error(f"Lỗi chuyển đổi conversation_id sang ObjectId khi lấy tin nhắn: {str(e)}")
                     return []
+                
+                # Đưa tin nhắn đã lưu trữ trở lại nếu có
+                self._rehydrate_if_archived(conversation_id)
                     
                 messages = list(self.db.conversation_messages.find(
                     {"conversation_id": obj_id}
                 ).sort("timestamp", 1))
                 
                 return [self._sanitize_mongodb_doc(msg) for msg in messages]
-            else:
-                # Lưu trữ file - tìm trong tất cả người dùng
-                conversations_dir = os.path.join(self.data_dir, "conversations")
+            elif self.storage_type == "sqlite":
+                self._rehydrate_if_archived(conversation_id)
                 
-                # Tìm trong thư mục của tất cả người dùng
-                for user_dir in os.listdir(conversations_dir):
-                    if not os.path.isdir(os.path.join(conversations_dir, user_dir)):
-                        continue
+                rows = self._sqlite_conn().execute(
+                    "SELECT id, conversation_id, role, content, timestamp FROM conversation_messages "
+                    "WHERE conversation_id = ? ORDER BY timestamp, rowid",
+                    (conversation_id,)
+                ).fetchall()
+                
+                return [dict(row) for row in rows]
+            else:
+                # Lưu trữ file - tra cứu chủ sở hữu qua index
+                user_dir, _ = self._locate_conversation(conversation_id)
+
+                if user_dir:
+                    self._rehydrate_if_archived(conversation_id, user_dir)
                     
-                    messages_file = os.path.join(conversations_dir, user_dir, f"{conversation_id}.json")
+                    messages_file = self._get_messages_file(user_dir, conversation_id)
                     if os.path.exists(messages_file):
-                        with open(messages_file, "r", encoding="utf-8") as f:
-                            messages = json.load(f)
-                        
-                        # Đảm bảo mỗi tin nhắn có trường id
-                        for msg in messages:
-                            if "_id" in msg and "id" not in msg:
-                                msg["id"] = msg["_id"]
-                        
-                        return messages
-                
+                        return list(self._iter_messages(messages_file))
+
                 logger.warning(f"Không tìm thấy file tin nhắn cho hội thoại với ID: {conversation_id}")
                 return []
         except Exception as e:
             logger.error(f"Lỗi khi lấy tin nhắn hội thoại: {str(e)}")
             return []
 
-    def create_conversation(self, username: str, title: str = None) -> Optional[str]:
+    def get_recent_messages(self, conversation_id: str, limit: int = 20,
+                            before: Optional[str] = None, after: Optional[str] = None) -> List[Dict]:
         """
-        Tạo hội thoại mới
+        Lấy một phần tin nhắn của hội thoại thay vì toàn bộ lịch sử
         
         Args:
-            username (str): Tên người dùng
-            title (str, optional): Tiêu đề hội thoại
+            conversation_id (str): ID hội thoại
+            limit (int): Số tin nhắn tối đa
+            before (str, optional): Lấy limit tin nhắn ngay trước tin nhắn có ID này
+            after (str, optional): Lấy limit tin nhắn ngay sau tin nhắn có ID này
+            
+        Không có before/after: trả về limit tin nhắn cuối cùng.
             
         Returns:
-            Optional[str]: ID hội thoại mới hoặc None nếu thất bại
+            List[Dict]: Danh sách tin nhắn theo thứ tự thời gian tăng dần
         """
         try:
-            timestamp = datetime.now()
-            
-            if not title:
-                title = f"Hội thoại {timestamp.strftime('%d/%m/%Y %H:%M')}"
+            if not conversation_id:
+                logger.warning("Conversation ID rỗng khi lấy tin nhắn hội thoại")
+                return []
             
-            conversation_data = {
-                "username": username,
-                "title": title,
-                "created_at": timestamp,
-                "updated_at": timestamp,
-                "deleted": False
-            }
+            anchor_id = after or before
             
             if self.storage_type == "mongodb":
-                result = self.db.conversations.insert_one(conversation_data)
-                # Trả về chuỗi chứ không phải ObjectId
-                return str(result.inserted_id)
-            else:
-                # Lưu trữ file
-                conversation_id = str(uuid.uuid4())
-                
-                conversations_dir = os.path.join(self.data_dir, "conversations")
-                user_dir = os.path.join(conversations_dir, username)
-                os.makedirs(user_dir, exist_ok=True)
-                
-                # Tạo thư mục metadata nếu chưa có
-                meta_dir = os.path.join(user_dir, "metadata")
-                os.makedirs(meta_dir, exist_ok=True)
-                
-                # Lưu thông tin hội thoại
-                conversation_data["id"] = conversation_id
+                if not self._is_valid_object_id(conversation_id):
+                    logger.warning(f"Conversation ID không phải ObjectId hợp lệ khi lấy tin nhắn: {conversation_id}")
+                    return []
                 
-                meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                with open(meta_file, "w", encoding="utf-8") as f:
-                    conversation_data["created_at"] = conversation_data["created_at"].isoformat()
-                    conversation_data["updated_at"] = conversation_data["updated_at"].isoformat()
-                    json.dump(conversation_data, f, ensure_ascii=False, indent=2)
+                obj_id = ObjectId(conversation_id)
+                query = {"conversation_id": obj_id}
                 
-                # Tạo file tin nhắn trống
-                messages_file = os.path.join(user_dir, f"{conversation_id}.json")
-                with open(messages_file, "w", encoding="utf-8") as f:
-                    json.dump([], f, ensure_ascii=False, indent=2)
+                # Đưa tin nhắn đã lưu trữ trở lại nếu có
+                self._rehydrate_if_archived(conversation_id)
                 
-                return conversation_id
-        except Exception as e:
-            logger.error(f"Lỗi khi tạo hội thoại mới: {str(e)}")
-            return None
-
-    def add_message_to_conversation(self, conversation_id: str, role: str, content: str) -> bool:
-        """
-        Thêm tin nhắn vào hội thoại
-        
-        Args:
-            conversation_id (str): ID hội thoại
-            role (str): Vai trò (user/assistant)
-            content (str): Nội dung tin nhắn
-            
-        Returns:
-            bool: True nếu thành công, False nếu thất bại
-        """
-        try:
-            if not conversation_id:
-                logger.warning("Conversation ID rỗng khi thêm tin nhắn")
-                return False
+                if anchor_id:
+                    # Tìm tin nhắn mốc (theo id hoặc _id)
+                    anchor_query = {"conversation_id": obj_id, "id": anchor_id}
+                    if self._is_valid_object_id(anchor_id):
+                        anchor_query = {"conversation_id": obj_id, "$or": [{"id": anchor_id}, {"_id": ObjectId(anchor_id)}]}
+                    anchor = self.db.conversation_messages.find_one(anchor_query, {"timestamp": 1})
                     
-            timestamp = datetime.now()
-            message_id = str(uuid.uuid4())
-            
-            if self.storage_type == "mongodb":
-                try:
-                    obj_id = None
-                    if self._is_valid_object_id(conversation_id):
-                        obj_id = ObjectId(conversation_id)
-                    else:
-                        logger.warning(f"Conversation ID không phải ObjectId hợp lệ khi thêm tin nhắn: {conversation_id}")
-                        return False
-                except Exception as e:
-                    logger.error(f"Lỗi chuyển đổi conversation_id sang ObjectId khi thêm tin nhắn: {str(e)}")
-                    return False
+                    if not anchor:
+                        logger.warning(f"Không tìm thấy tin nhắn mốc {anchor_id} trong hội thoại {conversation_id}")
+                        return []
+                    
+                    op = "$gt" if after else "$lt"
+                    query["$or"] = [
+                        {"timestamp": {op: anchor["timestamp"]}},
+                        {"timestamp": anchor["timestamp"], "_id": {op: anchor["_id"]}}
+                    ]
                 
-                message_data = {
-                    "conversation_id": obj_id,
-                    "id": message_id,
-                    "role": role,
-                    "content": content,
-                    "timestamp": timestamp
-                }
+                # Dùng index (conversation_id, timestamp, _id), không sắp xếp trong bộ nhớ
+                direction = 1 if after else -1
+                messages = list(self.db.conversation_messages.find(query).sort(
+                    [("timestamp", direction), ("_id", direction)]
+                ).limit(limit))
                 
-                # Thêm tin nhắn mới
-                self.db.conversation_messages.insert_one(message_data)
+                if not after:
+                    messages.reverse()
                 
-                # Cập nhật thời gian cập nhật của hội thoại
-                self.db.conversations.update_one(
-                    {"_id": obj_id},
-                    {"$set": {"updated_at": timestamp}}
-                )
+                return [self._sanitize_mongodb_doc(msg) for msg in messages]
                 
-                return True
-            else:
-                # Lưu trữ file - tìm thư mục hội thoại
-                conversations_dir = os.path.join(self.data_dir, "conversations")
+            elif self.storage_type == "sqlite":
+                self._rehydrate_if_archived(conversation_id)
                 
-                # Tìm file hội thoại để lấy username
-                username = None
+                conn = self._sqlite_conn()
+                query = "SELECT id, conversation_id, role, content, timestamp FROM conversation_messages WHERE conversation_id = ?"
+                params = [conversation_id]
                 
-                for user_dir in os.listdir(conversations_dir):
-                    if not os.path.isdir(os.path.join(conversations_dir, user_dir)):
-                        continue
+                if anchor_id:
+                    anchor = conn.execute(
+                        "SELECT timestamp, rowid FROM conversation_messages WHERE id = ? AND conversation_id = ?",
+                        (anchor_id, conversation_id)
+                    ).fetchone()
                     
-                    meta_dir = os.path.join(conversations_dir, user_dir, "metadata")
-                    if not os.path.exists(meta_dir):
-                        continue
+                    if not anchor:
+                        logger.warning(f"Không tìm thấy tin nhắn mốc {anchor_id} trong hội thoại {conversation_id}")
+                        return []
                     
-                    meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                    if os.path.exists(meta_file):
-                        username = user_dir
-                        
-                        # Cập nhật thời gian cập nhật hội thoại
-                        with open(meta_file, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        conversation["updated_at"] = timestamp.isoformat()
-                        
-                        with open(meta_file, "w", encoding="utf-8") as f:
-                            json.dump(conversation, f, ensure_ascii=False, indent=2)
-                        
-                        break
-                
-                if not username:
-                    logger.error(f"Không tìm thấy username cho conversation_id: {conversation_id}")
-                    return False
+                    op = ">" if after else "<"
+                    query += f" AND (timestamp {op} ? OR (timestamp = ? AND rowid {op} ?))"
+                    params += [anchor["timestamp"], anchor["timestamp"], anchor["rowid"]]
                 
-                # Tìm file tin nhắn
-                messages_file = os.path.join(conversations_dir, username, f"{conversation_id}.json")
+                direction = "ASC" if after else "DESC"
+                query += f" ORDER BY timestamp {direction}, rowid {direction} LIMIT ?"
+                params.append(limit)
                 
-                messages = []
-                if os.path.exists(messages_file):
-                    with open(messages_file, "r", encoding="utf-8") as f:
-                        messages = json.load(f)
+                messages = [dict(row) for row in conn.execute(query, params).fetchall()]
                 
-                # Chuẩn bị tin nhắn mới
-                message_data = {
-                    "conversation_id": conversation_id,
-                    "id": message_id,
-                    "role": role,
-                    "content": content,
-                    "timestamp": timestamp.isoformat()
-                }
+                if not after:
+                    messages.reverse()
                 
-                # Thêm tin nhắn mới
-                messages.append(message_data)
+                return messages
                 
-                # Lưu lại
-                with open(messages_file, "w", encoding="utf-8") as f:
-                    json.dump(messages, f, ensure_ascii=False, indent=2)
+            else:
+                # Lưu trữ file - tra cứu chủ sở hữu qua index
+                user_dir, _ = self._locate_conversation(conversation_id)
                 
-                return True
-        except Exception as e:
-            logger.error(f"Lỗi khi thêm tin nhắn vào hội thoại: {str(e)}")
-            return False
-    
-    def delete_conversation(self, conversation_id: str) -> bool:
-        """
-        Xóa hội thoại
-        
-        Args:
-            conversation_id (str): ID hội thoại
-            
-        Returns:
-            bool: True nếu thành công, False nếu thất bại
-        """
-        try:
-            if self.storage_type == "mongodb":
-                # Soft delete - chỉ đánh dấu là đã xóa
-                result = self.db.conversations.update_one(
-                    {"_id": ObjectId(conversation_id) if isinstance(conversation_id, str) else conversation_id},
-                    {"$set": {"deleted": True, "deleted_at": datetime.now()}}
-                )
+                if not user_dir:
+                    logger.warning(f"Không tìm thấy file tin nhắn cho hội thoại với ID: {conversation_id}")
+                    return []
                 
-                return result.modified_count > 0
-            else:
-                # Lưu trữ file - tìm trong tất cả người dùng
-                conversations_dir = os.path.join(self.data_dir, "conversations")
+                self._rehydrate_if_archived(conversation_id, user_dir)
                 
-                # Tìm trong thư mục của tất cả người dùng
-                for user_dir in os.listdir(conversations_dir):
-                    if not os.path.isdir(os.path.join(conversations_dir, user_dir)):
-                        continue
-                    
-                    meta_dir = os.path.join(conversations_dir, user_dir, "metadata")
-                    if not os.path.exists(meta_dir):
-                        continue
-                    
-                    meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                    if os.path.exists(meta_file):
-                        with open(meta_file, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Đánh dấu là đã xóa
-                        conversation["deleted"] = True
-                        conversation["deleted_at"] = datetime.now().isoformat()
-                        
-                        # Lưu lại
-                        with open(meta_file, "w", encoding="utf-8") as f:
-                            json.dump(conversation, f, ensure_ascii=False, indent=2)
-                        
-                        return True
+                messages_file = self._get_messages_file(user_dir, conversation_id)
+                messages = []
                 
-                return False
+                if after:
+                    # Đọc xuôi tới tin nhắn mốc rồi lấy các tin nhắn tiếp theo
+                    found = False
+                    for message in self._iter_messages(messages_file):
+                        if found:
+                            messages.append(message)
+                            if len(messages) >= limit:
+                                break
+                        elif message.get("id") == after:
+                            found = True
+                    return messages
+                
+                # Đọc ngược từ cuối file (chỉ đọc phần đuôi cần thiết)
+                found = before is None
+                for message in self._iter_messages_reversed(messages_file):
+                    if found:
+                        messages.append(message)
+                        if len(messages) >= limit:
+                            break
+                    elif message.get("id") == before:
+                        found = True
+                
+                messages.reverse()
+                return messages
         except Exception as e:
-            logger.error(f"Lỗi khi xóa hội thoại: {str(e)}")
-            return False
+            logger.error(f"Lỗi khi lấy tin nhắn hội thoại: {str(e)}")
+            return []
 
-    def delete_all_conversations(self, username: str) -> bool:
+    def create_conversation(self, username: str, title: str = None) -> Optional[str]:
         """
-        Xóa tất cả hội thoại của người dùng
+        Tạo hội thoại mới
         
         Args:
             username (str): Tên người dùng
+            title (str, optional): Tiêu đề hội thoại
             
         Returns:
-            bool: True nếu thành công, False nếu thất bại
+            Optional[str]: ID hội thoại mới hoặc None nếu thất bại
         """
         try:
+            timestamp = datetime.now()
+            
+            if not title:
+                title = f"Hội thoại {timestamp.strftime('%d/%m/%Y %H:%M')}"
+            
+            conversation_data = {
+                "username": username,
+                "title": title,
+                "created_at": timestamp,
+                "updated_at": timestamp,
+                "deleted": False
+            }
+            
             if self.storage_type == "mongodb":
-                # Soft delete - chỉ đánh dấu là đã xóa
-                result = self.db.conversations.update_many(
-                    {"username": username},
-                    {"$set": {"deleted": True, "deleted_at": datetime.now()}}
-                )
+                # Thông tin tóm tắt tin nhắn, cập nhật trong add_message_to_conversation
+                conversation_data["message_count"] = 0
+                conversation_data["last_message_at"] = None
                 
-                return True
+                result = self.db.conversations.insert_one(conversation_data)
+                # Trả về chuỗi chứ không phải ObjectId
+                return str(result.inserted_id)
+            elif self.storage_type == "sqlite":
+                conversation_id = str(uuid.uuid4())
+                
+                with self._sqlite_transaction() as conn:
+                    conn.execute(
+                        "INSERT INTO conversations (id, username, title, created_at, updated_at, deleted) "
+                        "VALUES (?, ?, ?, ?, ?, 0)",
+                        (conversation_id, username, title, timestamp.isoformat(), timestamp.isoformat())
+                    )
+                
+                return conversation_id
             else:
                 # Lưu trữ file
+                conversation_id = str(uuid.uuid4())
+                
                 conversations_dir = os.path.join(self.data_dir, "conversations")
                 user_dir = os.path.join(conversations_dir, username)
+                os.makedirs(user_dir, exist_ok=True)
                 
-                if not os.path.exists(user_dir):
-                    return True
-                
-                # Lấy danh sách file hội thoại metadata
+                # Tạo thư mục metadata nếu chưa có
                 meta_dir = os.path.join(user_dir, "metadata")
-                if not os.path.exists(meta_dir):
-                    return True
+                os.makedirs(meta_dir, exist_ok=True)
                 
-                meta_files = [f for f in os.listdir(meta_dir) if f.endswith('.json')]
+                # Ghi index trước metadata: nếu tiến trình dừng giữa chừng, index chỉ
+                # trỏ tới một hội thoại không tồn tại và sẽ bị bỏ qua khi tra cứu
+                self._index_conversation_owner(conversation_id, username)
                 
-                # Đánh dấu tất cả là đã xóa
-                for meta_file in meta_files:
-                    file_path = os.path.join(meta_dir, meta_file)
-                    try:
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Đánh dấu là đã xóa
-                        conversation["deleted"] = True
-                        conversation["deleted_at"] = datetime.now().isoformat()
-                        
-                        # Lưu lại
-                        with open(file_path, "w", encoding="utf-8") as f:
-                            json.dump(conversation, f, ensure_ascii=False, indent=2)
-                    except Exception as e:
-                        logger.error(f"Lỗi khi đánh dấu xóa hội thoại: {str(e)}")
+                # Lưu thông tin hội thoại
+                conversation_data["id"] = conversation_id
                 
-                return True
+                meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
+                conversation_data["created_at"] = conversation_data["created_at"].isoformat()
+                conversation_data["updated_at"] = conversation_data["updated_at"].isoformat()
+                self._atomic_write_json(meta_file, conversation_data)
+                
+                # Tạo file tin nhắn trống (JSONL, mỗi dòng một tin nhắn)
+                messages_file = os.path.join(user_dir, f"{conversation_id}.jsonl")
+                open(messages_file, "a", encoding="utf-8").close()
+
+                # Thêm hội thoại vào manifest của người dùng
+                self._update_conversation_manifest(user_dir, conversation_id)
+                
+                return conversation_id
         except Exception as e:
-            logger.error(f"Lỗi khi xóa tất cả hội thoại: {str(e)}")
-            return False
+            logger.error(f"Lỗi khi tạo hội thoại mới: {str(e)}")
+            return None
 
     def update_conversation(self, conversation_id: str, update_data: Dict) -> bool:
         """
@@ -1802,44 +4532,242 @@ class StorageService:
                     {"$set": update_data}
                 )
                 
+                self._invalidate_cached_entity("conversations", conversation_id)
                 return result.modified_count > 0
+            elif self.storage_type == "sqlite":
+                fields = {**update_data, "updated_at": datetime.now().isoformat()}
+                
+                with self._sqlite_transaction() as conn:
+                    row = conn.execute(
+                        "SELECT extra FROM conversations WHERE id = ? AND deleted = 0",
+                        (conversation_id,)
+                    ).fetchone()
+                    
+                    if not row:
+                        logger.warning(f"Không tìm thấy hội thoại để cập nhật: {conversation_id}")
+                        return False
+                    
+                    # Cột có sẵn cập nhật trực tiếp, các trường khác gộp vào cột extra
+                    extra = json.loads(row["extra"] or "{}")
+                    assignments = []
+                    params = []
+                    for key, value in fields.items():
+                        if key in self._SQLITE_CONVERSATION_COLUMNS:
+                            assignments.append(f"{key} = ?")
+                            params.append(value)
+                        else:
+                            extra[key] = value
+                    
+                    assignments.append("extra = ?")
+                    params.append(json.dumps(extra, ensure_ascii=False))
+                    
+                    conn.execute(
+                        f"UPDATE conversations SET {', '.join(assignments)} WHERE id = ?",
+                        params + [conversation_id]
+                    )
+                
+                self._invalidate_cached_entity("conversations", conversation_id)
+                return True
             else:
-                # Lưu trữ file - tìm trong tất cả người dùng
-                conversations_dir = os.path.join(self.data_dir, "conversations")
+                # Lưu trữ file - tra cứu chủ sở hữu qua index
+                user_dir, meta_file = self._locate_conversation(conversation_id)
+
+                if not meta_file:
+                    logger.warning(f"Không tìm thấy hội thoại để cập nhật: {conversation_id}")
+                    return False
+
+                fields = {**update_data, "updated_at": datetime.now().isoformat()}
+
+                def apply_update(conversation):
+                    # Kiểm tra nếu đã xóa
+                    if conversation.get("deleted", False):
+                        return conversation, False
+
+                    # Cập nhật dữ liệu
+                    conversation.update(fields)
+                    return conversation, True
+
+                if not self._update_json_file(meta_file, apply_update):
+                    return False
+
+                # Cập nhật manifest của người dùng
+                self._update_conversation_manifest(user_dir, conversation_id, fields=fields)
+
+                self._invalidate_cached_entity("conversations", conversation_id)
+                return True
+        except Exception as e:
+            logger.error(f"Lỗi khi cập nhật hội thoại: {str(e)}")
+            return False
+    
+    def get_conversation_summary(self, conversation_id: str) -> Optional[Dict]:
+        """
+        Lấy bản tóm tắt lũy tiến của hội thoại (lưu trong metadata hội thoại)
+        
+        Args:
+            conversation_id (str): ID hội thoại
+            
+        Returns:
+            Optional[Dict]: text (None nếu chưa có tóm tắt), last_message_id (tin nhắn cuối đã được tóm tắt),
+            message_count (số tin nhắn đã được tóm tắt), updated_at và pending_messages (số tin nhắn
+            chưa được tóm tắt); None nếu không tìm thấy hội thoại
+        """
+        try:
+            if not conversation_id:
+                logger.warning("Conversation ID rỗng khi lấy tóm tắt hội thoại")
+                return None
+            
+            if self.storage_type == "mongodb":
+                if not self._is_valid_object_id(conversation_id):
+                    logger.warning(f"Conversation ID không phải ObjectId hợp lệ khi lấy tóm tắt: {conversation_id}")
+                    return None
                 
-                # Tìm trong thư mục của tất cả người dùng
-                for user_dir in os.listdir(conversations_dir):
-                    if not os.path.isdir(os.path.join(conversations_dir, user_dir)):
-                        continue
+                conversation = self.db.conversations.find_one(
+                    {"_id": ObjectId(conversation_id), "deleted": {"$ne": True}},
+                    {"summary": 1, "message_count": 1}
+                )
+                
+                if not conversation:
+                    return None
+                
+                summary = conversation.get("summary") or {}
+                total = conversation.get("message_count", 0)
+            elif self.storage_type == "sqlite":
+                row = self._sqlite_conn().execute(
+                    "SELECT message_count, extra FROM conversations WHERE id = ? AND deleted = 0",
+                    (conversation_id,)
+                ).fetchone()
+                
+                if not row:
+                    return None
+                
+                summary = json.loads(row["extra"] or "{}").get("summary") or {}
+                total = row["message_count"]
+            else:
+                # Lưu trữ file - tóm tắt nằm trong file metadata, số tin nhắn lấy từ manifest
+                user_dir, meta_file = self._locate_conversation(conversation_id)
+                
+                if not meta_file:
+                    return None
+                
+                conversation = self._read_json_file(meta_file, {})
+                if conversation.get("deleted", False):
+                    return None
+                
+                summary = conversation.get("summary") or {}
+                total = 0
+                for entry in self._load_conversation_manifest(user_dir):
+                    if entry.get("id") == conversation_id:
+                        total = entry.get("message_count", 0)
+                        break
+            
+            message_count = summary.get("message_count", 0)
+            return {
+                "text": summary.get("text"),
+                "last_message_id": summary.get("last_message_id"),
+                "message_count": message_count,
+                "updated_at": summary.get("updated_at"),
+                "pending_messages": max(total - message_count, 0)
+            }
+        except Exception as e:
+            logger.error(f"Lỗi khi lấy tóm tắt hội thoại: {str(e)}")
+            return None
+    
+    def update_conversation_summary(self, conversation_id: str, text: str, last_message_id: str,
+                                    message_count: int) -> bool:
+        """
+        Lưu bản tóm tắt lũy tiến của hội thoại
+        
+        Không thay đổi updated_at (thứ tự danh sách hội thoại) và không hủy bộ đệm chủ sở hữu.
+        Chỉ ghi khi bản tóm tắt mới bao phủ nhiều tin nhắn hơn bản đang lưu, để hai lần làm mới
+        đồng thời (từ nhiều worker) không ghi đè bản mới hơn bằng bản cũ.
+        
+        Args:
+            conversation_id (str): ID hội thoại
+            text (str): Nội dung tóm tắt
+            last_message_id (str): ID tin nhắn cuối cùng đã được tóm tắt
+            message_count (int): Số tin nhắn đã được tóm tắt (tính từ đầu hội thoại)
+            
+        Returns:
+            bool: True nếu đã lưu, False nếu thất bại hoặc đã có bản tóm tắt mới hơn
+        """
+        try:
+            if not conversation_id:
+                logger.warning("Conversation ID rỗng khi lưu tóm tắt hội thoại")
+                return False
+            
+            summary = {
+                "text": text,
+                "last_message_id": last_message_id,
+                "message_count": message_count
+            }
+            
+            if self.storage_type == "mongodb":
+                if not self._is_valid_object_id(conversation_id):
+                    logger.warning(f"Conversation ID không phải ObjectId hợp lệ khi lưu tóm tắt: {conversation_id}")
+                    return False
+                
+                summary["updated_at"] = datetime.now()
+                
+                # Tóm tắt có thể tạo lại nên dùng write concern của tin nhắn
+                result = self._mongo_db("messages").conversations.update_one(
+                    {
+                        "_id": ObjectId(conversation_id),
+                        "deleted": {"$ne": True},
+                        "$or": [
+                            {"summary.message_count": {"$lt": message_count}},
+                            {"summary": {"$exists": False}}
+                        ]
+                    },
+                    {"$set": {"summary": summary}}
+                )
+                
+                return result.modified_count > 0
+            elif self.storage_type == "sqlite":
+                summary["updated_at"] = datetime.now().isoformat()
+                
+                with self._sqlite_transaction() as conn:
+                    row = conn.execute(
+                        "SELECT extra FROM conversations WHERE id = ? AND deleted = 0",
+                        (conversation_id,)
+                    ).fetchone()
                     
-                    meta_dir = os.path.join(conversations_dir, user_dir, "metadata")
-                    if not os.path.exists(meta_dir):
-                        continue
+                    if not row:
+                        logger.warning(f"Không tìm thấy hội thoại để lưu tóm tắt: {conversation_id}")
+                        return False
                     
-                    meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                    if os.path.exists(meta_file):
-                        # Đọc dữ liệu hiện tại
-                        with open(meta_file, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Kiểm tra nếu đã xóa
-                        if conversation.get("deleted", False):
-                            return False
-                        
-                        # Cập nhật dữ liệu
-                        conversation.update(update_data)
-                        conversation["updated_at"] = datetime.now().isoformat()
-                        
-                        # Lưu lại
-                        with open(meta_file, "w", encoding="utf-8") as f:
-                            json.dump(conversation, f, ensure_ascii=False, indent=2)
-                        
-                        return True
+                    extra = json.loads(row["extra"] or "{}")
+                    if (extra.get("summary") or {}).get("message_count", 0) >= message_count:
+                        return False
+                    
+                    extra["summary"] = summary
+                    conn.execute(
+                        "UPDATE conversations SET extra = ? WHERE id = ?",
+                        (json.dumps(extra, ensure_ascii=False), conversation_id)
+                    )
                 
-                logger.warning(f"Không tìm thấy hội thoại để cập nhật: {conversation_id}")
-                return False
+                return True
+            else:
+                # Lưu trữ file - chỉ ghi file metadata (manifest không chứa tóm tắt)
+                _, meta_file = self._locate_conversation(conversation_id)
+                
+                if not meta_file:
+                    logger.warning(f"Không tìm thấy hội thoại để lưu tóm tắt: {conversation_id}")
+                    return False
+                
+                summary["updated_at"] = datetime.now().isoformat()
+                
+                def apply_summary(conversation):
+                    if conversation.get("deleted", False):
+                        return conversation, False
+                    if (conversation.get("summary") or {}).get("message_count", 0) >= message_count:
+                        return conversation, False
+                    
+                    conversation["summary"] = summary
+                    return conversation, True
+                
+                return self._update_json_file(meta_file, apply_summary)
         except Exception as e:
-            logger.error(f"Lỗi khi cập nhật hội thoại: {str(e)}")
+            logger.error(f"Lỗi khi lưu tóm tắt hội thoại: {str(e)}")
             return False
     
     def delete_conversation(self, conversation_id: str) -> bool:
@@ -1883,42 +4811,47 @@ class StorageService:
                     }
                 )
                 
+                self._invalidate_cached_entity("conversations", conversation_id)
                 return result.modified_count > 0
-            else:
-                # Lưu trữ file - tìm trong tất cả người dùng
-                conversations_dir = os.path.join(self.data_dir, "conversations")
-                
-                # Tìm trong thư mục của tất cả người dùng
-                for user_dir in os.listdir(conversations_dir):
-                    if not os.path.isdir(os.path.join(conversations_dir, user_dir)):
-                        continue
-                    
-                    meta_dir = os.path.join(conversations_dir, user_dir, "metadata")
-                    if not os.path.exists(meta_dir):
-                        continue
-                    
-                    meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                    if os.path.exists(meta_file):
-                        # Đọc dữ liệu hiện tại
-                        with open(meta_file, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Kiểm tra nếu đã xóa rồi
-                        if conversation.get("deleted", False):
-                            return False
-                        
-                        # Đánh dấu là đã xóa
-                        conversation["deleted"] = True
-                        conversation["deleted_at"] = timestamp.isoformat()
-                        
-                        # Lưu lại
-                        with open(meta_file, "w", encoding="utf-8") as f:
-                            json.dump(conversation, f, ensure_ascii=False, indent=2)
-                        
-                        return True
+            elif self.storage_type == "sqlite":
+                # Soft delete - chỉ đánh dấu là đã xóa thay vì xóa hoàn toàn
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute(
+                        "UPDATE conversations SET deleted = 1, deleted_at = ? WHERE id = ? AND deleted = 0",
+                        (timestamp.isoformat(), conversation_id)
+                    )
                 
-                logger.warning(f"Không tìm thấy hội thoại để xóa: {conversation_id}")
-                return False
+                self._invalidate_cached_entity("conversations", conversation_id)
+                return cursor.rowcount > 0
+            else:
+                # Lưu trữ file - tra cứu chủ sở hữu qua index
+                user_dir, meta_file = self._locate_conversation(conversation_id)
+
+                if not meta_file:
+                    logger.warning(f"Không tìm thấy hội thoại để xóa: {conversation_id}")
+                    return False
+
+                def mark_deleted(conversation):
+                    # Kiểm tra nếu đã xóa rồi
+                    if conversation.get("deleted", False):
+                        return conversation, False
+
+                    # Đánh dấu là đã xóa
+                    conversation["deleted"] = True
+                    conversation["deleted_at"] = timestamp.isoformat()
+                    return conversation, True
+
+                if not self._update_json_file(meta_file, mark_deleted):
+                    return False
+
+                # Cập nhật manifest của người dùng
+                self._update_conversation_manifest(
+                    user_dir, conversation_id,
+                    fields={"deleted": True, "deleted_at": timestamp.isoformat()}
+                )
+
+                self._invalidate_cached_entity("conversations", conversation_id)
+                return True
         except Exception as e:
             logger.error(f"Lỗi khi xóa hội thoại: {str(e)}")
             return False
@@ -1948,7 +4881,18 @@ class StorageService:
                     }
                 )
                 
+                self._invalidate_cached_entity("conversations")
                 return True  # Luôn trả về True, ngay cả khi không có hội thoại nào bị xóa
+            elif self.storage_type == "sqlite":
+                # Soft delete tất cả hội thoại của người dùng
+                with self._sqlite_transaction() as conn:
+                    conn.execute(
+                        "UPDATE conversations SET deleted = 1, deleted_at = ? WHERE username = ? AND deleted = 0",
+                        (timestamp.isoformat(), username)
+                    )
+                
+                self._invalidate_cached_entity("conversations")
+                return True
             else:
                 # Lưu trữ file
                 conversations_dir = os.path.join(self.data_dir, "conversations")
@@ -1965,23 +4909,28 @@ class StorageService:
                 # Đánh dấu tất cả hội thoại là đã xóa
                 meta_files = [f for f in os.listdir(meta_dir) if f.endswith('.json')]
                 
+                def mark_deleted(conversation):
+                    # Đánh dấu là đã xóa (nếu chưa xóa)
+                    if not conversation.get("deleted", False):
+                        conversation["deleted"] = True
+                        conversation["deleted_at"] = timestamp.isoformat()
+                    return conversation, True
+                
                 for meta_file in meta_files:
                     file_path = os.path.join(meta_dir, meta_file)
                     try:
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Đánh dấu là đã xóa (nếu chưa xóa)
-                        if not conversation.get("deleted", False):
-                            conversation["deleted"] = True
-                            conversation["deleted_at"] = timestamp.isoformat()
-                            
-                            # Lưu lại
-                            with open(file_path, "w", encoding="utf-8") as f:
-                                json.dump(conversation, f, ensure_ascii=False, indent=2)
+                        self._update_json_file(file_path, mark_deleted)
                     except Exception as e:
                         logger.error(f"Lỗi khi đánh dấu xóa file hội thoại: {str(e)}")
                 
+                # Đánh dấu đã xóa trong manifest của người dùng
+                def mark_all_deleted(entries, rebuilt):
+                    for entry in entries:
+                        mark_deleted(entry)
+                
+                self._update_conversation_manifest_entries(user_dir, mark_all_deleted)
+                
+                self._invalidate_cached_entity("conversations")
                 return True
         except Exception as e:
             logger.error(f"Lỗi khi xóa tất cả hội thoại: {str(e)}")
@@ -2005,6 +4954,12 @@ class StorageService:
                     "deleted": {"$ne": True}
                 })
                 return count
+            elif self.storage_type == "sqlite":
+                row = self._sqlite_conn().execute(
+                    "SELECT COUNT(*) AS count FROM conversations WHERE username = ? AND deleted = 0",
+                    (username,)
+                ).fetchone()
+                return row["count"]
             else:
                 # Lưu trữ file
                 conversations_dir = os.path.join(self.data_dir, "conversations")
@@ -2013,28 +4968,11 @@ class StorageService:
                 if not os.path.exists(user_dir):
                     return 0
                 
-                # Lấy danh sách file hội thoại metadata
-                meta_dir = os.path.join(user_dir, "metadata")
-                if not os.path.exists(meta_dir):
-                    return 0
-                
-                # Đếm số file metadata (trừ những hội thoại đã xóa)
-                count = 0
-                meta_files = [f for f in os.listdir(meta_dir) if f.endswith('.json')]
-                
-                for meta_file in meta_files:
-                    file_path = os.path.join(meta_dir, meta_file)
-                    try:
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        # Kiểm tra nếu chưa xóa
-                        if not conversation.get("deleted", False):
-                            count += 1
-                    except Exception as e:
-                        logger.error(f"Lỗi đọc file hội thoại khi đếm: {str(e)}")
-                
-                return count
+                # Đếm từ manifest (trừ những hội thoại đã xóa)
+                return sum(
+                    1 for conversation in self._load_conversation_manifest(user_dir)
+                    if not conversation.get("deleted", False)
+                )
         except Exception as e:
             logger.error(f"Lỗi khi đếm tổng số hội thoại: {str(e)}")
             return 0
@@ -2048,92 +4986,131 @@ class StorageService:
             role (str): Vai trò (user/assistant)
             content (str): Nội dung tin nhắn
             
+        Returns:
+            bool: True nếu thành công, False nếu thất bại
+        """
+        return self.add_messages_to_conversation(conversation_id, [{"role": role, "content": content}])
+
+    def add_messages_to_conversation(self, conversation_id: str, messages: List[Dict[str, Any]]) -> bool:
+        """
+        Thêm nhiều tin nhắn (ví dụ một lượt chat: tin nhắn người dùng + phản hồi) vào hội thoại
+        trong một lần ghi: MongoDB một insert_many + một update, SQLite một transaction,
+        lưu trữ file một lần append
+        
+        Args:
+            conversation_id (str): ID hội thoại
+            messages (List[Dict]): Danh sách {"role", "content", "timestamp" (datetime, tùy chọn)}
+                theo thứ tự thời gian
+            
         Returns:
             bool: True nếu thành công, False nếu thất bại
         """
         try:
-            timestamp = datetime.now()
-            message_id = str(uuid.uuid4())
+            if not messages:
+                return True
             
-            message_data = {
-                "conversation_id": conversation_id,
-                "id": message_id,
-                "role": role,
-                "content": content,
-                "timestamp": timestamp
-            }
+            messages_data = []
+            for message in messages:
+                messages_data.append({
+                    "conversation_id": conversation_id,
+                    "id": str(uuid.uuid4()),
+                    "role": message["role"],
+                    "content": message["content"],
+                    "timestamp": message.get("timestamp") or datetime.now()
+                })
+            
+            last_message = messages_data[-1]
+            timestamp = last_message["timestamp"]
             
             if self.storage_type == "mongodb":
                 # Chuyển conversation_id thành ObjectId nếu là string
+                conversation_key = conversation_id
                 if isinstance(conversation_id, str):
                     try:
-                        message_data["conversation_id"] = ObjectId(conversation_id)
+                        conversation_key = ObjectId(conversation_id)
                     except:
                         # Nếu không phải ObjectId hợp lệ, giữ nguyên
                         pass
                 
-                # Thêm tin nhắn mới
-                self.db.conversation_messages.insert_one(message_data)
+                for message_data in messages_data:
+                    message_data["conversation_id"] = conversation_key
                 
-                # Cập nhật thời gian cập nhật của hội thoại
-                self.db.conversations.update_one(
-                    {"_id": message_data["conversation_id"]},
-                    {"$set": {"updated_at": timestamp}}
-                )
+                # Thêm các tin nhắn mới
+                self._mongo_db("messages").conversation_messages.insert_many(messages_data, ordered=True)
                 
-                return True
-            else:
-                # Lưu trữ file - tìm trong tất cả người dùng
-                conversations_dir = os.path.join(self.data_dir, "conversations")
+                # Cập nhật thời gian cập nhật và thông tin tóm tắt của hội thoại
+                self._update_conversation_stats(conversation_key, messages_data)
                 
-                # Tìm file hội thoại để lấy username
-                username = None
+                return True
+            elif self.storage_type == "sqlite":
+                for message_data in messages_data:
+                    message_data["timestamp"] = message_data["timestamp"].isoformat()
+                
+                last_message_summary = {
+                    "id": last_message["id"],
+                    "role": last_message["role"],
+                    "content": last_message["content"][:100],
+                    "timestamp": last_message["timestamp"]
+                }
                 
-                for user_dir in os.listdir(conversations_dir):
-                    if not os.path.isdir(os.path.join(conversations_dir, user_dir)):
-                        continue
+                # Thêm tin nhắn và cập nhật thông tin tóm tắt của hội thoại trong cùng transaction
+                with self._sqlite_transaction() as conn:
+                    cursor = conn.execute(
+                        "UPDATE conversations SET updated_at = ?, message_count = message_count + ?, "
+                        "preview = ?, last_message = ? WHERE id = ?",
+                        (
+                            last_message["timestamp"],
+                            len(messages_data),
+                            last_message["content"][:100],
+                            json.dumps(last_message_summary, ensure_ascii=False),
+                            conversation_id
+                        )
+                    )
                     
-                    meta_dir = os.path.join(conversations_dir, user_dir, "metadata")
-                    if not os.path.exists(meta_dir):
-                        continue
+                    if cursor.rowcount == 0:
+                        logger.error(f"Không tìm thấy hội thoại với ID: {conversation_id}")
+                        return False
                     
-                    meta_file = os.path.join(meta_dir, f"{conversation_id}.json")
-                    if os.path.exists(meta_file):
-                        username = user_dir
-                        
-                        # Cập nhật thời gian cập nhật hội thoại
-                        with open(meta_file, "r", encoding="utf-8") as f:
-                            conversation = json.load(f)
-                        
-                        conversation["updated_at"] = timestamp.isoformat()
-                        
-                        with open(meta_file, "w", encoding="utf-8") as f:
-                            json.dump(conversation, f, ensure_ascii=False, indent=2)
-                        
-                        break
+                    conn.executemany(
+                        "INSERT INTO conversation_messages (id, conversation_id, role, content, timestamp) "
+                        "VALUES (:id, :conversation_id, :role, :content, :timestamp)",
+                        messages_data
+                    )
                 
-                if not username:
+                return True
+            else:
+                # Lưu trữ file - tra cứu chủ sở hữu qua index
+                user_dir, meta_file = self._locate_conversation(conversation_id)
+
+                if not meta_file:
+                    logger.error(f"Không tìm thấy username cho conversation_id: {conversation_id}")
                     return False
-                
+
+                # Cập nhật thời gian cập nhật hội thoại
+                def touch(conversation):
+                    conversation["updated_at"] = timestamp.isoformat()
+                    return conversation, True
+
+                self._update_json_file(meta_file, touch)
+
                 # Tìm file tin nhắn
-                messages_file = os.path.join(conversations_dir, username, f"{conversation_id}.json")
-                
-                messages = []
-                if os.path.exists(messages_file):
-                    with open(messages_file, "r", encoding="utf-8") as f:
-                        messages = json.load(f)
-                
+                messages_file = self._get_messages_file(user_dir, conversation_id)
+
                 # Chuẩn bị tin nhắn mới
-                message_data["timestamp"] = message_data["timestamp"].isoformat()
-                
-                # Thêm tin nhắn mới
-                messages.append(message_data)
-                
-                # Lưu lại
-                with open(messages_file, "w", encoding="utf-8") as f:
-                    json.dump(messages, f, ensure_ascii=False, indent=2)
-                
+                for message_data in messages_data:
+                    message_data["timestamp"] = message_data["timestamp"].isoformat()
+
+                # Ghi thêm các tin nhắn vào cuối file trong một lần append (không đọc lại toàn bộ hội thoại)
+                self._append_jsonl(messages_file, messages_data)
+
+                # Cập nhật manifest của người dùng
+                self._update_conversation_manifest(
+                    user_dir, conversation_id,
+                    fields={"updated_at": timestamp.isoformat()},
+                    messages=messages_data
+                )
+
                 return True
         except Exception as e:
             logger.error(f"Lỗi khi thêm tin nhắn vào hội thoại: {str(e)}")
-            return False
\ No newline at end of file
+            return False
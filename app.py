@@ -12,8 +12,7 @@ from datetime import datetime, timedelta
 from functools import wraps
 
 from api.chatbot_service import CodeSupporterService
-from api.storage_service import StorageService
-from api.api_service import api_bp  # Import Blueprint thay vì app
+from api.api_service import api_bp, storage_service  # Import Blueprint thay vì app
 
 # Cấu hình logging
 logging.basicConfig(
@@ -35,7 +34,7 @@ SECRET_KEY = os.getenv('API_SECRET_KEY', 'default_secret_key')
 
 # Khởi tạo các dịch vụ
 chatbot_service = CodeSupporterService()
-storage_service = StorageService()
+# storage_service dùng chung với Blueprint API (một connection pool MongoDB cho mỗi tiến trình)
 
 # --- Decorator xác thực ---
 
@@ -117,6 +116,8 @@ if __name__ == '__main__':
     
     if storage_service.storage_type == "mongodb":
         logger.info("Đã kết nối thành công với MongoDB")
+    elif storage_service.storage_type == "sqlite":
+        logger.info(f"Sử dụng lưu trữ SQLite: {storage_service.sqlite_path}")
     else:
         logger.warning("Sử dụng lưu trữ file. Để sử dụng MongoDB, hãy đặt biến môi trường MONGODB_URI")
     